@@ -0,0 +1,125 @@
+"""
+Headless batch runner for scenario files.
+
+Each scenario is a json file naming a model in rms/models and the values to override, e.g.
+
+    {
+        "model": "jckantor_complex",
+        "params": {"UA": 40000},
+        "mvars": {"q": 120, "T0": 360},
+        "subrvars": {"Tsp": 380},
+        "simvars": {"Tf": 10, "n": 200}
+    }
+
+Usage:
+
+    python rms/batch.py scenarios/ -o results/ -j 4
+
+Every result is written to a columnar file named after its scenario, and a summary of all the runs to index.csv.
+"""
+from engine import Model, Simulator, write_timeseries
+import multiprocessing
+import argparse
+import time
+import glob
+import json
+import os
+import pandas as pd
+
+MODELS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')
+
+def run_scenario(scenario_file, output_dir, fmt = 'parquet', models_dir = MODELS_DIR):
+    """
+    Runs a single scenario and writes its result. Returns a summary of the run, also when it fails.
+
+    Arguments
+    ---------
+        scenario_file :
+            Path to the scenario json file
+        output_dir :
+            Directory where the result is written
+
+    Keyword Arguments
+    -----------------
+        fmt : str
+            File format of the result, "parquet" or "csv". Defaults to "parquet".
+        models_dir :
+            Directory with the models. Defaults to rms/models.
+    """
+    name = os.path.splitext(os.path.basename(scenario_file))[0]
+    summary = {'scenario': name, 'model': None, 'status': 'failed', 'message': '', 'wall_time_s': None, 'n_steps': 0, 'output': None}
+    tic = time.perf_counter()
+    try:
+        with open(scenario_file) as f:
+            scenario = json.load(f)
+        summary['model'] = scenario['model']
+
+        mysim = Simulator(model = Model(os.path.join(models_dir, scenario['model'])))
+        mysim.update_inputs(**{k: scenario.get(k) for k in ['params', 'mvars', 'subrvars', 'simvars']})
+        mysim.reinitialize()
+        data = mysim.run()
+
+        output = os.path.join(output_dir, name + '.' + fmt)
+        write_timeseries(data, output)
+        summary.update({'status': 'ok', 'n_steps': len(data), 'output': output})
+    except Exception as e:
+        summary['message'] = '{}: {}'.format(type(e).__name__, e)
+    summary['wall_time_s'] = time.perf_counter() - tic
+    return summary
+
+def _run_scenario(args):
+    return run_scenario(*args)
+
+def run_batch(scenario_dir, output_dir, jobs = None, fmt = 'parquet', max_tasks_per_child = 10, models_dir = MODELS_DIR):
+    """
+    Runs all the scenarios (*.json) in a directory in parallel. Workers only return a small summary
+    and are replaced after a number of scenarios, which keeps the memory bounded.
+    Returns the summary of all runs, also written to index.csv in the output directory.
+
+    Arguments
+    ---------
+        scenario_dir :
+            Directory with the scenario json files
+        output_dir :
+            Directory where the results are written
+
+    Keyword Arguments
+    -----------------
+        jobs : int
+            Number of worker processes. Defaults to the number of CPUs.
+        fmt : str
+            File format of the results, "parquet" or "csv". Defaults to "parquet".
+        max_tasks_per_child : int
+            Scenarios run by a worker before it is replaced. Defaults to 10.
+        models_dir :
+            Directory with the models. Defaults to rms/models.
+    """
+    os.makedirs(output_dir, exist_ok = True)
+    files = sorted(glob.glob(os.path.join(scenario_dir, '*.json')))
+    args = [(f, output_dir, fmt, models_dir) for f in files]
+
+    with multiprocessing.Pool(processes = jobs, maxtasksperchild = max_tasks_per_child) as pool:
+        summaries = []
+        for summary in pool.imap_unordered(_run_scenario, args):
+            print('{scenario}: {status} in {wall_time_s:.2f} s {message}'.format(**summary))
+            summaries.append(summary)
+
+    index = pd.DataFrame(summaries, columns = ['scenario', 'model', 'status', 'message', 'wall_time_s', 'n_steps', 'output'])
+    index = index.sort_values('scenario').reset_index(drop = True)
+    index.to_csv(os.path.join(output_dir, 'index.csv'), index = False)
+    return index
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Run a directory of scenario files without the Dash app.')
+    parser.add_argument('scenario_dir', help = 'directory with the scenario json files')
+    parser.add_argument('-o', '--output-dir', default = 'results', help = 'directory for the results (default: results)')
+    parser.add_argument('-j', '--jobs', type = int, default = None, help = 'number of worker processes (default: number of CPUs)')
+    parser.add_argument('-f', '--format', default = 'parquet', choices = ['parquet', 'csv'], help = 'result file format (default: parquet)')
+    parser.add_argument('--max-tasks-per-child', type = int, default = 10, help = 'scenarios per worker before it is replaced (default: 10)')
+    args = parser.parse_args(argv)
+
+    index = run_batch(args.scenario_dir, args.output_dir, jobs = args.jobs, fmt = args.format, max_tasks_per_child = args.max_tasks_per_child)
+    return 0 if (index.status == 'ok').all() else 1
+
+if __name__ == '__main__':
+    raise SystemExit(main())
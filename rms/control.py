@@ -0,0 +1,444 @@
+from engine import Subroutine, Model, Simulator, make_bioprocess_model, rhs_batch, rhs_jacobian, rhs_jacobian_batch, parameter_jacobian
+from scipy.integrate import odeint
+from scipy.linalg import expm
+from scipy.optimize import minimize
+import numpy as np
+
+class MPCSubroutine(Subroutine):
+    """
+    Linear model predictive control based on a linearization of MyModel.rhs.
+    The linearization is cached and reused while the state and inputs stay within a trust region,
+    so no simulation is needed to evaluate candidate moves.
+    The resulting box-constrained QP is solved warm-started from the previous solution.
+
+    Inherit from this class and set the class attributes below, e.g. for jckantor_complex:
+
+        class MySubroutines(MPCSubroutine):
+            manipulated = ['qc']
+            setpoints = {'T': 'Tsp'}
+            bounds = {'qc': ('qc_min', 'qc_max')}
+            move_weights = {'qc': 1e-3}
+    """
+    # manipulated variables, as named in the model parameters
+    manipulated = []
+    # controlled states and their setpoints, either a number or the name of a subroutine variable
+    setpoints = {}
+    # bounds of the manipulated variables, either numbers or names of subroutine variables
+    bounds = {}
+    # tracking weights of the controlled states, default 1
+    weights = {}
+    # move suppression weights of the manipulated variables, default 0
+    move_weights = {}
+    # number of steps of the prediction horizon
+    horizon = 10
+    # maximum relative change of state and inputs before linearizing again
+    trust_region = 0.02
+
+    def __init__(self, model: Model, simulator: Simulator):
+        """
+        Arguments
+        ---------
+            model : Model
+                Model object this subroutine is associated with
+            simulator : Simulator
+                Simulator object running the model and subroutines
+        """
+        self._linearization = None
+        self._U = None
+        self.linearizations = 0
+        super().__init__(model, simulator)
+
+    def model_predictive_control(self):
+        '''
+        Computes the optimal moves over the horizon and applies the first one
+        '''
+        dt = self.simulator_vars['dt']
+        states = list(self.model_state.keys())
+        x = np.array([self.model_state[k] for k in states], dtype = float)
+        u = np.array([self.model_parameters[k] for k in self.manipulated], dtype = float)
+
+        if not self._is_valid(x, u, dt):
+            self._linearize(x, u, dt)
+        lin = self._linearization
+
+        N, m = self.horizon, len(self.manipulated)
+        r = np.tile([self._value(self.setpoints[k]) for k in self.setpoints], N)
+        lb = np.tile([self._value(self.bounds[k][0]) if k in self.bounds else -np.inf for k in self.manipulated], N)
+        ub = np.tile([self._value(self.bounds[k][1]) if k in self.bounds else np.inf for k in self.manipulated], N)
+
+        # outputs are Y = Y0 + G U, moves are D U - d0
+        Y0 = lin['Yx'] @ (x - lin['x']) + lin['Y0']
+        d0 = np.zeros(N*m)
+        d0[:m] = u
+        b = np.concatenate([lin['wy']*(r - Y0), lin['wu']*d0])
+        g = -lin['A'].T @ b
+
+        # warm start from the previous solution, shifted by one step
+        if self._U is None or len(self._U) != N*m:
+            U0 = np.tile(u, N)
+        else:
+            U0 = np.concatenate([self._U[m:], self._U[-m:]])
+        U0 = np.clip(U0, lb, ub)
+
+        H = lin['H']
+        res = minimize(lambda U: 0.5*U @ H @ U + g @ U, U0, jac = lambda U: H @ U + g,
+                       method = 'L-BFGS-B', bounds = list(zip(lb, ub)))
+        self._U = res.x
+
+        for k, value in zip(self.manipulated, self._U[:m]):
+            self.model_parameters[k] = value
+        return True
+
+    def _value(self, v):
+        """
+        Returns v, or the subroutine variable named v
+        """
+        return float(self.subroutine_vars[v]) if isinstance(v, str) else float(v)
+
+    def _is_valid(self, x, u, dt):
+        """
+        Checks if the cached linearization can be reused at state x and inputs u
+        """
+        lin = self._linearization
+        if lin is None or lin['dt'] != dt or lin['horizon'] != self.horizon:
+            return False
+        if self._fixed_parameters() != lin['parameters']:
+            return False
+        xu, xu0 = np.concatenate([x, u]), np.concatenate([lin['x'], lin['u']])
+        return np.all(np.abs(xu - xu0) <= self.trust_region*np.maximum(np.abs(xu0), 1e-6))
+
+    def _fixed_parameters(self):
+        """
+        Model parameters other than the manipulated variables, states and initial conditions
+        """
+        skip = [*self.manipulated, *self.model_state, *[k+'0' for k in self.model_state]]
+        return {k: v for k, v in self.model_parameters.items() if k not in skip}
+
+    def _linearize(self, x, u, dt):
+        """
+        Linearizes and discretizes the model around x and u, and builds the condensed QP matrices
+        """
+        bioprocess_model = make_bioprocess_model(self.model.model_class, self.model_parameters)
+        n, m, N = len(x), len(u), self.horizon
+
+        A = rhs_jacobian(bioprocess_model, 0., x)
+        B = parameter_jacobian(bioprocess_model, 0., x, self.manipulated)
+        c = np.asarray(bioprocess_model.rhs(0., x), dtype = float)
+
+        # exact discretization of dx/dt = A dx + B du + c
+        M = np.zeros((n+m+1, n+m+1))
+        M[:n,:n], M[:n,n:n+m], M[:n,-1] = A, B, c
+        E = expm(M*dt)
+        Ad, Bd, cd = E[:n,:n], E[:n,n:n+m], E[:n,-1]
+
+        # predictions of the deviations over the horizon
+        states = list(self.model_state.keys())
+        C = np.zeros((len(self.setpoints), n))
+        for i, k in enumerate(self.setpoints):
+            C[i, states.index(k)] = 1.
+
+        Phi = np.zeros((N*n, n))
+        Gamma = np.zeros((N*n, N*m))
+        offset = np.zeros(N*n)
+        Ak, ck = np.eye(n), np.zeros(n)
+        for k in range(N):
+            ck = Ad @ ck + cd
+            Ak = Ad @ Ak
+            Phi[k*n:(k+1)*n] = Ak
+            offset[k*n:(k+1)*n] = ck
+            for j in range(k+1):
+                Gamma[k*n:(k+1)*n, j*m:(j+1)*m] = np.linalg.matrix_power(Ad, k-j) @ Bd
+
+        Cbig = np.kron(np.eye(N), C)
+        G = Cbig @ Gamma
+        D = np.eye(N*m) - np.eye(N*m, k = -m)
+
+        wy = np.tile([np.sqrt(self.weights.get(k, 1.)) for k in self.setpoints], N)
+        wu = np.tile([np.sqrt(self.move_weights.get(k, 0.)) for k in self.manipulated], N)
+        A_ls = np.vstack([wy[:,None]*G, wu[:,None]*D])
+
+        self._linearization = {
+            'x': x, 'u': u, 'dt': dt, 'horizon': N,
+            'parameters': self._fixed_parameters(),
+            'Yx': Cbig @ Phi,
+            'Y0': Cbig @ (np.tile(x, N) + offset) - G @ np.tile(u, N),
+            'wy': wy, 'wu': wu, 'A': A_ls, 'H': A_ls.T @ A_ls,
+        }
+        self.linearizations += 1
+
+class ExtendedKalmanFilter():
+    """
+    Continuous-discrete extended Kalman filter for k instances of a model at once, e.g. a fleet of vessels.
+    Between samples the means are integrated with MyModel.rhs, all the instances in a single stacked solve,
+    and the covariances are propagated with the discretized Jacobians (see `rhs_jacobian_batch`).
+    Measurements are states of the model, with missing values as NaN.
+    """
+    def __init__(self, model: Model, measured: list, x0, P0, Q, R, parameters = None):
+        """
+        Arguments
+        ---------
+            model : Model
+                Model of the instances
+            measured : list
+                Names of the measured states
+            x0 : array-like
+                Initial estimates, with shape (k, states) or (states,) for a single instance.
+                States are in the order of `Model.get_state_dict`.
+            P0 : array-like
+                Initial covariances, with shape (k, states, states) or (states, states)
+            Q : array-like
+                Process noise intensity, i.e. covariance per unit of time, with shape (states, states)
+            R : array-like
+                Measurement noise covariance, with shape (measured, measured)
+
+        Keyword Arguments
+        -----------------
+            parameters : dict
+                Values of the model parameters, scalars or arrays with one value per instance.
+                Defaults to None, the current values of the model.
+        """
+        self.model_class = model.model_class
+        self.states = list(model.get_state_dict().keys())
+        self.measured = list(measured)
+        self.x = np.atleast_2d(np.asarray(x0, dtype = float)).copy()
+        k, n = self.x.shape
+        self.P = np.broadcast_to(np.asarray(P0, dtype = float), (k, n, n)).copy()
+        self.Q = np.asarray(Q, dtype = float)
+        self.R = np.asarray(R, dtype = float)
+        self.H = np.zeros((len(self.measured), n))
+        for i, v in enumerate(self.measured):
+            self.H[i, self.states.index(v)] = 1.
+        self.parameters = dict(model.get_vars_dict() if parameters is None else parameters)
+
+    @property
+    def std(self):
+        """
+        Standard deviations of the estimates, with shape (k, states)
+        """
+        return np.sqrt(np.diagonal(self.P, axis1 = 1, axis2 = 2))
+
+    def _model(self, repeat = 1):
+        """
+        Model instance holding the parameters of every instance, each repeated `repeat` times
+        """
+        return make_bioprocess_model(self.model_class, {p: np.repeat(v, repeat) if np.ndim(v) else v for p, v in self.parameters.items()})
+
+    def _integrate(self, bioprocess_model, t, dt, X):
+        """
+        Integrates the state vectors X, with shape (vectors, states), from t to t + dt in a single solve
+        """
+        k, n = X.shape
+        def myfun(y, t):
+            return rhs_batch(bioprocess_model, t, y.reshape(k, n).T).T.ravel()
+        # the states of each vector are contiguous, so the Jacobian is banded
+        return odeint(myfun, t = np.array([t, t+dt]), y0 = X.ravel(), ml = n-1, mu = n-1, mxstep = 5000)[-1].reshape(k, n)
+
+    def predict(self, dt, parameters = None, t = 0.):
+        """
+        Propagates the means and covariances from t to t + dt, and returns the means
+
+        Arguments
+        ---------
+            dt : float
+                Time since the last sample
+
+        Keyword Arguments
+        -----------------
+            parameters : dict
+                New values of the model parameters, held over the interval. Defaults to None, the last values.
+            t : float
+                Time of the last sample. Defaults to 0.
+        """
+        if parameters is not None:
+            self.parameters.update(parameters)
+        bioprocess_model = self._model()
+        k, n = self.x.shape
+
+        # Van Loan discretization of the covariance, linearized at the current means
+        F = rhs_jacobian_batch(bioprocess_model, t, self.x.T)
+        M = np.zeros((k, 2*n, 2*n))
+        M[:, :n, :n] = -F
+        M[:, :n, n:] = self.Q
+        M[:, n:, n:] = np.swapaxes(F, 1, 2)
+        E = expm(M*dt)
+        Phi = np.swapaxes(E[:, n:, n:], 1, 2)
+        Qd = Phi @ E[:, :n, n:]
+
+        self.x = self._integrate(bioprocess_model, t, dt, self.x)
+        self.P = Phi @ self.P @ np.swapaxes(Phi, 1, 2) + Qd
+        return self.x
+
+    def update(self, z):
+        """
+        Corrects the estimates with new measurements, and returns the means
+
+        Arguments
+        ---------
+            z : array-like
+                Measurements, with shape (k, measured) or (measured,). Missing values are NaN.
+        """
+        k, n = self.x.shape
+        m = len(self.measured)
+        z = np.broadcast_to(np.asarray(z, dtype = float), (k, m))
+        missing = np.isnan(z)
+        innovation = np.where(missing, 0., z - self.x @ self.H.T)
+
+        # missing measurements are uncorrelated and have no gain
+        R = np.broadcast_to(self.R, (k, m, m)).copy()
+        R[missing[:, :, None] | missing[:, None, :]] = 0.
+        R[:, np.arange(m), np.arange(m)] = np.where(missing, 1e300, R[:, np.arange(m), np.arange(m)])
+
+        HP = self.H @ self.P
+        S = HP @ self.H.T + R
+        K = np.swapaxes(np.linalg.solve(S, HP), 1, 2)
+        K[np.broadcast_to(missing[:, None, :], K.shape)] = 0.
+        self.x = self.x + (K @ innovation[:, :, None])[:, :, 0]
+        # Joseph form, which keeps the covariances symmetric and positive
+        IKH = np.eye(n) - K @ self.H
+        self.P = IKH @ self.P @ np.swapaxes(IKH, 1, 2) + K @ np.where(R < 1e300, R, 0.) @ np.swapaxes(K, 1, 2)
+        return self.x
+
+class UnscentedKalmanFilter(ExtendedKalmanFilter):
+    """
+    Unscented Kalman filter for k instances of a model at once. Same as ExtendedKalmanFilter, but the means and
+    covariances are propagated through the sigma points of every instance, all of them in a single stacked solve,
+    so no Jacobian is needed.
+    """
+    def __init__(self, model: Model, measured: list, x0, P0, Q, R, parameters = None, alpha = 1e-3, beta = 2., kappa = 0.):
+        """
+        Arguments
+        ---------
+            See ExtendedKalmanFilter.
+
+        Keyword Arguments
+        -----------------
+            parameters : dict
+                Values of the model parameters. See ExtendedKalmanFilter.
+            alpha : float
+                Spread of the sigma points. Defaults to 1e-3.
+            beta : float
+                Prior knowledge of the distribution, 2 is optimal for Gaussians. Defaults to 2.
+            kappa : float
+                Secondary scaling parameter. Defaults to 0.
+        """
+        super().__init__(model, measured, x0, P0, Q, R, parameters)
+        n = self.x.shape[1]
+        self.scaling = alpha**2*(n + kappa) - n
+        self.Wm = np.full(2*n + 1, 0.5/(n + self.scaling))
+        self.Wc = self.Wm.copy()
+        self.Wm[0] = self.scaling/(n + self.scaling)
+        self.Wc[0] = self.Wm[0] + 1 - alpha**2 + beta
+
+    def predict(self, dt, parameters = None, t = 0.):
+        """
+        Propagates the means and covariances from t to t + dt, and returns the means. See ExtendedKalmanFilter.predict.
+        """
+        if parameters is not None:
+            self.parameters.update(parameters)
+        k, n = self.x.shape
+
+        # sigma points of every instance, with shape (k, 2n+1, states)
+        L = np.swapaxes(np.linalg.cholesky((n + self.scaling)*self.P), 1, 2)
+        sigma = self.x[:, None, :] + np.concatenate([np.zeros((k, 1, n)), L, -L], axis = 1)
+        sigma = self._integrate(self._model(repeat = 2*n + 1), t, dt, sigma.reshape(-1, n)).reshape(k, 2*n + 1, n)
+
+        self.x = np.einsum('s,ksn->kn', self.Wm, sigma)
+        d = sigma - self.x[:, None, :]
+        self.P = np.einsum('s,ksi,ksj->kij', self.Wc, d, d) + self.Q*dt
+        return self.x
+
+class EstimatorSubroutine(Subroutine):
+    """
+    Soft sensor: estimates the states of the model from noisy measurements of some of them, with an extended
+    (or unscented) Kalman filter running on MyModel.rhs. Measurements are simulated from the model states.
+    The current estimates are kept in `estimate`, and their history in `estimates`.
+
+    Inherit from this class and set the class attributes below, e.g. for jckantor_simple,
+    with P_noise and V_noise in the controlled_vars.csv of the model:
+
+        class MySubroutines(EstimatorSubroutine):
+            measured = ['P', 'V']
+            noise = {'P': 'P_noise', 'V': 'V_noise'}
+            initial_guess = {'S': 8}
+            initial_std = {'X': 0.05, 'S': 2}
+
+    Decorate `state_estimation` with @periodic to set the sample period.
+    Subclasses overriding `_initialization` must call it from their own.
+    """
+    # measured states
+    measured = []
+    # standard deviations of the measurement noise, either numbers or names of subroutine variables,
+    # default 1% of the initial conditions
+    noise = {}
+    # standard deviations of the process noise per unit of time, default 0
+    process_noise = {}
+    # standard deviations of the initial estimates, default 10% of the initial guess
+    initial_std = {}
+    # initial estimates, default the initial conditions
+    initial_guess = {}
+    # "ekf" or "ukf"
+    filter = 'ekf'
+    # seed of the simulated measurement noise
+    seed = None
+
+    def _initialization(self):
+        '''
+        Creates the filter from the initial conditions of the model
+        '''
+        state = self.model_state
+        states = list(state.keys())
+        x0 = np.array([self.initial_guess.get(k, state[k]) for k in states], dtype = float)
+        std = [self.initial_std.get(k, 0.1*max(abs(x), 1e-6)) for k, x in zip(states, x0)]
+        noise = [self._value(self.noise.get(k, 0.01*max(abs(state[k]), 1e-6))) for k in self.measured]
+        Q = np.diag([self.process_noise.get(k, 0.)**2 for k in states])
+        if self.filter == 'ekf':
+            kalman_filter = ExtendedKalmanFilter
+        elif self.filter == 'ukf':
+            kalman_filter = UnscentedKalmanFilter
+        else:
+            raise ValueError('Filter not recognized. Please use "ekf" or "ukf".')
+        self.kalman_filter = kalman_filter(self.model, self.measured, x0, np.diag(np.square(std)), Q, np.diag(np.square(noise)), parameters = self._parameters())
+        self.measurement_noise = dict(zip(self.measured, noise))
+        self._rng = np.random.default_rng(self.seed)
+        self._time = None
+        self._last_time = None
+        self.estimate = dict(zip(states, x0))
+        self.estimates = []
+
+    def _value(self, v):
+        """
+        Returns v, or the subroutine variable named v
+        """
+        return float(self.subroutine_vars[v]) if isinstance(v, str) else float(v)
+
+    def _parameters(self):
+        """
+        Current model parameters, without the states
+        """
+        return {k: v for k, v in self.model_parameters.items() if k not in self.model_state}
+
+    def _execute(self, t: float, methods = None):
+        """
+        Keeps the current time, to know the time between samples
+        """
+        self._time = t
+        super()._execute(t, methods)
+
+    def state_estimation(self):
+        '''
+        Measures, predicts the states since the last sample and corrects them with the measurements
+        '''
+        kalman_filter = self.kalman_filter
+        z = np.array([self.model_state[k] + self.measurement_noise[k]*self._rng.standard_normal() for k in self.measured])
+        if self._last_time is not None and self._time > self._last_time:
+            kalman_filter.predict(self._time - self._last_time, t = self._last_time)
+        x = kalman_filter.update(z)[0]
+        # inputs are held until the next sample
+        kalman_filter.parameters.update(self._parameters())
+        self._last_time = self._time
+
+        self.estimate = dict(zip(kalman_filter.states, x))
+        self.estimates.append({'Time': self._time, **dict(zip(self.measured, z)),
+                               **{k+'_est': v for k, v in self.estimate.items()},
+                               **{k+'_std': v for k, v in zip(kalman_filter.states, kalman_filter.std[0])}})
+        return True
@@ -0,0 +1,102 @@
+// Builds the charts in the browser from the results sent by encode_frame (dash_apps/shared_transport.py).
+// Every column is decoded once per run and shared by all the charts. Past runs from the history are overlaid as dashed lines,
+// and previews of the surrogate are drawn dotted until the exact run replaces them.
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    rms: {
+        _cache: {},
+
+        _decode: function(text, dtype) {
+            var binary = atob(text);
+            var bytes = new Uint8Array(binary.length);
+            for (var i = 0; i < binary.length; i++) {
+                bytes[i] = binary.charCodeAt(i);
+            }
+            return dtype === 'float32' ? new Float32Array(bytes.buffer) : new Float64Array(bytes.buffer);
+        },
+
+        _entry: function(payload) {
+            var cache = window.dash_clientside.rms._cache;
+            if (!(payload.run in cache)) {
+                cache[payload.run] = {time: window.dash_clientside.rms._decode(payload.time, 'float64'), columns: {}};
+            }
+            return cache[payload.run];
+        },
+
+        _column: function(payload, name) {
+            var entry = window.dash_clientside.rms._entry(payload);
+            if (!(name in entry.columns)) {
+                entry.columns[name] = window.dash_clientside.rms._decode(payload.columns[name], payload.dtype);
+            }
+            return entry.columns[name];
+        },
+
+        _prune: function(payloads) {
+            // keeps the decoded columns of the runs on display only
+            var cache = window.dash_clientside.rms._cache;
+            var keep = payloads.map(function(p) { return String(p.run); });
+            Object.keys(cache).forEach(function(run) {
+                if (keep.indexOf(run) < 0) {
+                    delete cache[run];
+                }
+            });
+        },
+
+        figure: function(spec, time_idx, payload, overlays, preview, old_fig) {
+            // shows whichever of the exact run and the surrogate preview is newer
+            var shown = [payload, preview].filter(Boolean);
+            if (preview && (!payload || preview.meta.stamp > (payload.meta.stamp || 0))) {
+                payload = preview;
+            }
+            if (!spec || !payload || !spec.vars || spec.vars.length === 0) {
+                return old_fig || {};
+            }
+            var rms = window.dash_clientside.rms;
+            var vars = spec.vars.filter(function(v) { return v in payload.columns; });
+            if (vars.length === 0) {
+                return old_fig || {};
+            }
+            var past = Object.keys(overlays || {}).map(function(k) { return overlays[k]; });
+            rms._prune(shown.concat(past));
+
+            var template = spec.template;
+            var idx = Math.min(time_idx, payload.length - 1);
+            var time = rms._entry(payload).time;
+            var traces, layout;
+
+            if (spec.chart_type === 'bar') {
+                traces = vars.map(function(v, i) {
+                    return Object.assign({}, template.data[i], {x: [v], y: [rms._column(payload, v)[idx]], name: spec.labels[v], legendgroup: v});
+                });
+                var yaxis = Object.assign({}, template.layout.yaxis, {title: {text: 'Value at ' + time[idx].toFixed(2)}});
+                layout = Object.assign({}, template.layout, {yaxis: yaxis});
+            } else {
+                var surrogate = Boolean(payload.meta && payload.meta.surrogate);
+                traces = vars.map(function(v, i) {
+                    var trace = Object.assign({}, template.data[i], {
+                        x: time.subarray(0, idx),
+                        y: rms._column(payload, v).subarray(0, idx),
+                        name: spec.labels[v] + (surrogate ? ' [surrogate]' : ''), legendgroup: v, showlegend: true
+                    });
+                    if (surrogate) {
+                        trace.line = {dash: 'dot'};
+                    }
+                    return trace;
+                });
+                past.forEach(function(p) {
+                    vars.forEach(function(v, i) {
+                        if (v in p.columns) {
+                            traces.push(Object.assign({}, template.data[i], {
+                                x: rms._entry(p).time,
+                                y: rms._column(p, v),
+                                name: spec.labels[v] + ' [' + p.meta.label + ']', legendgroup: v,
+                                line: {dash: 'dash'}, opacity: 0.6
+                            }));
+                        }
+                    });
+                });
+                layout = template.layout;
+            }
+            return {data: traces, layout: layout};
+        }
+    }
+});
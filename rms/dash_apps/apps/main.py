@@ -1,49 +1,264 @@
 import dash_bootstrap_components as dbc
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output, State, MATCH, ALL
+from dash.dependencies import Input, Output, State, MATCH, ALL, ClientsideFunction
 import dash_apps.shared_components as dsc
+from dash_apps.shared_transport import encode_frame
 from dash_apps.shared_styles import *
 from dash_apps.apps.myapp import app
 import dash
-from engine import Model, Simulator
+from engine import Model, Simulator, Vars, load_manifest, manifest_table, add_state_rows
+from history import RunHistory, input_values
+from surrogate import Surrogate
+from prefetch import ResultCache, Prefetcher
 import os
-import plotly.express as px
-import pandas as pd
+import json
+import time
+import atexit
+import plotly.graph_objects as go
 
 path = os.getcwd()
-# get all models in the models directory, skip penicilin
-model_names = [o for o in sorted(os.listdir(os.path.join('rms','models'))) if os.path.isdir(os.path.join('rms','models',o))]
-model_names.remove('penicillin_goldrick_2017')
+# get all valid models in the models directory from the cached manifest, without importing them
+manifest = load_manifest(os.path.join(path,'rms','models'))
+model_names = list(manifest.keys())
 model_path = lambda model_name: os.path.join(path,'rms','models', model_name) 
 
+# the simulator is only created once it is needed, see get_sim
+mysim = None
+data = None
+
+# figure layouts, built once per chart type and reused with new data
+figure_templates = {}
+
+# results are sent to the browser once per run, as base64 typed arrays shared by all the charts,
+# in float32 when the simulator variable "precision" is float32
+transfer_float32 = None
+runs = 0
+
+# the latest runs are stored, so past runs can be overlaid on the charts; set save_runs = False to store nothing
+save_runs = True
+history = RunHistory(os.path.join(path, 'runs'), max_runs = 200)
+
+# surrogates trained with rms/surrogate.py preview the results while a slider is dragged, loaded once per model
+surrogates = {}
+surrogate_file = lambda model_name: os.path.join(path, 'surrogates', model_name + '.pkl.gz')
+previews = 0
+# the error statistics of the surrogates are written at most every surrogate_save_every seconds, and at shutdown
+surrogate_save_every = 300
+surrogates_saved = {}
+surrogates_changed = set()
+
+# neighbours of the last run (one slider step up and down) are run in idle worker processes into a bounded cache
+results = ResultCache(max_entries = 64, max_bytes = 256*2**20)
+prefetch_workers = 2
+prefetcher = None
+
 # make a Dropdown Menu to select a models
 dropdown_models = lambda pick: [dbc.DropdownMenuItem(m, id = m, active = True) if i is pick else dbc.DropdownMenuItem(m, id = m,  active = False) for i,m in enumerate(model_names)]
 
-def sim(model_name):
+def select_model(model_name):
     """
-    Generates simulator object based on model name
+    Loads the variable tables of a model from the manifest. The model itself is not imported until needed.
 
     Arguments
     ---------
         model_name
     """
-    global mysim, mymvars, mycvars, mymparams, mysparams, data
-    mysim = Simulator(model = Model(model_path(model_name)))
-    mymvars = mysim.model.mvars.default
-    try:
-        mycvars = mysim.subroutines.subrvars.default
-    except Exception as e:
-        print(e)
-        mycvars = None
+    global selected_model, mysim, mymvars, mycvars, mymparams, mysparams, data, var_index, var_options, prefetcher, slider_steps
+    selected_model = model_name
+    mysim = None
+    data = None
+
+    tables = manifest[model_name]['vars']
+    mymvars = add_state_rows(manifest_table(tables['manipulated_vars.csv']))
+    mycvars = manifest_table(tables.get('controlled_vars.csv'))
+    mymparams = manifest_table(tables['parameters.csv'])
+    mysparams = Vars(os.path.join(path,'rms'), 'simulator_vars.csv').default
+
+    # labels and units of the plotted variables, looked up by the chart callbacks
+    var_index = make_var_index(mymvars, mycvars)
+    var_options = [{'label': meta['label'] + ' ('+var+')', 'value': var} for var, meta in var_index.items() if '0' not in var]
+
+    # step and bounds of every slider, to prefetch the neighbouring runs
+    slider_steps, bounds = {}, {}
+    for df in [mymvars[~mymvars.State], mycvars]:
+        for var in ([] if df is None else df.index):
+            try:
+                bounds[var] = slider_range(df, var)
+                slider_steps[var] = (bounds[var][1] - bounds[var][0])/100
+            except:
+                pass
+    if prefetcher is not None:
+        prefetcher.close()
+    prefetcher = Prefetcher(model_path(model_name), results, workers = prefetch_workers, bounds = bounds)
+    return
 
-    mymparams = mysim.model.params.default
-    mysparams = mysim.simvars.default
+def make_var_index(mvars, cvars):
+    """
+    Returns the label, units and group of every variable that can be plotted, in a dictionary
+
+    Arguments
+    ---------
+        mvars: Pandas DataFrame of manipulated variables, including the state rows
+        cvars: Pandas DataFrame of controlled variables, or None
+    """
+    index = {}
+    for group, df in [('Manipulated', mvars), ('Controlled', cvars)]:
+        if df is None:
+            continue
+        for var, row in df.iterrows():
+            index[var] = {
+                'label': str(row['Label']),
+                'units': '' if row.get('Units', False) is False else str(row['Units']),
+                'group': 'State' if 'State' in df.columns and bool(row['State']) else group,
+            }
+    return index
+
+def figure_template(chart_type, n_vars):
+    """
+    Returns the layout and trace styles of a chart, creating them on first use
+
+    Arguments
+    ---------
+        chart_type: "line" or "bar"
+        n_vars: number of plotted variables
+    """
+    key = (chart_type, n_vars)
+    if key not in figure_templates:
+        trace = go.Scatter(mode = 'lines') if chart_type == 'line' else go.Bar()
+        fig = go.Figure([trace]*n_vars)
+        fig.update_layout(legend_orientation='h', legend_title_text = 'Variable', xaxis_title = 'Time' if chart_type == 'line' else 'Variable', yaxis_title = 'Value')
+        figure_templates[key] = fig.to_dict()
+    return figure_templates[key]
+
+def get_sim():
+    """
+    Returns the simulator of the selected model, importing the model on first use
+    """
+    global mysim
+    if mysim is None:
+        tic = time.perf_counter()
+        mysim = Simulator(model = Model(model_path(selected_model)))
+        print('Loaded model {} in {:.2f} s'.format(selected_model, time.perf_counter() - tic))
+    return mysim
+
+def get_surrogate():
+    """
+    Returns the surrogate of the selected model, or None if none has been trained
+    """
+    if selected_model not in surrogates:
+        file = surrogate_file(selected_model)
+        surrogates[selected_model] = Surrogate.load(file) if os.path.isfile(file) else None
+        surrogates_saved[selected_model] = time.time()
+    return surrogates[selected_model]
+
+def sim():
+    """
+    Runs the simulator of the selected model with the current inputs
+    """
+    global data, mymvars, runs
+    mysim = get_sim()
+    mysim.reinitialize()
+    values = input_values(mysim)
+    key = prefetcher.key(values)
+    tic = time.perf_counter()
+    # prefetched runs are taken from the cache, or waited for if still running
+    data = prefetcher.result(key)
+    prefetched = data is not None
+    if not prefetched:
+        data = mysim.run(incremental = True)
+        results.put(key, data)
+    if save_runs:
+        history.save(mysim, data, wall_time_s = time.perf_counter() - tic, note = 'prefetched' if prefetched else '')
+    prefetcher.schedule(values)
+
+    # keeps track of the error of the surrogate against the exact runs it could have previewed
+    surrogate = get_surrogate()
+    if surrogate is not None and surrogate.applies_to(values):
+        surrogate.observe({v: x for t, v, x in values if v in surrogate.dists}, data)
+        surrogates_changed.add(selected_model)
+        if time.time() - surrogates_saved[selected_model] > surrogate_save_every:
+            save_surrogates([selected_model])
 
-    mysim.set_inputs()
-    data = mysim.run()
     mymvars = mysim.model.reset()
-    return 
+    runs += 1
+    return encode_frame(data, float32 = transfer_float32, run = runs, meta = {'stamp': time.time()})
+
+@atexit.register
+def save_surrogates(model_names = None):
+    """
+    Writes the surrogates whose error statistics changed since they were last written
+
+    Keyword Arguments
+    -----------------
+        model_names: list of models, defaults to all of them
+    """
+    for model_name in (list(surrogates_changed) if model_names is None else model_names):
+        if model_name in surrogates_changed:
+            surrogates[model_name].save(surrogate_file(model_name))
+            surrogates_changed.discard(model_name)
+            surrogates_saved[model_name] = time.time()
+
+def preview(dragged:dict):
+    """
+    Predicts the results of the selected model with the surrogate, with the dragged slider values
+    instead of the current inputs. Returns None if there is no surrogate for these inputs.
+
+    Arguments
+    ---------
+        dragged: dictionary of variable: value
+    """
+    global previews
+    surrogate = get_surrogate()
+    if surrogate is None:
+        return None
+    values = [(t, v, dragged.get(v, x) if t in ['mvars', 'subrvars'] else x) for t, v, x in input_values(get_sim())]
+    if not surrogate.applies_to(values):
+        return None
+    previews += 1
+    prediction = surrogate.predict({v: x for t, v, x in values if v in surrogate.dists})
+    return encode_frame(prediction, float32 = transfer_float32, run = 'preview-{}'.format(previews), meta = {'stamp': time.time(), 'surrogate': True})
+
+def apply_inputs(inputs):
+    """
+    Sets the values of the input boxes as the inputs of the simulator, in the order of the sliders.
+    The inputs are split with the same tables that made the sliders, see update_simulator.
+
+    Arguments
+    ---------
+        inputs: list of values
+    """
+    mysim = get_sim()
+    l1 = len(mymvars[~mymvars.State])
+    l2 = l1 + (0 if mycvars is None else len(mycvars))
+    l3 = l2 + len(mymparams)
+    l4 = l3 + len(mysparams)
+
+    mysim.model.mvars.from_input['Value'].iloc[:] = inputs[:l1]
+    if mysim.subroutines:
+        mysim.subroutines.subrvars.from_input['Value'].iloc[:] = inputs[l1:l2]
+    mysim.model.params.from_input['Value'].iloc[:] = inputs[l2:l3]
+    mysim.simvars.from_input['Value'].iloc[:] = inputs[l3:l4]
+
+def slider_range(vars_df, var):
+    """
+    Returns the minimum and maximum of the slider of a variable: its Min and Max, or 10% and 190% of its value
+
+    Arguments
+    ---------
+        vars_df: Pandas DataFrame containing variables
+        var: name of the variable
+    """
+    if vars_df.loc[var,'Min'] is not False:
+        minval = vars_df.loc[var,'Min']
+    else:
+        minval = vars_df.loc[var,'Value']*0.1
+
+    if vars_df.loc[var,'Max'] is not False:
+        maxval = vars_df.loc[var,'Max']
+    else:
+        maxval = vars_df.loc[var,'Value']*1.9
+    return minval, maxval
 
 def sliders_from_df(vars_df):
     """
@@ -57,15 +272,7 @@ def sliders_from_df(vars_df):
     if vars_df is not None:
         for i,var in enumerate(vars_df.index):
             try:
-                if vars_df.loc[var,'Min'] is not False:
-                    minval = vars_df.loc[var,'Min']
-                else:
-                    minval = vars_df.loc[var,'Value']*0.1
-
-                if vars_df.loc[var,'Max'] is not False:
-                    maxval = vars_df.loc[var,'Max']
-                else:
-                    maxval = vars_df.loc[var,'Value']*1.9
+                minval, maxval = slider_range(vars_df, var)
 
                 slider = dsc.NamedSlider(
                             name= vars_df.loc[var,'Label'],
@@ -95,11 +302,11 @@ def sliders_from_df(vars_df):
     return sliders
 
 # make a diagram, if any
-diagram = lambda simulator: dbc.Card(
+diagram = lambda model_name: dbc.Card(
     [
-        dbc.CardImg(src=simulator.model.diagram, top=True, alt = 'Oh snap! No diagram for this model!'),
+        dbc.CardImg(src=manifest[model_name]['diagram'], top=True, alt = 'Oh snap! No diagram for this model!'),
         dbc.CardBody(
-            html.P(simulator.model.doc, className="card-text")
+            html.P(manifest[model_name]['doc'], className="card-text")
         ),
     ],
 )
@@ -110,6 +317,15 @@ run_btn = dbc.Button(children = "Run Simulation", outline=True, size = "lg", col
 # make a button for plots
 plot_btn = dbc.Button(children = "Add Chart", outline=True, size = "lg", color="primary", className="mb-3", id="btn_plot", n_clicks = 0)
 
+# make a dropdown to overlay past runs of the selected model
+history_dropdown = dcc.Dropdown(id = 'history-runs', options = [], value = [], multi = True, placeholder = 'Overlay past runs...')
+
+# make a switch to run the simulation when a model is selected
+auto_run = dbc.Checklist(options = [{'label': 'Run on model switch', 'value': 'auto'}], value = [], switch = True, id = 'auto-run')
+
+# make a switch to preview the results with the surrogate while dragging a slider, and run the simulation on release
+surrogate_preview = dbc.Checklist(options = [{'label': 'Preview while dragging', 'value': 'preview'}], value = ['preview'], switch = True, id = 'surrogate-preview')
+
 # layout all the components to be displayed
 content = html.Div(
     [
@@ -127,6 +343,10 @@ content = html.Div(
                 ),
             )
         ]),
+        dbc.Row([
+            dbc.Col(auto_run, width = 6),
+            dbc.Col(surrogate_preview, width = 6),
+        ]),
         dbc.Row([
             dbc.Col(html.H1(children=''), width = 12),
         ]),
@@ -148,7 +368,12 @@ content = html.Div(
 
         dbc.Row(dbc.Col(run_btn)),
         dbc.Row(dbc.Col(plot_btn)),
+        dbc.Row(dbc.Col(history_dropdown, width = 6)),
         dbc.Row(id = 'container', children = []),
+        dcc.Store(id = 'run-data'),
+        dcc.Store(id = 'overlay-data'),
+        dcc.Store(id = 'preview-data'),
+        dcc.Store(id = 'inputs-applied'),
     ],
     id="page-content",
     style = CONTENT_STYLE
@@ -158,7 +383,6 @@ content = html.Div(
 layout = html.Div(
     [
         content,
-        html.Div(id='dummy-output4'),
         html.Div(id='dummy-output-models')
     ],
 )
@@ -181,14 +405,15 @@ def update_simulator(*args):
     except:
         new_pick = 0
 
-    sim(model_names[new_pick])
+    select_model(model_names[new_pick])
 
-    return dropdown_models(new_pick), sliders_from_df(mymvars[~mymvars.State]), *[sliders_from_df(p) for p in [mycvars, mymparams, mysparams]], [], diagram(mysim)
+    return dropdown_models(new_pick), sliders_from_df(mymvars[~mymvars.State]), *[sliders_from_df(p) for p in [mycvars, mymparams, mysparams]], [], diagram(model_names[new_pick])
 
 # callback to update the model variables with the sliders / input box
 @app.callback(
     [Output({'type': 'dynamic-var-input', 'index': ALL}, 'value'),
-    Output({'type': 'dynamic-var', 'index': ALL}, 'value')],
+    Output({'type': 'dynamic-var', 'index': ALL}, 'value'),
+    Output('inputs-applied', 'data')],
     [Input({'type': 'dynamic-var-input', 'index': ALL}, 'value'),
     Input({'type': 'dynamic-var', 'index': ALL}, 'value')]
 )
@@ -201,49 +426,91 @@ def update_mvars_slider(inputs,sliders):
             sliders = inputs[:len(sliders)]
         else:
             inputs[:len(sliders)] = sliders
+        apply_inputs(inputs)
 
-        l1 = len(mysim.model.mvars.from_input['Value']) # cheap but works
-        try:
-            l2 = len(mysim.subroutines.subrvars.from_input['Value'])+l1
-        except:
-            l2 = l1
-        l3 = len(mysim.model.params.from_input['Value'])+l2
-
-        mysim.model.mvars.from_input['Value'].iloc[:] = inputs[:l1]
-        try:
-            mysim.subroutines.subrvars.from_input['Value'].iloc[:] = inputs[l1:l2]
-        except:
-            pass
-        mysim.model.params.from_input['Value'].iloc[:] = inputs[l2:l3]
-        mysim.simvars.from_input['Value'].iloc[:] = inputs[l3:]
+        # the neighbours of the variables moved last are prefetched after the next run
+        var = json.loads(button_id)['index']
+        if var in slider_steps:
+            prefetcher.touch(var, slider_steps[var])
+        return inputs, sliders, {'slider': 'input' not in button_id, 'stamp': time.time()}
 
-    return inputs, sliders
+    return inputs, sliders, dash.no_update
 
-# callback to run the simulator and display data when the button is clicked
+# callback to preview the results with the surrogate while a slider is dragged
 @app.callback(
-    Output('dummy-output4','children'),
-    Input('btn_run', 'n_clicks'),
+    Output('preview-data', 'data'),
+    [Input({'type': 'dynamic-var', 'index': ALL}, 'drag_value')],
+    [State({'type': 'dynamic-var', 'index': ALL}, 'id'),
+    State('surrogate-preview', 'value')],
 )
-def run_simulation(n_clicks_run):
+def preview_simulation(drag_values, ids, switch):
+    if not switch:
+        return dash.no_update
+    payload = preview({i['index']: v for i, v in zip(ids, drag_values) if v is not None})
+    return dash.no_update if payload is None else payload
+
+# callback to run the simulator and send the results to the browser when the button is clicked,
+# when a model is selected with the auto-run switch on, or when a slider previewed by the surrogate is released
+@app.callback(
+    Output('run-data','data'),
+    [Input('btn_run', 'n_clicks'),
+    Input('dummy-output-models','children'),
+    Input('inputs-applied', 'data')],
+    [State('auto-run', 'value'),
+    State('surrogate-preview', 'value')],
+)
+def run_simulation(n_clicks_run, dummy_models, applied, auto, switch):
+    ctx = dash.callback_context
+    button_id = ctx.triggered[0]["prop_id"].split(".")[0]
+
+    if button_id == 'dummy-output-models':
+        return sim() if auto else None
+    if button_id == 'inputs-applied':
+        return sim() if switch and applied and applied['slider'] and get_surrogate() is not None else dash.no_update
     if n_clicks_run>0:
-        global data, mymvars
-        mysim.set_inputs()
-        data = mysim.run()
-        mymvars = mysim.model.reset()
+        return sim()
 
-    return
+    return dash.no_update
    
+# callback to list the past runs of the selected model, newest first
+@app.callback(
+    [Output('history-runs', 'options'),
+    Output('history-runs', 'value')],
+    [Input('run-data', 'data'),
+    Input('dummy-output-models','children')],
+    [State('history-runs', 'value')],
+)
+def list_history(run_data, dummy_models, selected):
+    ctx = dash.callback_context
+    button_id = ctx.triggered[0]["prop_id"].split(".")[0]
+
+    past = history.find(model = selected_model).tail(50).iloc[::-1]
+    options = [{'label': 'Run {} ({})'.format(i, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(row.created))), 'value': i} for i, row in past.iterrows()]
+    return options, [] if button_id == 'dummy-output-models' else selected
+
+# callback to load the selected past runs, only with the plotted variables
+@app.callback(
+    Output('overlay-data', 'data'),
+    [Input('history-runs', 'value'),
+    Input({'type': 'dynamic-spec', 'index': ALL}, 'data')],
+)
+def load_history(run_ids, specs):
+    variables = sorted({v for spec in specs if spec for v in spec['vars']})
+    if not run_ids or not variables:
+        return {}
+    overlays = history.load(run_ids, variables = variables)
+    return {str(i): encode_frame(df, float32 = transfer_float32, run = 'history-{}'.format(i), meta = {'label': 'run {}'.format(i)}) for i, df in overlays.items()}
+
 # Takes the n-clicks of the add-chart button and the state of the container children.
 @app.callback(
    Output('container','children'),
    [Input('btn_plot','n_clicks'),
-   Input('dummy-output4','children'),
    Input('dummy-output-models','children')],
    [State('btn_run','n_clicks'),
    State('container','children')]
 )
 #This function is triggered when the add-chart clicks changes. This function is not triggered by changes in the state of the container. If children changes, state saves the change in the callback.
-def display_graphs(n_clicks, dummy,dummy_models, n_run, div_children):
+def display_graphs(n_clicks, dummy_models, n_run, div_children):
     ctx = dash.callback_context
     button_id = ctx.triggered[0]["prop_id"].split(".")[0]
 
@@ -251,6 +518,8 @@ def display_graphs(n_clicks, dummy,dummy_models, n_run, div_children):
         div_children = []
 
     elif button_id == 'btn_plot' or (n_clicks == 0 and n_run == 0):
+        # the time slider spans the plotted results, or the time grid of the simulator before the first run
+        n_times = len(data) if data is not None else len(get_sim().time)
         new_child = dbc.Col(
             children=[
                 dbc.Row([
@@ -268,7 +537,7 @@ def display_graphs(n_clicks, dummy,dummy_models, n_run, div_children):
                         'type': 'dynamic-dpn-var1',
                         'index': n_clicks
                     },
-                    options=[{'label': pd.concat([mymvars,mycvars]).loc[var,'Label'] + ' ('+var+')', 'value': var} for var in data.columns[data.columns.map(lambda x: '0' not in x)]],
+                    options=var_options,
                     multi=True,
                     value = [],
                     placeholder='Select variables to plot...',
@@ -281,9 +550,9 @@ def display_graphs(n_clicks, dummy,dummy_models, n_run, div_children):
                         'index':n_clicks
                     },
                     min=1,
-                    max=len(mysim.time)-1,
+                    max=n_times-1,
                     step=1,
-                    value=len(mysim.time)-1,
+                    value=n_times-1,
                 )], width = 2),
                 ]),
                 dcc.Graph(
@@ -293,55 +562,34 @@ def display_graphs(n_clicks, dummy,dummy_models, n_run, div_children):
                     },
                     figure={}
                 ),
+                dcc.Store(id={'type':'dynamic-spec', 'index':n_clicks}),
             ],
         width = 4)
         div_children.append(new_child)
 
-    elif button_id == 'dummy-output4':
-        for c,child in enumerate(div_children):
-            try:
-                for l,line in enumerate(child['props']['children'][1]['props']['figure']['data']):
-                    old_data = div_children[c]['props']['children'][1]['props']['figure']['data'][l]['y']
-                    var = div_children[c]['props']['children'][1]['props']['figure']['data'][l]['legendgroup']
-                    div_children[c]['props']['children'][1]['props']['figure']['data'][l]['y'] = data[var].iloc[:len(old_data)].tolist()
-            except:
-                pass
-
     return div_children
 
-# callback to update the graphs with the selected variables and graph types
+# callback to describe the graphs with the selected variables and graph types, without any data
 @app.callback(
-    Output({'type': 'dynamic-graph', 'index': MATCH}, 'figure'),
+    Output({'type': 'dynamic-spec', 'index': MATCH}, 'data'),
     [Input(component_id={'type': 'dynamic-dpn-var1', 'index': MATCH}, component_property='value'),
-     Input(component_id={'type': 'dynamic-choice', 'index': MATCH}, component_property='value'),
-     Input(component_id={'type': 'dynamic-slider', 'index': MATCH}, component_property='value')],
-     State({'type': 'dynamic-graph', 'index': MATCH}, 'figure')
+     Input(component_id={'type': 'dynamic-choice', 'index': MATCH}, component_property='value')],
 )
-def new_graph(var, chart_type, time_idx, old_fig):
-    ctx = dash.callback_context
-    global data
-    data = data.astype(float)
-    if ctx.triggered[0]["prop_id"] != '.':
+def new_graph(var, chart_type):
+    labels = {v: var_index[v]['label'] + (' (' + var_index[v]['units'] + ')' if var_index[v]['units'] else '') for v in var}
+    return {'vars': var, 'labels': labels, 'chart_type': chart_type, 'template': figure_template(chart_type, len(var))}
 
-        if len(var) == 0:
-            fig = old_fig
-        else:
-            if chart_type == 'bar':
-                fig = px.bar(x = var, y= data[var].iloc[time_idx], color=var, labels = {'y':'Value at {:.2f}'.format(data.index[time_idx]), 'x':'Variable', 'color':'Variable'})
-            elif chart_type == 'line':
-                fig = px.line(data.iloc[:time_idx] , x = data.iloc[:time_idx].index, y = var, labels = {'x':'Time','value':'Value', 'variable':'Variable'})
-            fig.update_layout(legend_orientation='h')                
-            # change labels
-            labels = {v: pd.concat([mymvars,mycvars]).loc[v,'Label'] + ' (' + pd.concat([mymvars,mycvars]).loc[v,'Units'] +')' for v in var}
-            for i, dat in enumerate(fig.data):
-                for elem in dat:
-                    if elem == 'name':
-                        fig.data[i].name = labels[fig.data[i].name]
-
-        return fig
-
-    else:
-        return old_fig
+# clientside callback to fill the graphs with the results in the browser, see assets/transport.js
+app.clientside_callback(
+    ClientsideFunction(namespace = 'rms', function_name = 'figure'),
+    Output({'type': 'dynamic-graph', 'index': MATCH}, 'figure'),
+    [Input({'type': 'dynamic-spec', 'index': MATCH}, 'data'),
+     Input({'type': 'dynamic-slider', 'index': MATCH}, 'value'),
+     Input('run-data', 'data'),
+     Input('overlay-data', 'data'),
+     Input('preview-data', 'data')],
+    State({'type': 'dynamic-graph', 'index': MATCH}, 'figure')
+)
 
 # callback to collapse the different slider menus
 @app.callback(
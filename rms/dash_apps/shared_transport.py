@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import base64
+
+def _to_base64(values, dtype):
+    """
+    Encodes an array as base64 of its little-endian bytes
+    """
+    return base64.b64encode(np.ascontiguousarray(values, dtype = np.dtype(dtype).newbyteorder('<')).tobytes()).decode('ascii')
+
+def _from_base64(text, dtype):
+    """
+    Decodes an array encoded with `_to_base64`
+    """
+    return np.frombuffer(base64.b64decode(text), dtype = np.dtype(dtype).newbyteorder('<'))
+
+def encode_frame(df: pd.DataFrame, float32 = None, run = 0, meta = None):
+    """
+    Encodes a result indexed by time for the browser, with every column as a base64 typed array.
+    The payload is sent once per run to a dcc.Store and decoded by the clientside callbacks of the charts,
+    see assets/transport.js. Time is always sent in float64.
+
+    Arguments
+    ---------
+        df : pd.DataFrame
+            Numeric table indexed by time
+
+    Keyword Arguments
+    -----------------
+        float32 : boolean
+            Send the values in float32, halving the payload. Defaults to None, which sends float32
+            when the values are already stored in float32 (flags aside).
+        run : int
+            Identifies the run, so the browser decodes every column only once. Defaults to 0.
+        meta : dict
+            Any other information for the charts, e.g. labels. Defaults to None.
+    """
+    if float32 is None:
+        float32 = any(t == np.float32 for t in df.dtypes) and all(t in [np.float32, np.bool_] for t in df.dtypes)
+    dtype = 'float32' if float32 else 'float64'
+    return {
+        'run': run,
+        'length': len(df),
+        'dtype': dtype,
+        'time': _to_base64(df.index.values, 'float64'),
+        'columns': {str(c): _to_base64(df[c].values, dtype) for c in df.columns},
+        'meta': meta or {},
+    }
+
+def decode_frame(payload: dict):
+    """
+    Decodes a payload made by `encode_frame` back into a DataFrame
+
+    Arguments
+    ---------
+        payload : dict
+    """
+    time = _from_base64(payload['time'], 'float64')
+    return pd.DataFrame({c: _from_base64(v, payload['dtype']) for c, v in payload['columns'].items()}, index = time)
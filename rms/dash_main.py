@@ -1,3 +1,6 @@
+import time
+tic = time.perf_counter()
+
 from dash_apps.apps.myapp import app
 
 import dash_core_components as dcc
@@ -35,5 +38,13 @@ def display_page(pathname):
         ]
     )
 
+# cold start time, from the first import to the app being ready to serve
+startup = {'cold_start_s': time.perf_counter() - tic, 'models': main.model_names}
+print('RMS cold start: {:.2f} s'.format(startup['cold_start_s']))
+
+@app.server.route('/startup')
+def report_startup():
+    return startup
+
 if __name__ == '__main__':
     app.run_server(debug = True)
@@ -6,7 +6,15 @@ import os
 import errno
 import importlib.util
 import inspect
-from scipy.integrate import odeint
+import ast
+import json
+import glob
+import gzip
+import pickle
+import copy
+import tempfile
+from scipy.integrate import odeint, solve_ivp, ODEintWarning
+import warnings
 
 class ModelDefinitionError(Exception):
     """Raised when there is a problem loading the model"""
@@ -16,12 +24,168 @@ class SubroutineError(Exception):
     """Raised when there is a problem running a subroutine"""
     pass
 
+def read_timeseries(path):
+    """
+    Reads a time series table from a CSV or Parquet file.
+    The column "Time" (or the first column, if there is none) is used as index.
+
+    Arguments
+    ---------
+        path :
+            Path to a .csv or .parquet file
+
+    Raises
+    ------
+        FileNotFoundError
+            If the file does not exist.
+        ValueError
+            If the file extension is not supported.
+    """
+    if not os.path.isfile(path):
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.csv':
+        df = pd.read_csv(path)
+    elif ext in ['.parquet', '.pq']:
+        df = pd.read_parquet(path)
+    else:
+        raise ValueError('Unsupported file type "{}". Please use a .csv or .parquet file.'.format(ext))
+
+    time = 'Time' if 'Time' in df.columns else df.columns[0]
+    return df.set_index(time).rename_axis('Time').sort_index().astype(float)
+
+def write_timeseries(df: pd.DataFrame, path):
+    """
+    Writes a time series table, e.g. a simulation result, to a CSV or Parquet file.
+    The index is written as the column "Time". Float columns keep their precision, see `result_dtype`,
+    and the other columns, e.g. flags, are written as floats of the same precision.
+
+    Arguments
+    ---------
+        df : pd.DataFrame
+            Table indexed by time
+        path :
+            Path to a .csv or .parquet file
+
+    Raises
+    ------
+        ValueError
+            If the file extension is not supported.
+    """
+    floats = df.select_dtypes('floating').dtypes
+    dtype = np.result_type(*floats) if len(floats) else np.float64
+    df = df.astype({k: dtype for k, v in df.dtypes.items() if not np.issubdtype(v, np.floating)}).rename_axis('Time').reset_index()
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.csv':
+        df.to_csv(path, index = False)
+    elif ext in ['.parquet', '.pq']:
+        df.to_parquet(path, index = False)
+    else:
+        raise ValueError('Unsupported file type "{}". Please use a .csv or .parquet file.'.format(ext))
+
+class Profile():
+    """
+    Time-varying input read once from a table of breakpoints, e.g. a recorded plant profile.
+    Interpolated with zero-order hold ("zoh") or linearly ("linear"), and callable with a single time
+    or an array of times, like any other time-dependent variable.
+
+    In a variables file, set the Value of a variable to "profile:<file>" or "profile:<file>:linear",
+    where <file> is a .csv or .parquet file in the model directory with a "Time" column and one value column.
+    """
+    def __init__(self, path, kind = 'zoh', column = None):
+        """
+        Arguments
+        ---------
+            path :
+                Path to a .csv or .parquet file, see `read_timeseries`
+
+        Keyword Arguments
+        -----------------
+            kind : str
+                "zoh" for zero-order hold or "linear". Defaults to "zoh".
+            column : str
+                Column with the values. Defaults to the first one.
+
+        Raises
+        ------
+            ValueError
+                If the interpolation kind is not recognized.
+        """
+        if kind not in ['zoh', 'linear']:
+            raise ValueError('Interpolation not recognized. Please use "zoh" or "linear".')
+        df = read_timeseries(path)
+        self.path = path
+        self.kind = kind
+        self.time = df.index.values.astype(float)
+        self.values = df[column or df.columns[0]].values.astype(float)
+
+    @classmethod
+    def from_spec(cls, spec:str, path):
+        """
+        Creates a Profile from a "profile:<file>[:<kind>]" value, relative to path
+        """
+        _, file, *kind = spec.split(':')
+        return cls(os.path.join(path, file), *kind)
+
+    def __call__(self, t):
+        if self.kind == 'linear':
+            return np.interp(t, self.time, self.values)
+        i = np.clip(np.searchsorted(self.time, t, side = 'right') - 1, 0, len(self.time) - 1)
+        return self.values[i]
+
+    def __repr__(self):
+        return 'profile:{}:{}'.format(os.path.basename(self.path), self.kind)
+
+    def first_difference(self, other):
+        """
+        Returns the first time from which two profiles differ, -inf if they differ from the start,
+        or None if they are the same. Between their table times, both are constant ("zoh") or linear ("linear"),
+        so comparing them at the table times is enough.
+
+        Arguments
+        ---------
+            other : Profile
+        """
+        if self.kind != other.kind:
+            return -np.inf
+        times = np.union1d(self.time, other.time)
+        differ = np.flatnonzero(self(times) != other(times))
+        if not len(differ):
+            return None
+        first = differ[0]
+        # before the first table time both hold their first value; a linear profile departs from the previous time
+        if first == 0:
+            return -np.inf
+        return times[first] if self.kind == 'zoh' else times[first - 1]
+
+    @property
+    def breakpoints(self):
+        """
+        Times where the profile is not smooth: jumps for "zoh", changes of slope for "linear"
+        """
+        if self.kind == 'zoh':
+            return self.time[1:][np.diff(self.values) != 0]
+        slope = np.diff(self.values)/np.diff(self.time)
+        return self.time[1:-1][np.diff(slope) != 0]
+
+def _same_value(a, b):
+    """
+    Compares two variable values, which may be functions
+    """
+    try:
+        return bool(a == b)
+    except Exception:
+        return a is b
+
 class Vars():
     """
     Manages sets of variables in a Pandas DataFrame.
     Receives model info and listens for changes in Dash.
     Keeps track of both defualt and current variable values.
     """
+    REQUIRED = ['parameters.csv','manipulated_vars.csv','simulator_vars.csv', 'controlled_vars.csv']
+
     def __init__(self, path, var_file):
         """
         Arguments
@@ -36,18 +200,64 @@ class Vars():
         self.default = self.read_vars()
         self.from_input = self.default.copy(True) 
         self.current = self.default.copy(True)
-        self.REQUIRED = ['parameters.csv','manipulated_vars.csv','simulator_vars.csv', 'controlled_vars.csv']
+
+    @property
+    def current(self):
+        """
+        Table with the current values. Replacing it marks all the variables as changed.
+        """
+        return self._current
+
+    @current.setter
+    def current(self, df:pd.DataFrame):
+        self._current = df
+        self.mark_changed()
+
+    @property
+    def changed(self):
+        """
+        Names of the variables whose current value changed since the last `clear_changed`
+        """
+        return self._changed
+
+    def clear_changed(self):
+        """
+        Forgets the changes made so far, see `changed`
+        """
+        self._changed = set()
+
+    def mark_changed(self):
+        """
+        Marks all the variables as changed, see `changed`
+        """
+        self._changed = set(self._current.index) if self._current is not None else set()
+
+    def copy(self):
+        """
+        Returns a copy with its own default, input and current tables
+        """
+        new = copy.copy(self)
+        new.default = self.default.copy(True)
+        new.from_input = self.from_input.copy(True)
+        new.current = self.current.copy(True)
+        return new
 
     def _update(self, pd:pd.DataFrame):
         """
-        Updates current variable values with values from passed DataFrame, based on index
+        Updates current variable values with values from passed DataFrame, based on index.
+        Only the values that differ are written, and marked as changed.
 
         Arguments
         ---------
             pd: pd.DataFrame
-                DataFrame with which to update vales
+                DataFrame with which to update vales. A Series or a dictionary of values also work.
         """
-        self.current.update(pd)
+        new = pd['Value'] if hasattr(pd, 'columns') else pd
+        current = self.current.Value
+        changed = [k for k, v in new.items() if k in current.index and not _same_value(current[k], v) and not (isinstance(v, float) and np.isnan(v))]
+        for k in changed:
+            self.current.at[k,'Value'] = new[k]
+        self._changed.update(changed)
 
     def read_vars(self):
         """
@@ -60,12 +270,21 @@ class Vars():
                 If there is no file with that name in the specified directory.
         """
         try:
-            return pd.read_csv(os.path.join(self.path, self.var_file)).set_index('Var').fillna(False).sort_index()
+            df = pd.read_csv(os.path.join(self.path, self.var_file)).set_index('Var').fillna(False).sort_index()
         except:
             if self.var_file in self.REQUIRED:
                 raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), os.path.join(self.path, self.var_file))
             else:
                 return None
+        # values like "profile:feed.csv" are loaded as time-varying profiles
+        df['Value'] = df.Value.map(lambda v: Profile.from_spec(v, self.path) if isinstance(v, str) and v.startswith('profile:') else v)
+        return df
+
+    def get_profiles(self):
+        """
+        Returns the variables driven by a Profile, in a dictionary
+        """
+        return {k: v for k, v in self.default.Value.items() if isinstance(v, Profile)}
 
     def _eval_time(self, t:float):
         """
@@ -75,10 +294,12 @@ class Vars():
         ---------
             t:flaot
         """
-        funs = self.default.Value.apply(callable)
-        if funs.any():
-            for i in self.default[funs].index:
-                self.current.loc[i,'Value'] = self.default.loc[i,'Value'](t)
+        for i, fun in self.default.Value.items():
+            if callable(fun):
+                value = fun(t)
+                if not _same_value(self.current.loc[i,'Value'], value):
+                    self.current.loc[i,'Value'] = value
+                    self._changed.add(i)
 
     def get_all_vars_dict(self, t=0):
         """
@@ -92,6 +313,114 @@ class Vars():
         self._eval_time(t)
         return {**self.current.Value}
 
+def add_state_rows(mvars: pd.DataFrame):
+    """
+    Returns a copy of a manipulated variables table with one extra row per state, used to track its current value.
+    State rows are named after the initial condition without the trailing '0'.
+
+    Arguments
+    ---------
+        mvars : pd.DataFrame
+            Table as read from manipulated_vars.csv
+    """
+    mvars = mvars.copy(True)
+    state = mvars[mvars.State].copy(True)
+    mvars.State = False
+    state.index = state.index.map(lambda x: str(x)[:-1])
+    state.Label = state.Label.map(lambda x: str(x)[8:])
+    return mvars.append(state)
+
+def _model_doc(model_file):
+    """
+    Reads the docstring of MyModel.rhs without importing the model. Returns None if MyModel.rhs is not defined.
+    """
+    with open(model_file) as f:
+        tree = ast.parse(f.read())
+    for node in tree.body:
+        if isinstance(node, ast.ClassDef) and node.name == 'MyModel':
+            for item in node.body:
+                if isinstance(item, ast.FunctionDef) and item.name == 'rhs':
+                    return ast.get_docstring(item, clean = False) or ''
+    return None
+
+def load_manifest(models_dir, cache = '.manifest.json'):
+    """
+    Describes every valid model in a directory without importing it: documentation, diagram and variable tables.
+    The manifest is cached in a json file inside the directory, keyed by the absolute path of the directory,
+    and only rebuilt for models whose files changed. Paths are rebuilt from models_dir, so they do not depend on
+    the working directory of the process that wrote the cache.
+    Directories without parameters.csv, manipulated_vars.csv or a MyModel.rhs definition are skipped.
+
+    Arguments
+    ---------
+        models_dir :
+            Directory with one subdirectory per model
+
+    Keyword Arguments
+    -----------------
+        cache : str
+            Name of the cache file. Defaults to ".manifest.json".
+
+    Returns
+    -------
+        dict of model name -> {'path', 'doc', 'diagram', 'vars'}, where 'vars' maps each csv file to its records
+        and the paths are absolute. Use `manifest_table` to turn the records back into a DataFrame.
+    """
+    models_dir = os.path.abspath(models_dir)
+    cache_path = os.path.join(models_dir, cache)
+    try:
+        with open(cache_path) as f:
+            cached = json.load(f)
+        cached = cached['models'] if cached.get('models_dir') == models_dir else {}
+    except (OSError, ValueError, AttributeError, KeyError):
+        cached = {}
+
+    manifest, changed = {}, False
+    for name in sorted(os.listdir(models_dir)):
+        path = os.path.join(models_dir, name)
+        if not os.path.isdir(path):
+            continue
+        signature = sorted([f, os.path.getmtime(os.path.join(path, f))] for f in os.listdir(path) if not f.startswith(('.', '__')))
+        if name in cached and cached[name]['signature'] == signature:
+            entry = cached[name]
+        else:
+            changed = True
+            entry = {'signature': signature, 'valid': False}
+            try:
+                doc = _model_doc(os.path.join(path, 'model.py'))
+                tables = {f: Vars(path, f).default for f in ['parameters.csv', 'manipulated_vars.csv', 'controlled_vars.csv'] if os.path.isfile(os.path.join(path, f))}
+                if doc is not None and 'parameters.csv' in tables and 'manipulated_vars.csv' in tables:
+                    entry.update({
+                        'valid': True,
+                        'doc': doc,
+                        'diagram': os.path.isfile(os.path.join(path,'diagram.png')),
+                        'vars': {f: json.loads(df.reset_index().to_json(orient = 'records', default_handler = str)) for f, df in tables.items()},
+                    })
+            except Exception:
+                pass
+        manifest[name] = entry
+
+    if changed or set(cached) != set(manifest):
+        try:
+            with open(cache_path, 'w') as f:
+                json.dump({'models_dir': models_dir, 'models': manifest}, f)
+        except OSError:
+            pass
+
+    return {name: {**entry,
+                   'path': os.path.join(models_dir, name),
+                   'diagram': os.path.join(models_dir, name, 'diagram.png') if entry['diagram'] else None}
+            for name, entry in manifest.items() if entry['valid']}
+
+def manifest_table(records):
+    """
+    Converts the records of a variable table in the manifest back to a DataFrame indexed by "Var".
+    Returns None if there are no records.
+    """
+    if records is None:
+        return None
+    return pd.DataFrame(records).set_index('Var')
+
 class Model():
     """
     Keeps track of all model related info at a high level
@@ -106,6 +435,7 @@ class Model():
                 Path poiting to a specific model directory.
         """
         self.path = model_path
+        self._module = None
         self.model_class = self.get_model()
         self.params = Vars(self.path, 'parameters.csv')
         self.mvars = Vars(self.path, 'manipulated_vars.csv')
@@ -127,31 +457,39 @@ class Model():
         """
         # back to default
         #current = self.mvars.current['Value'].copy(True)
-        self.mvars.current = self.mvars.default.copy(True)
         # add rows to keep track of state
-        self.state = self.mvars.current[self.mvars.current.State].copy(True)
-        self.mvars.current.State = False
-        self.state.index = self.state.index.map(lambda x: str(x)[:-1])
-        self.state.Label = self.state.Label.map(lambda x: str(x)[8:])
-        self.mvars.current = self.mvars.current.append(self.state)
+        self.mvars.current = add_state_rows(self.mvars.default)
         self.state = self.get_state_dict()
         #if hard is False: self.mvars._update(current)
         return self.mvars.current
 
+    def copy(self):
+        """
+        Returns a copy of the model with its own variable tables, sharing the imported model class
+        """
+        new = copy.copy(self)
+        new.params = self.params.copy()
+        new.mvars = self.mvars.copy()
+        new.state = dict(self.state)
+        return new
+
     def __import_module(self):
         """
-        Dynamic import of modules.
+        Dynamic import of modules. The module is only executed once per Model.
         Raises
         ------
             FileNotFoundError
                 If there is no model.py file
         """
+        if self._module is not None:
+            return self._module
         try:
             spec = importlib.util.spec_from_file_location('model', os.path.join(self.path, 'model.py'))
         except:
             raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), os.path.join(self.path, 'model.py'))
         model = importlib.util.module_from_spec(spec)
         spec.loader.exec_module(model)
+        self._module = model
         return model
 
     def get_model(self):
@@ -202,6 +540,27 @@ class Model():
         self.mvars._eval_time(t)
         return {**self.params.get_all_vars_dict(t), **self.mvars.current[~self.mvars.current.State].Value}
 
+    def get_changed_vars_dict(self, t = 0.):
+        """
+        Returns the variables, excluding the state, whose value changed since the last call, in a dictionary
+
+        Keyword Arguments
+        -----------------
+            t:flaot
+                Current time, provided by Simulator. Degaults to 0.
+        """
+        self.params._eval_time(t)
+        self.mvars._eval_time(t)
+        values = {}
+        for table in [self.params, self.mvars]:
+            current = table.current
+            changed = [k for k in table.changed if k in current.index]
+            if 'State' in current.columns:
+                changed = [k for k in changed if not current.loc[k,'State']]
+            values.update(current.loc[changed,'Value'])
+            table.clear_changed()
+        return values
+
     def get_all_vars_dict(self, t = 0.):
         """
         Returns all the current variables, including the state, in a dictionary
@@ -240,22 +599,423 @@ class Model():
             also_IC:boolean
                 Flag used to also update the initial conditions. Degaults to False.
         """
-        def _update(new_mvars_dict):
-            new_mvars_df = pd.DataFrame.from_dict(new_mvars_dict, orient = 'index', columns = ['Value'])
-            new_mvars_df.index.name = 'Var'
-            self.mvars._update(new_mvars_df)
-
-        _update(new_mvars_dict)
+        self.mvars._update(new_mvars_dict)
         if also_IC:
-            new_mvars_dict = {key+'0': value for key, value in new_mvars_dict.items()}
-            _update(new_mvars_dict)
+            self.mvars._update({key+'0': value for key, value in new_mvars_dict.items()})
+
+def _defines(model_class, name):
+    """
+    Whether a model class implements a method, rather than inheriting it from pyfoomb
+    """
+    return any(name in vars(c) for c in model_class.__mro__ if c is not object and not c.__module__.startswith('pyfoomb'))
+
+def result_dtype(simvars: Vars):
+    """
+    Storage type of the results, from the simulator variable "precision": float64 (default) or float32,
+    which halves the memory and transfer size of the trajectories
+
+    Arguments
+    ---------
+        simvars : Vars
+            Simulator variables
+
+    Raises
+    ------
+        ValueError
+            If the precision is not float64 or float32.
+    """
+    precision = simvars.current.loc['precision','Value'] if 'precision' in simvars.current.index else False
+    precision = str(precision or 'float64').strip()
+    if precision not in ['float64', 'float32']:
+        raise ValueError('The result precision must be float64 or float32, not {}'.format(precision))
+    return np.dtype(precision)
+
+def make_bioprocess_model(model_class, model_parameters: dict):
+    """
+    Creates a light instance of a model class holding the given parameter values,
+    without the checks done by pyfoomb. Useful to evaluate rhs outside of the Caretaker.
+
+    Arguments
+    ---------
+        model_class : Subclass of BioprocessModel
+            Model class, as in `Model.model_class`
+        model_parameters : dict
+            Values available to rhs through `self.model_parameters`
+    """
+    bioprocess_model = model_class.__new__(model_class)
+    bioprocess_model.model_parameters = dict(model_parameters)
+    return bioprocess_model
+
+def rhs_batch(bioprocess_model, t, Y):
+    """
+    Evaluates the model right-hand side for several state vectors in one call.
+    Relies on the rhs being written with NumPy operations, as in the provided models.
+
+    Arguments
+    ---------
+        bioprocess_model : BioprocessModel
+            Model instance holding the parameter values
+        t : float
+            Current time
+        Y : np.ndarray
+            State vectors as columns, with shape (states, k)
+
+    Returns
+    -------
+        np.ndarray with shape (states, k)
+    """
+    Y = np.asarray(Y, dtype = float)
+    out = np.empty_like(Y)
+    for i, derivative in enumerate(bioprocess_model.rhs(t, Y)):
+        out[i] = derivative
+    return out
+
+def rhs_jacobian(bioprocess_model, t, y, rel_h = 1e-6):
+    """
+    Jacobian of the model right-hand side with respect to the states.
+    Uses the method `jacobian(t, y)` when the model defines it, otherwise central finite differences.
+
+    Arguments
+    ---------
+        bioprocess_model : BioprocessModel
+            Model instance holding the parameter values
+        t : float
+            Current time
+        y : array-like
+            Current state vector
+
+    Keyword Arguments
+    -----------------
+        rel_h : float
+            Relative finite difference step. Defaults to 1e-6.
+    """
+    if hasattr(bioprocess_model, 'jacobian'):
+        return np.asarray(bioprocess_model.jacobian(t, y), dtype = float)
+
+    y = np.asarray(y, dtype = float)
+    h = rel_h*np.maximum(np.abs(y), 1.)
+    dY = np.diag(h)
+    try:
+        f = rhs_batch(bioprocess_model, t, np.hstack([y[:,None] + dY, y[:,None] - dY]))
+        return (f[:,:len(y)] - f[:,len(y):])/(2*h)
+    except (TypeError, ValueError):
+        # rhs does not vectorize, one column at a time
+        return np.array([
+            (np.asarray(bioprocess_model.rhs(t, y + dy), dtype = float) - np.asarray(bioprocess_model.rhs(t, y - dy), dtype = float))/(2*hi)
+            for dy, hi in zip(dY, h)]).T
+
+def rhs_jacobian_batch(bioprocess_model, t, Y, rel_h = 1e-6):
+    """
+    Jacobians of the model right-hand side at several state vectors in one call, see `rhs_jacobian` and `rhs_batch`.
+    Parameters may be scalars or arrays with one value per state vector.
+
+    Arguments
+    ---------
+        bioprocess_model : BioprocessModel
+            Model instance holding the parameter values
+        t : float
+            Current time
+        Y : np.ndarray
+            State vectors as columns, with shape (states, k)
+
+    Keyword Arguments
+    -----------------
+        rel_h : float
+            Relative finite difference step. Defaults to 1e-6.
+
+    Returns
+    -------
+        np.ndarray with shape (k, states, states)
+    """
+    Y = np.asarray(Y, dtype = float)
+    n, k = Y.shape
+    if hasattr(bioprocess_model, 'jacobian'):
+        J = bioprocess_model.jacobian(t, Y)
+        J = np.array([np.broadcast_to(np.asarray(e, dtype = float), (k,)) for row in J for e in row])
+        return J.reshape(n, n, k).transpose(2, 0, 1)
+
+    # one state perturbed in all the vectors at once
+    h = rel_h*np.maximum(np.abs(Y), 1.)
+    perturbed = np.repeat(Y[None], 2*n, axis = 0)
+    for s in range(n):
+        perturbed[s, s] += h[s]
+        perturbed[n+s, s] -= h[s]
+    tiled = make_bioprocess_model(type(bioprocess_model), {p: np.tile(v, 2*n) if np.ndim(v) else v for p, v in bioprocess_model.model_parameters.items()})
+    f = rhs_batch(tiled, t, np.hstack(list(perturbed))).reshape(n, 2*n, k)
+    return ((f[:,:n] - f[:,n:])/(2*h[None])).transpose(2, 0, 1)
+
+def parameter_jacobian(bioprocess_model, t, y, parameters, rel_h = 1e-6):
+    """
+    Jacobian of the model right-hand side with respect to some of its parameters, by central finite differences.
+
+    Arguments
+    ---------
+        bioprocess_model : BioprocessModel
+            Model instance holding the parameter values
+        t : float
+            Current time
+        y : array-like
+            Current state vector
+        parameters : list
+            Names of the parameters to differentiate against
+
+    Keyword Arguments
+    -----------------
+        rel_h : float
+            Relative finite difference step. Defaults to 1e-6.
+    """
+    y = np.asarray(y, dtype = float)
+    values = bioprocess_model.model_parameters
+    jac = np.empty((len(y), len(parameters)))
+    for j, p in enumerate(parameters):
+        p0 = values[p]
+        h = rel_h*max(abs(p0), 1.)
+        try:
+            values[p] = p0 + h
+            fp = np.asarray(bioprocess_model.rhs(t, y), dtype = float)
+            values[p] = p0 - h
+            fm = np.asarray(bioprocess_model.rhs(t, y), dtype = float)
+        finally:
+            values[p] = p0
+        jac[:,j] = (fp - fm)/(2*h)
+    return jac
+
+class Recorder():
+    """
+    Logs the variables of a run following a recording policy: which variables to keep, every how many steps,
+    whether values that do not change are stored once, and how much memory to use before spilling to disk.
+    Rows are kept in chunks of `chunk_size` steps. Once the chunks in memory exceed `memory_budget`,
+    the oldest ones are written to `spill_dir`, so the peak memory does not depend on the length of the run.
+    Values are stored with a single numeric type, float64 or float32, and time always in float64.
+    Variables that are booleans at every logged step (flags) are returned as bool columns.
+    """
+    def __init__(self, variables = None, decimation = 1, constants_once = False, memory_budget = None, spill_dir = None, chunk_size = 512,
+                 dtype = np.float64):
+        """
+        Keyword Arguments
+        -----------------
+            variables : list
+                Variables to log. Defaults to None, which logs all of them.
+            decimation : int
+                Log one every `decimation` steps. Defaults to 1.
+            constants_once : boolean
+                Store the variables that do not change within a chunk only once. Defaults to False.
+            memory_budget : int
+                Bytes of logged data kept in memory before spilling chunks to disk. Defaults to None, no limit.
+            spill_dir : str
+                Directory for the spilled chunks. Defaults to None, which uses a temporary directory.
+            chunk_size : int
+                Number of logged rows per chunk. Defaults to 512.
+            dtype :
+                Storage type of the values, np.float64 or np.float32. Defaults to np.float64.
+
+        Raises
+        ------
+            ValueError
+                If dtype is not float64 or float32.
+        """
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in [np.float64, np.float32]:
+            raise ValueError('Results are stored in float64 or float32, not {}'.format(self.dtype))
+        self.variables = variables
+        self.decimation = max(int(decimation), 1)
+        self.constants_once = constants_once
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        self.chunk_size = chunk_size
+        self.columns = None
+        self._flags = None
+        self._chunks = []
+        self._buffer = []
+        self._tempdir = None
+
+    def _start(self, columns):
+        """
+        Sets the logged columns, out of all the available ones
+        """
+        columns = list(columns)
+        if self.variables is not None:
+            missing = [v for v in self.variables if v not in columns]
+            if missing:
+                raise KeyError('Cannot record unknown variables {}'.format(missing))
+            columns = [c for c in columns if c in self.variables]
+        self.columns = columns
+        self._flags = np.ones(len(columns), dtype = bool)
+
+    def append(self, i:int, t:float, row:dict):
+        """
+        Logs the values of time step i, if due
+
+        Arguments
+        ---------
+            i : int
+                Index of the time step
+            t : float
+                Time
+            row : dict
+                Values of all the variables
+        """
+        if i % self.decimation:
+            return
+        self._buffer.append((i, t, [row[c] for c in self.columns]))
+        if len(self._buffer) >= self.chunk_size:
+            self._flush()
+
+    def _flush(self):
+        """
+        Moves the buffered rows into a new chunk
+        """
+        if not self._buffer:
+            return
+        steps, time, values = zip(*self._buffer)
+        self._buffer = []
+        # a flag stays one while it is a boolean at every logged step
+        self._flags &= [all(isinstance(row[j], (bool, np.bool_)) for row in values) for j in range(len(self.columns))]
+        values = np.array(values, dtype = self.dtype)
+        chunk = {'steps': np.array(steps), 'time': np.array(time, dtype = float)}
+        if self.constants_once:
+            constant = np.all(values == values[:1], axis = 0)
+            chunk.update({'constant': constant, 'constants': values[0, constant], 'values': values[:, ~constant]})
+        else:
+            chunk['values'] = values
+        self._chunks.append(chunk)
+        self._spill()
+
+    def _spill(self):
+        """
+        Writes the oldest chunks in memory to disk while over the memory budget
+        """
+        if self.memory_budget is None:
+            return
+        if self.spill_dir is None:
+            self.spill_dir = self._tempdir = tempfile.mkdtemp(prefix = 'rms_recorder_')
+        os.makedirs(self.spill_dir, exist_ok = True)
+        for n, chunk in enumerate(self._chunks):
+            if self.nbytes <= self.memory_budget:
+                break
+            if isinstance(chunk, dict):
+                path = os.path.join(self.spill_dir, 'chunk_{:06d}_{:06d}.npz'.format(chunk['steps'][0], chunk['steps'][-1]))
+                np.savez(path, **chunk)
+                self._chunks[n] = path
+
+    @property
+    def nbytes(self):
+        """
+        Bytes of logged data held in memory
+        """
+        in_memory = sum(sum(a.nbytes for a in c.values()) for c in self._chunks if isinstance(c, dict))
+        return in_memory + len(self._buffer)*(self.dtype.itemsize*len(self.columns or []) + 16)
+
+    def _load(self, chunk):
+        """
+        Returns a chunk, reading it from disk if it was spilled
+        """
+        if isinstance(chunk, dict):
+            return chunk
+        with np.load(chunk) as f:
+            return {k: f[k] for k in f.files}
+
+    def _to_frame(self, chunk):
+        """
+        Converts a chunk to a DataFrame indexed by time
+        """
+        if 'constant' in chunk:
+            values = np.empty((len(chunk['time']), len(self.columns)), dtype = self.dtype)
+            values[:, chunk['constant']] = chunk['constants']
+            values[:, ~chunk['constant']] = chunk['values']
+        else:
+            values = chunk['values']
+        df = pd.DataFrame(values, index = chunk['time'], columns = self.columns)
+        if self._flags.any():
+            df = df.astype({c: bool for c, flag in zip(self.columns, self._flags) if flag})
+        return df
+
+    def chunks(self):
+        """
+        Iterates over the logged data as DataFrames, one chunk at a time
+        """
+        self._flush()
+        for chunk in self._chunks:
+            yield self._to_frame(self._load(chunk))
+
+    def to_frame(self):
+        """
+        Returns all the logged data in a single DataFrame indexed by time
+        """
+        frames = list(self.chunks())
+        if not frames:
+            return pd.DataFrame(columns = self.columns or [], dtype = self.dtype)
+        return pd.concat(frames) if len(frames) > 1 else frames[0]
+
+    def export(self, start = 0, stop = None):
+        """
+        Returns the rows logged for the time steps start <= i < stop, e.g. to write a checkpoint
+        """
+        self._flush()
+        parts = []
+        for chunk in self._chunks:
+            chunk = self._load(chunk)
+            keep = chunk['steps'] >= start
+            if stop is not None:
+                keep &= chunk['steps'] < stop
+            if keep.any():
+                parts.append((chunk['steps'][keep], self._to_frame(chunk)[keep]))
+        return {
+            'columns': self.columns,
+            'steps': np.concatenate([p[0] for p in parts]) if parts else np.array([], dtype = int),
+            'frame': pd.concat([p[1] for p in parts]) if parts else pd.DataFrame(columns = self.columns, dtype = self.dtype),
+        }
+
+    def extend(self, rows:dict):
+        """
+        Logs rows returned by `export`, e.g. when resuming from a checkpoint
+        """
+        if self.columns is None:
+            self._start(rows['columns'])
+        frame = rows['frame'][self.columns]
+        for i, t, values in zip(rows['steps'], frame.index, frame.values):
+            if i % self.decimation:
+                continue
+            self._buffer.append((i, t, list(values)))
+            if len(self._buffer) >= self.chunk_size:
+                self._flush()
+
+    def truncate(self, stop:int):
+        """
+        Drops the rows logged for the time steps i >= stop
+        """
+        rows = self.export(0, stop)
+        self.close()
+        self._chunks, self._buffer = [], []
+        self.extend(rows)
+
+    def close(self):
+        """
+        Deletes the spilled chunks
+        """
+        for chunk in self._chunks:
+            if not isinstance(chunk, dict) and os.path.isfile(chunk):
+                os.remove(chunk)
+        if self._tempdir is not None and os.path.isdir(self._tempdir) and not os.listdir(self._tempdir):
+            os.rmdir(self._tempdir)
+            self.spill_dir = self._tempdir = None
 
 class Simulator(Caretaker):
     """
     Wrapper for pyfoomb.Caretacker
     Keeps track of simulation settings
     Integrates the model and call subroutines
+
+    Models can declare state events as in pyfoomb: `state_events(self, t, y, sw)` returns the event values,
+    and an event happens when one of them changes sign. Its switch in `sw` is toggled and, if the model
+    defines `change_states(self, t, y, sw)`, the states are replaced by the values it returns, e.g. for a feed pulse.
+    Events listed by index in the class attribute `terminal_events` end the run, with a last row at the event time.
+    The rhs receives the switches if it takes them, `rhs(self, t, y, sw)`.
+    Event times are located by bisection between the time steps, and the events of a run are listed in `events`.
     """
+    # number of in-memory snapshots kept by incremental runs
+    snapshots_per_run = 40
+
     def __init__(self, model: Model,**kwds):
         """
         Arguments
@@ -301,81 +1061,918 @@ class Simulator(Caretaker):
                 initial_values = model.initial_values_dict,
                 **kwds)
 
-        # read settings
-        try:
-            self.simvars = Vars(os.getcwd(), 'rms/simulator_vars.csv')
-        except:
-            self.simvars = Vars(os.getcwd(), 'simulator_vars.csv')
+        # read settings, next to this file
+        self.simvars = Vars(os.path.dirname(os.path.abspath(__file__)), 'simulator_vars.csv')
             
         self.model = model
+        self._set_time()
+        self._history = None
+        # last step size of the integrator, 0 restarts it
+        self._step_size = 0.
+
+        # state events declared by the model, see the class docstring
+        self._has_events = _defines(model.model_class, 'state_events')
+        self._rhs_switches = len(inspect.signature(model.model_class.rhs).parameters) > 3
+        self._switches = []
+        self._event_signs = None
+        self._terminated = None
+        self.events = []
+
+        # load subroutines
+        if model.subroutine_class: 
+            self.subroutines = model.subroutine_class(model, self)
+        else:
+            self.subroutines = None
 
+        # replicates get their own copy of the model and subroutines, and are integrated together
+        self.replicates = None
+        if kwds.get('replicate_ids') is not None:
+            self.replicates = {}
+            for replicate_id in kwds['replicate_ids']:
+                replicate_model = model.copy()
+                self.replicates[replicate_id] = {
+                    'model': replicate_model,
+                    'subroutines': model.subroutine_class(replicate_model, self) if model.subroutine_class else None,
+                }
+
+    def _set_time(self):
+        """
+        Sets the integrator and the time grid from the current simulator variables
+        """
         self.integrator = self.simvars.current.loc['integrator','Value']
         ti = float(self.simvars.current.loc['Ti','Value'])
         tf = float(self.simvars.current.loc['Tf','Value'])
         n = int(self.simvars.current.loc['n','Value'])
-        self.dt = (tf-ti)/n
+        # step between consecutive points of the time grid
+        self.dt = (tf-ti)/max(n-1, 1)
         self.simvars.current.loc['dt','Value'] = self.dt
         self.time = np.linspace(ti,tf,n) 
 
-        # load subroutines
-        if model.subroutine_class: 
-            self.subroutines = model.subroutine_class(model, self)
-        else:
-            self.subroutines = None
     def set_inputs(self):
         """
         Sets the current variables to their input value.
 
         """
-        self.model.mvars._update(self.model.mvars.from_input['Value'])
-        if self.subroutines: self.subroutines.subrvars._update(self.subroutines.subrvars.from_input['Value'])
-        self.model.params._update(self.model.params.from_input['Value'])
         self.simvars._update(self.simvars.from_input['Value'])
-        
-    def run(self): #TODO: beautify
+        self._set_time()
+        for model, subroutines in self._units():
+            model.mvars._update(model.mvars.from_input['Value'])
+            model.params._update(model.params.from_input['Value'])
+            if subroutines:
+                subroutines.subrvars._update(subroutines.subrvars.from_input['Value'])
+                subroutines.simulator_vars = self.simvars.get_all_vars_dict()
+
+    def _units(self):
+        """
+        Pairs of model and subroutines run by this simulator: the model, followed by every replicate
+        """
+        units = [(self.model, self.subroutines)]
+        if self.replicates:
+            units += [(r['model'], r['subroutines']) for r in self.replicates.values()]
+        return units
 
+    def update_inputs(self, params = None, mvars = None, subrvars = None, simvars = None, replicate_id = None):
+        """
+        Updates the input values of the variables from dictionaries. Use `set_inputs` or `reinitialize` to apply them.
 
-        mdata = self.model.mvars.current.T[0:0].rename_axis('Time')
-        
-        try:
-            cdata = self.subroutines.subrvars.current.T[0:0].rename_axis('Time')
-        except:
-            cdata = pd.DataFrame()
+        Keyword Arguments
+        -----------------
+            params : dict
+                New values of the model parameters
+            mvars : dict
+                New values of the manipulated variables, including initial conditions
+            subrvars : dict
+                New values of the subroutine variables
+            simvars : dict
+                New values of the simulator variables
+            replicate_id :
+                Only update this replicate. Defaults to None, which updates the model and all the replicates.
+
+        Raises
+        ------
+            KeyError
+                If a variable or replicate does not exist.
+        """
+        if replicate_id is None:
+            units = self._units()
+        elif self.replicates and replicate_id in self.replicates:
+            units = [(self.replicates[replicate_id]['model'], self.replicates[replicate_id]['subroutines'])]
+        else:
+            raise KeyError('Unknown replicate {}'.format(replicate_id))
+
+        for model, subroutines in units:
+            tables = {'params': model.params, 'mvars': model.mvars, 'simvars': self.simvars,
+                      'subrvars': subroutines.subrvars if subroutines else None}
+            for name, values in [('params', params), ('mvars', mvars), ('subrvars', subrvars), ('simvars', simvars)]:
+                if not values:
+                    continue
+                unknown = [k for k in values if tables[name] is None or k not in tables[name].from_input.index]
+                if unknown:
+                    raise KeyError('Unknown {} {}'.format(name, unknown))
+                for k, value in values.items():
+                    tables[name].from_input.loc[k,'Value'] = value
+
+    def reinitialize(self):
+        """
+        Brings the model back to its initial conditions, applies the input values
+        and reinitializes the subroutines, so consecutive runs are independent.
+        """
+        for model, _ in self._units():
+            model.reset()
+        self.set_inputs()
+        for model, subroutines in self._units():
+            state = model.get_state_dict()
+            model.update_mvars_from_dict({k: model.mvars.current.loc[k+'0','Value'] for k in state})
+            if subroutines: subroutines._reset()
+
+    def run(self, checkpoint_every = None, checkpoint_dir = 'checkpoints', incremental = False, recording = None):
+        """
+        Integrates the model over the simulation time, running any subroutine before every step.
+        Returns a DataFrame with the manipulated, state and controlled variables indexed by time,
+        or the Recorder if one is given.
+        With replicates, all of them are integrated together and the DataFrame is indexed by replicate and time,
+        or a dictionary of Recorders is returned, one per replicate.
+
+        Keyword Arguments
+        -----------------
+            checkpoint_every : float
+                Simulation time between checkpoints. Defaults to None, which disables checkpoints.
+            checkpoint_dir : str
+                Directory where checkpoints are written, replacing those of previous runs. Defaults to "checkpoints".
+            incremental : boolean
+                Keep the trajectory and state snapshots in memory and, if the previous run was also incremental,
+                only integrate from the first time step where the inputs differ from the previous run.
+                Call `reinitialize` before each run so the runs start from the same conditions. Defaults to False.
+            recording : Recorder
+                Recording policy: logged variables, decimation, memory budget. Defaults to None, which logs everything in memory
+                with the precision of the simulator variables, see `result_dtype`.
+        """
+        if self.replicates:
+            if incremental or checkpoint_every:
+                raise ValueError('Checkpoints and incremental runs are not supported with replicates.')
+            if self._has_events:
+                raise ValueError('State events are not supported with replicates.')
+            recorders = {}
+            for replicate_id in self.replicates:
+                recorders[replicate_id] = Recorder(dtype = result_dtype(self.simvars)) if recording is None else copy.deepcopy(recording)
+                if recording is not None and recording.spill_dir is not None:
+                    recorders[replicate_id].spill_dir = os.path.join(recording.spill_dir, str(replicate_id))
+            self._run_replicates(recorders)
+            if recording is not None:
+                return recorders
+            return pd.concat([r.to_frame() for r in recorders.values()], keys = list(recorders), names = ['Replicate', 'Time'])
+
+        recorder = Recorder(dtype = result_dtype(self.simvars)) if recording is None else recording
+        if not incremental:
+            self._history = None
+            self._run(self._step, recorder = recorder, checkpoint_every = checkpoint_every, checkpoint_dir = checkpoint_dir)
+            return recorder.to_frame() if recording is None else recorder
+
+        inputs = self._input_signature()
+        start = self._first_divergence(inputs)
+        snapshots = {}
+        if start > 0:
+            start = max(i for i in self._history['snapshots'] if i <= start)
+            self._restore(self._history['snapshots'][start])
+            previous = self._history['recorder']
+            if recorder is previous:
+                recorder.truncate(start)
+            else:
+                recorder.extend(previous.export(0, start))
+            snapshots = {i: s for i, s in self._history['snapshots'].items() if i <= start}
+
+        self._history = {'inputs': inputs, 'recorder': recorder, 'snapshots': snapshots}
+        self._run(self._step, start = start, recorder = recorder, snapshots = snapshots,
+                  checkpoint_every = checkpoint_every, checkpoint_dir = checkpoint_dir)
+        return recorder.to_frame() if recording is None else recorder
+
+    def resume(self, from_t = None, checkpoint_dir = 'checkpoints', restore_inputs = False, checkpoint_every = None, recording = None):
+        """
+        Continues a run from the last checkpoint at or before from_t, without recomputing the previous steps.
+        Inputs changed since the checkpoint was written (in `Vars.from_input`) are applied, so a run can branch
+        from any checkpoint. Returns the full result, including the steps before the checkpoint.
+
+        Keyword Arguments
+        -----------------
+            from_t : float
+                Time to resume from. Defaults to None, which uses the latest checkpoint.
+            checkpoint_dir : str
+                Directory with the checkpoints. Defaults to "checkpoints".
+            restore_inputs : boolean
+                Use the inputs as they were when the checkpoint was written. Defaults to False.
+            checkpoint_every : float
+                Keep writing checkpoints, replacing the later ones. Defaults to None.
+            recording : Recorder
+                Recording policy, see `run`. Defaults to None.
+
+        Raises
+        ------
+            FileNotFoundError
+                If there is no checkpoint at or before from_t.
+        """
+        recorder = Recorder(dtype = result_dtype(self.simvars)) if recording is None else recording
+        checkpoint = None
+        for f in sorted(glob.glob(os.path.join(checkpoint_dir, 'checkpoint_*.pkl.gz'))):
+            with gzip.open(f, 'rb') as fh:
+                ckpt = pickle.load(fh)
+            if from_t is not None and ckpt['t'] > from_t:
+                break
+            recorder.extend(ckpt['log'])
+            checkpoint = ckpt
+
+        if checkpoint is None:
+            raise FileNotFoundError(errno.ENOENT, 'No checkpoint at or before t = {}'.format(from_t), checkpoint_dir)
+
+        self._restore(checkpoint['snapshot'], apply_inputs = not restore_inputs)
+        self._run(self._step, start = checkpoint['i'], recorder = recorder, checkpoint_every = checkpoint_every, checkpoint_dir = checkpoint_dir)
+        return recorder.to_frame() if recording is None else recorder
+
+    def run_sensitivity(self, parameters = None):
+        """
+        Integrates the model together with its forward sensitivity system in a single solve.
+        The sensitivities S = dy/dp evolve as dS/dt = J S + df/dp, where J is the model Jacobian
+        (see `rhs_jacobian`) and df/dp is obtained with `parameter_jacobian`.
+        The augmented system is always integrated with scipy. Inputs changed by subroutines are treated as given.
+
+        Keyword Arguments
+        -----------------
+            parameters : list
+                Names of the model parameters to differentiate against. Defaults to all the entries in parameters.csv.
+
+        Returns
+        -------
+            data : pd.DataFrame
+                Same result as `run`.
+            sensitivities : pd.DataFrame
+                Sensitivity trajectories indexed by time, with (state, parameter) columns.
+
+        Raises
+        ------
+            ValueError
+                If the model has state events.
+        """
+        if self._has_events:
+            raise ValueError('Sensitivities are not supported with state events.')
+        if parameters is None:
+            parameters = list(self.model.params.current.index)
+        parameters = list(parameters)
+        states = list(self.model.get_state_dict().keys())
+
+        S = np.zeros((len(states), len(parameters)))
+        log = []
+        def step(t, state):
+            nonlocal S
+            log.append(S.ravel())
+            y, S = self._sensitivity_step(t, state, parameters, S)
+            return y
+
+        data = self._run(step).to_frame()
+        columns = pd.MultiIndex.from_product([states, parameters], names = ['State', 'Parameter'])
+        sensitivities = pd.DataFrame(np.array(log), index = data.index, columns = columns)
+        return data, sensitivities
+
+    def _run(self, step, start = 0, recorder = None, snapshots = None, checkpoint_every = None, checkpoint_dir = 'checkpoints'):
+        """
+        Main integration loop. Logs the variables, runs the subroutines and pushes the current values to the model
+        before advancing each time step with `step`. Returns the Recorder.
+
+        Arguments
+        ---------
+            step : callable
+                step(t, state) returns the state values at t + dt, in the order of `state`.
+
+        Keyword Arguments
+        -----------------
+            start : int
+                Index of the first time step. Defaults to 0.
+            recorder : Recorder
+                Recorder of the manipulated and controlled variables, with any rows before start. Defaults to None, a new Recorder.
+            snapshots : dict
+                If given, in-memory snapshots are added to it every `snapshot_every` steps. Defaults to None.
+            checkpoint_every : float
+                Simulation time between checkpoints. Defaults to None, which disables checkpoints.
+            checkpoint_dir : str
+                Directory where checkpoints are written. Defaults to "checkpoints".
+        """
+        if recorder is None:
+            recorder = Recorder(dtype = result_dtype(self.simvars))
+        if recorder.columns is None:
+            recorder._start([*self.model.mvars.current.index, *(self.subroutines.subrvars.current.index if self.subroutines else [])])
+        self._profiles = {**self.model.params.get_profiles(), **self.model.mvars.get_profiles()}
+        self._breakpoints = self.breakpoints
+        if checkpoint_every:
+            os.makedirs(checkpoint_dir, exist_ok = True)
+            # checkpoints after the start belong to another run, and would be mixed with this one on resume
+            for f in glob.glob(os.path.join(checkpoint_dir, 'checkpoint_*.pkl.gz')):
+                if int(os.path.basename(f)[len('checkpoint_'):-len('.pkl.gz')]) > start:
+                    os.remove(f)
+            next_checkpoint = self.time[start] + checkpoint_every
+            last_checkpoint = start
+
+        # time steps where some subroutine is due. In between, the integrator does not stop at every time step,
+        # unless inputs are functions of time, which are only evaluated at the time steps
+        due = self.subroutines._due(self.time) if self.subroutines else {}
+        events = np.flatnonzero(np.any(list(due.values()), axis = 0)) if due else np.array([], dtype = int)
+        functions = [v for table in [self.model.params, self.model.mvars] for v in table.default.Value if callable(v) and not isinstance(v, Profile)]
+        # with state events, every time step is checked for events
+        self._terminated = None
+        if self._has_events and step == self._step:
+            step = self._event_step
+            if start == 0:
+                self._reset_events(self.time[0], self.model.get_state_dict())
+        spans = step == self._step and not functions
+        pending = []
+
+        # only the variables changed since the previous step are pushed to the model, all of them at first.
+        # When none changed, other than profiles and initial conditions, the integrator continues with its last step size
+        # instead of restarting
+        self.model.params.mark_changed()
+        self.model.mvars.mark_changed()
+        self._step_size = 0.
+
+        for i in range(start, len(self.time)):
+            t = self.time[i]
+            if snapshots is not None and i % max(1, len(self.time)//self.snapshots_per_run) == 0:
+                snapshots[i] = self._snapshot()
+            if checkpoint_every and t >= next_checkpoint:
+                self._write_checkpoint(checkpoint_dir, i, recorder.export(last_checkpoint, i))
+                next_checkpoint += checkpoint_every
+                last_checkpoint = i
 
-        for t in self.time:
             state = self.model.get_state_dict()
-            mdata = pd.concat([mdata,pd.DataFrame(self.model.mvars.get_all_vars_dict(t),index = [t])])
+            row = self.model.mvars.get_all_vars_dict(t)
 
-            # run any subroutine
+            # run any subroutine that is due
             if self.subroutines:
-                self.subroutines._run_all(t)
-                cdata = pd.concat([cdata,pd.DataFrame(self.subroutines.subrvars.get_all_vars_dict(t),index = [t])])
-            else:
-                pass
+                methods = [name for name, d in due.items() if d[i]]
+                if methods:
+                    self.subroutines._run_all(t, methods)
+                row.update(self.subroutines.subrvars.get_all_vars_dict(t))
+            recorder.append(i, t, row)
 
             # update, integrate, log
-            self.simulators[None].set_parameters(self.model.get_vars_dict(t))
+            if pending:
+                values = pending.pop(0)
+            else:
+                changed = self.model.get_changed_vars_dict(t)
+                if changed:
+                    self.simulators[None].set_parameters(changed)
+                if any(k not in self._profiles and not (k[-1] == '0' and k[:-1] in state) for k in changed):
+                    self._step_size = 0.
+                after = events[events > i]
+                j = min(after[0], len(self.time) - 1) if len(after) else len(self.time) - 1
+                if spans and j > i + 1:
+                    # integrate up to the next event in one go, keeping the states at the time steps in between
+                    pending = list(self._step_span(self.time[i:j+1], state)[1:])
+                    values = pending.pop(0)
+                else:
+                    values = step(t, state)
+            state = dict(zip(state.keys(), values))
+            self.model.update_mvars_from_dict(state, also_IC = True)
 
-            if self.integrator == 'CVODE': # TODO: make sure this works
-                results = self.simulate(np.array([t,t+self.dt]))
-                # log data
-                for i,(r,k) in enumerate(zip(results, state.keys())):
-                    state[k] = r.values[-1]
+            # the run ends at a terminal event, with a last row at its time
+            if self._terminated is not None:
+                te = self._terminated
+                row = self.model.mvars.get_all_vars_dict(te)
+                if self.subroutines:
+                    row.update(self.subroutines.subrvars.get_all_vars_dict(te))
+                recorder.append(i + 1, te, row)
+                break
 
-            elif self.integrator == 'scipy':
+        return recorder
 
-                myfun = lambda y,t: self.model.model_class.rhs(self.simulators[None].bioprocess_model,t,y)
-                results = odeint(myfun, t = np.array([t,t+self.dt]), y0 = [value for _, value in state.items()])[-1]
-                # log data
-                for i,(r,k) in enumerate(zip(results.T, state.keys())):
-                    state[k] = r
+    def _run_replicates(self, recorders):
+        """
+        Integration loop of the replicates. Runs the subroutines of every replicate,
+        then advances all of them together in a single solve with `_replicate_span`.
+        As in `_run`, only the variables changed since the previous step are pushed, and the integrator
+        does not stop at every time step in between the time steps where a subroutine is due.
+
+        Arguments
+        ---------
+            recorders : dict
+                Recorder of each replicate
+        """
+        replicates = list(self.replicates.values())
+        for r, recorder in zip(replicates, recorders.values()):
+            if recorder.columns is None:
+                recorder._start([*r['model'].mvars.current.index, *(r['subroutines'].subrvars.current.index if r['subroutines'] else [])])
+        self._breakpoints = self.breakpoints
+        profiles = [{**r['model'].params.get_profiles(), **r['model'].mvars.get_profiles()} for r in replicates]
+        self._replicate_profiles = {k: [p.get(k) for p in profiles] for k in set().union(*profiles)}
+        states = list(self.model.get_state_dict().keys())
+        due = [r['subroutines']._due(self.time) if r['subroutines'] else {} for r in replicates]
+        due_any = [d for dues in due for d in dues.values()]
+        events = np.flatnonzero(np.any(due_any, axis = 0)) if due_any else np.array([], dtype = int)
+        functions = [v for r in replicates for table in [r['model'].params, r['model'].mvars]
+                     for v in table.default.Value if callable(v) and not isinstance(v, Profile)]
+        spans = not functions
+        pending = []
+
+        # stacked parameters of all the replicates, updated with the variables that changed
+        parameters = {}
+        for r in replicates:
+            r['model'].params.mark_changed()
+            r['model'].mvars.mark_changed()
+        self._step_size = 0.
+
+        for i, t in enumerate(self.time):
+            for r, recorder, d in zip(replicates, recorders.values(), due):
+                row = r['model'].mvars.get_all_vars_dict(t)
+                if r['subroutines']:
+                    methods = [name for name, dm in d.items() if dm[i]]
+                    if methods:
+                        r['subroutines']._run_all(t, methods)
+                    row.update(r['subroutines'].subrvars.get_all_vars_dict(t))
+                recorder.append(i, t, row)
+
+            if pending:
+                Y = pending.pop(0)
             else:
-                raise Exception('Integrator not recognized. Please use "CVODE" or "scipy".')
+                Y = np.array([list(r['model'].get_state_dict().values()) for r in replicates], dtype = float).T
+                for j, r in enumerate(replicates):
+                    changed = r['model'].get_changed_vars_dict(t)
+                    for k, v in changed.items():
+                        parameters.setdefault(k, np.zeros(len(replicates)))[j] = v
+                    if any(k not in self._replicate_profiles and not (k[-1] == '0' and k[:-1] in states) for k in changed):
+                        self._step_size = 0.
+                after = events[events > i]
+                j = min(after[0], len(self.time) - 1) if len(after) else len(self.time) - 1
+                times = self.time[i:j+1] if spans and j > i + 1 else np.array([t, t + self.dt])
+                pending = list(self._replicate_span(times, parameters, Y)[1:])
+                Y = pending.pop(0)
+            for j, r in enumerate(replicates):
+                r['model'].update_mvars_from_dict(dict(zip(states, Y[:,j])), also_IC = True)
 
+    def _replicate_span(self, times, parameters, Y):
+        """
+        Integrates all the replicates over several time steps without stopping.
+        Returns the states at every time, with shape (times, states, replicates).
 
-            self.model.update_mvars_from_dict(state, also_IC = True)
+        Arguments
+        ---------
+            times : np.ndarray
+                Increasing times, starting at the current time
+            parameters : dict
+                Values of the parameters of every replicate, as arrays
+            Y : np.ndarray
+                Current states, with shape (states, replicates)
+        """
+        if self.integrator == 'CVODE':
+            for j, replicate_id in enumerate(self.replicates):
+                self.simulators[replicate_id].set_parameters({k: v[j] for k, v in parameters.items()})
+            results = self.simulate(np.asarray(times))
+            states = list(self.model.get_state_dict().keys())
+            values = {(r.replicate_id, r.name): r.values for r in results}
+            return np.array([[values[(replicate_id, k)] for replicate_id in self.replicates] for k in states]).transpose(2, 0, 1)
+
+        elif self.integrator == 'scipy':
+            bioprocess_model = make_bioprocess_model(self.model.model_class, parameters)
+            n, k = Y.shape
+            def myfun(y, t):
+                for name, profiles in self._replicate_profiles.items():
+                    bioprocess_model.model_parameters[name] = np.array([p(t) if p else parameters[name][j] for j, p in enumerate(profiles)])
+                return rhs_batch(bioprocess_model, t, y.reshape(k, n).T).T.ravel()
+            # the states of each replicate are contiguous, so the Jacobian is banded
+            Y = self._odeint(myfun, np.asarray(times), Y.T.ravel(), ml = n-1, mu = n-1)
+            return Y.reshape(len(times), k, n).transpose(0, 2, 1)
+
+        else:
+            raise Exception('Integrator not recognized. Please use "CVODE" or "scipy".')
+
+    @property
+    def breakpoints(self):
+        """
+        Sorted times within the simulation where a model input profile is not smooth
+        """
+        profiles = [p for model, _ in self._units() for p in [*model.params.get_profiles().values(), *model.mvars.get_profiles().values()]]
+        if not profiles:
+            return np.array([])
+        breakpoints = np.unique(np.concatenate([p.breakpoints for p in profiles]))
+        return breakpoints[(breakpoints >= self.time[0]) & (breakpoints <= self.time[-1])]
+
+    def _set_profiles(self, bioprocess_model, t):
+        """
+        Sets the value of the profile inputs at time t
+        """
+        for k, profile in self._profiles.items():
+            bioprocess_model.model_parameters[k] = profile(t)
+
+    def _input_signature(self):
+        """
+        Describes the inputs of a run: time grid, integrator, initial subroutine state and the value of every variable,
+        evaluated over the time grid for time-dependent variables. Profiles are kept whole, since they act between the grid times.
+        """
+        signature = {
+            'time': self.time.copy(),
+            'integrator': self.integrator,
+            'subroutines': pickle.dumps(self.subroutines._get_state()) if self.subroutines else None,
+            'vars': {},
+        }
+        for v in self._all_vars():
+            for k in v.current.index:
+                value = v.default.loc[k,'Value'] if k in v.default.index else None
+                if isinstance(value, Profile):
+                    signature['vars'][(v.var_file, k)] = copy.deepcopy(value)
+                elif callable(value):
+                    signature['vars'][(v.var_file, k)] = np.array([value(t) for t in self.time])
+                else:
+                    signature['vars'][(v.var_file, k)] = v.current.loc[k,'Value']
+        return signature
+
+    def _first_divergence(self, inputs):
+        """
+        Returns the index of the first time step where the inputs differ from the previous incremental run,
+        0 if there is no previous run or the runs are not comparable.
+        For a profile, it is the last time step strictly before the profiles differ, whose integration is not affected.
+        """
+        old = self._history
+        if (old is None or len(old['inputs']['time']) != len(inputs['time']) or np.any(old['inputs']['time'] != inputs['time'])
+                or old['inputs']['integrator'] != inputs['integrator'] or old['inputs']['subroutines'] != inputs['subroutines']
+                or old['inputs']['vars'].keys() != inputs['vars'].keys()):
+            return 0
+
+        first = len(self.time)
+        for k, new in inputs['vars'].items():
+            previous = old['inputs']['vars'][k]
+            if isinstance(new, Profile) and isinstance(previous, Profile):
+                t = new.first_difference(previous)
+                if t is not None:
+                    first = min(first, max(np.searchsorted(self.time, t, side = 'left') - 1, 0))
+            elif isinstance(new, Profile) or isinstance(previous, Profile):
+                return 0
+            elif isinstance(new, np.ndarray) and isinstance(previous, np.ndarray):
+                diff = np.flatnonzero(new != previous)
+                if len(diff):
+                    first = min(first, diff[0])
+            elif isinstance(new, np.ndarray) or isinstance(previous, np.ndarray) or not _same_value(new, previous):
+                return 0
+        return first
+
+    def _snapshot(self):
+        """
+        Returns a copy of everything needed to continue a run: variable tables, subroutine state and integrator settings
+        """
+        return {
+            'tables': [(v.current.copy(True), v.from_input.copy(True)) for v in self._all_vars()],
+            'subroutines': self.subroutines._get_state() if self.subroutines else None,
+            'integrator': self.integrator,
+            'dt': self.dt,
+            'time': self.time,
+            'events': (list(self._switches), None if self._event_signs is None else self._event_signs.copy(), list(self.events)),
+        }
+
+    def _restore(self, snapshot, apply_inputs = True):
+        """
+        Restores a snapshot taken with `_snapshot`
+
+        Arguments
+        ---------
+            snapshot : dict
+
+        Keyword Arguments
+        -----------------
+            apply_inputs : boolean
+                Apply the inputs (other than initial conditions) changed since the snapshot was taken. Defaults to True.
+        """
+        for v, (current, from_input) in zip(self._all_vars(), snapshot['tables']):
+            if apply_inputs:
+                new = v.from_input
+                changed = [k for k in new.index if k in from_input.index and not _same_value(new.loc[k,'Value'], from_input.loc[k,'Value'])
+                           and not ('State' in new.columns and new.loc[k,'State'] is True)]
+                v.current = current.copy(True)
+                v.current.loc[changed,'Value'] = new.loc[changed,'Value']
+            else:
+                v.current = current.copy(True)
+                v.from_input = from_input.copy(True)
+
+        if self.subroutines:
+            self.subroutines._set_state(snapshot['subroutines'])
+        self.integrator = snapshot['integrator']
+        self.dt = snapshot['dt']
+        self.time = snapshot['time']
+        if 'events' in snapshot:
+            switches, signs, events = snapshot['events']
+            self._switches, self.events = list(switches), list(events)
+            self._event_signs = None if signs is None else signs.copy()
+
+    def _all_vars(self):
+        """
+        All the variable tables of the model, subroutines and simulator
+        """
+        return [self.model.mvars, self.model.params, self.simvars] + ([self.subroutines.subrvars] if self.subroutines else [])
+
+    def _write_checkpoint(self, checkpoint_dir, i, log):
+        """
+        Writes a compressed checkpoint before time step i, with the rows logged since the previous checkpoint
+        """
+        checkpoint = {'i': i, 't': self.time[i], 'snapshot': self._snapshot(), 'log': log}
+        with gzip.open(os.path.join(checkpoint_dir, 'checkpoint_{:06d}.pkl.gz'.format(i)), 'wb') as f:
+            pickle.dump(checkpoint, f, protocol = pickle.HIGHEST_PROTOCOL)
+
+    def _step(self, t, state):
+        """
+        Integrates the model from t to t + dt with the selected integrator
+
+        Arguments
+        ---------
+            t : float
+                Current time
+            state : dict
+                Current state values
+        """
+        return self._step_interval(t, t + self.dt, state)
+
+    def _step_interval(self, t, t_end, state):
+        """
+        Integrates the model from t to t_end with the selected integrator
+
+        Arguments
+        ---------
+            t : float
+                Current time
+            t_end : float
+                Final time
+            state : dict
+                Current state values
 
-        return mdata.join(cdata)
+        Raises
+        ------
+            Exception
+                If the integrator is not recognized
+        """
+        if self.integrator == 'CVODE': # TODO: make sure this works
+            if self._has_events:
+                # starts from the given states, which differ from the model ones after an event
+                self.simulators[None].set_parameters({k+'0': v for k, v in state.items()})
+            results = self.simulate(np.array([t,t_end]))
+            return [r.values[-1] for r in results[:len(state)]]
+
+        elif self.integrator == 'scipy':
+            # profiles are evaluated continuously, stepping exactly across their breakpoints
+            bioprocess_model = self.simulators[None].bioprocess_model
+            def myfun(y, t):
+                self._set_profiles(bioprocess_model, t)
+                return self._rhs(bioprocess_model, t, y)
+            return self._odeint(myfun, np.array([t,t_end]), [value for _, value in state.items()])[-1]
+
+        else:
+            raise Exception('Integrator not recognized. Please use "CVODE" or "scipy".')
+
+    def _step_span(self, times, state):
+        """
+        Integrates the model over several time steps without stopping.
+        Returns the state values at every time, with shape (times, states).
+
+        Arguments
+        ---------
+            times : np.ndarray
+                Increasing times, starting at the current time
+            state : dict
+                Current state values
+
+        Raises
+        ------
+            Exception
+                If the integrator is not recognized
+        """
+        if self.integrator == 'CVODE':
+            results = self.simulate(np.asarray(times))
+            return np.array([r.values for r in results[:len(state)]]).T
+
+        elif self.integrator == 'scipy':
+            bioprocess_model = self.simulators[None].bioprocess_model
+            def myfun(y, t):
+                self._set_profiles(bioprocess_model, t)
+                return self._rhs(bioprocess_model, t, y)
+            return self._odeint(myfun, np.asarray(times), [value for _, value in state.items()])
+
+        else:
+            raise Exception('Integrator not recognized. Please use "CVODE" or "scipy".')
+
+    def _odeint(self, myfun, times, y0, **kwds):
+        """
+        Integrates with odeint over the given times, stepping exactly across the profile breakpoints.
+        The first step is the last one of the previous call, at most the first interval. If odeint fails with it,
+        e.g. on a stiff stretch, the integration is repeated letting odeint choose the first step, with more steps allowed,
+        so a step that stopped early is never returned as if it had reached the end.
+
+        Arguments
+        ---------
+            myfun : callable
+                Right-hand side, as myfun(y, t)
+            times : np.ndarray
+                Increasing times, starting at the current time
+            y0 : list
+                State values at times[0]
+
+        Keyword Arguments
+        -----------------
+            **kwds :
+                Passed on to `scipy.integrate.odeint`, e.g. the bandwidths ml and mu of the Jacobian.
+        """
+        tcrit = self._breakpoints[(self._breakpoints > times[0]) & (self._breakpoints < times[-1])]
+        tcrit = tcrit if len(tcrit) else None
+        h0 = min(self._step_size, times[1] - times[0])
+        if h0 > 0:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', ODEintWarning)
+                y, info = odeint(myfun, t = times, y0 = y0, tcrit = tcrit, h0 = h0, full_output = True, **kwds)
+            if info['message'] == 'Integration successful.':
+                self._step_size = info['hu'][-1]
+                return y
+        y, info = odeint(myfun, t = times, y0 = y0, tcrit = tcrit, mxstep = 5000, full_output = True, **kwds)
+        self._step_size = info['hu'][-1] if info['message'] == 'Integration successful.' else 0.
+        return y
+
+    def _rhs(self, bioprocess_model, t, y):
+        """
+        Evaluates the model right-hand side, with the current switches if it takes them
+        """
+        if self._rhs_switches:
+            return self.model.model_class.rhs(bioprocess_model, t, y, self._switches)
+        return self.model.model_class.rhs(bioprocess_model, t, y)
+
+    def _reset_events(self, t, state):
+        """
+        Sets the switches to their initial values, all off unless the model gives `initial_switches`,
+        and the sign of every event value at the start of a run
+        """
+        bioprocess_model = self.simulators[None].bioprocess_model
+        y = np.array(list(state.values()), dtype = float)
+        switches = getattr(bioprocess_model, 'initial_switches', None)
+        if switches is None:
+            # as many switches as event values, found by growing the list until state_events accepts it
+            switches = []
+            while True:
+                try:
+                    n = len(np.atleast_1d(bioprocess_model.state_events(t, y, switches)))
+                    break
+                except IndexError:
+                    if len(switches) > 100:
+                        raise
+                    switches.append(False)
+            switches = [False]*n
+        self._switches = list(switches)
+        self.events = []
+        self._event_signs = np.sign(self._event_values(t, y))
+
+    def _event_values(self, t, y):
+        """
+        Values of the state events at time t
+        """
+        bioprocess_model = self.simulators[None].bioprocess_model
+        return np.atleast_1d(np.asarray(bioprocess_model.state_events(t, y, self._switches), dtype = float))
+
+    def _crossed(self, g):
+        """
+        Events whose value has changed sign since the last time step or event
+        """
+        return (np.sign(g) != self._event_signs) & (g != 0)
+
+    def _event_step(self, t, state):
+        """
+        Integrates the model from t to t + dt, handling the state events in between in order:
+        switches are toggled, the states changed by `change_states`, and the run is stopped by a terminal event.
+
+        Arguments
+        ---------
+            t : float
+                Current time
+            state : dict
+                Current state values
+        """
+        bioprocess_model = self.simulators[None].bioprocess_model
+        names = list(state.keys())
+        terminal = getattr(self.model.model_class, 'terminal_events', [])
+        # nothing happens after the end of the simulation
+        a, b = t, min(t + self.dt, self.time[-1])
+        y = np.array(list(state.values()), dtype = float)
+        while b - a > 1e-12*max(1., abs(b)):
+            y_b = np.asarray(self._step_interval(a, b, dict(zip(names, y))), dtype = float)
+            g = self._event_values(b, y_b)
+            if not self._crossed(g).any():
+                return y_b
+
+            te, y, fired = self._locate_event(a, b, dict(zip(names, y)), y_b)
+            self._event_signs = np.where(fired, -self._event_signs, self._event_signs)
+            happened = np.zeros_like(fired)
+            while fired.any():
+                happened |= fired
+                for k in np.flatnonzero(fired):
+                    self._switches[k] = not self._switches[k]
+                if _defines(self.model.model_class, 'change_states'):
+                    y = np.asarray(bioprocess_model.change_states(te, y, self._switches), dtype = float)
+                # events whose value jumps across zero with the new states also happen, once at a given time
+                g = self._event_values(te, y)
+                fired = self._crossed(g) & ~happened
+                self._event_signs = np.where(g != 0, np.sign(g), self._event_signs)
+            # the integrator restarts after the discontinuity
+            self._step_size = 0.
+
+            self.events += [{'Time': te, 'Event': int(k), 'Terminal': k in terminal} for k in np.flatnonzero(happened)]
+            if any(k in terminal for k in np.flatnonzero(happened)):
+                self._terminated = te
+                return y
+            a = te
+        return y
+
+    def _locate_event(self, a, b, state, y_b):
+        """
+        Finds the first time in (a, b] where an event value has changed sign, by bisection, on the dense output
+        of solve_ivp with scipy or on repeated solves with CVODE. Returns the time, the states at that time
+        and which events changed sign. The time returned is just after the change, so every event happens once.
+
+        Arguments
+        ---------
+            a : float
+                Start of the interval
+            b : float
+                End of the interval, where some event value has changed sign
+            state : dict
+                State values at a
+            y_b : np.ndarray
+                State values at b
+        """
+        if self.integrator == 'scipy':
+            bioprocess_model = self.simulators[None].bioprocess_model
+            def myfun(t, y):
+                self._set_profiles(bioprocess_model, t)
+                return self._rhs(bioprocess_model, t, y)
+            solution = solve_ivp(myfun, (a, b), list(state.values()), method = 'LSODA', dense_output = True, rtol = 1.49012e-8, atol = 1.49012e-8).sol
+            y_at = lambda t: solution(t)
+        else:
+            y_at = lambda t: np.asarray(self._step_interval(a, t, state), dtype = float)
+
+        lo, hi = a, b
+        g_hi = self._event_values(b, y_b)
+        while hi - lo > 1e-10*max(1., abs(b)):
+            m = (lo + hi)/2
+            y_m = y_at(m)
+            g_m = self._event_values(m, y_m)
+            if self._crossed(g_m).any():
+                hi, y_b, g_hi = m, y_m, g_m
+            else:
+                lo = m
+        return hi, y_b, self._crossed(g_hi)
+
+    def _sensitivity_step(self, t, state, parameters, S):
+        """
+        Integrates the states and their sensitivities from t to t + dt
+
+        Arguments
+        ---------
+            t : float
+                Current time
+            state : dict
+                Current state values
+            parameters : list
+                Parameters to differentiate against
+            S : np.ndarray
+                Current sensitivities, with shape (states, parameters)
+        """
+        bioprocess_model = self.simulators[None].bioprocess_model
+        n = len(state)
+
+        def augmented(z, t):
+            self._set_profiles(bioprocess_model, t)
+            y, S = z[:n], z[n:].reshape(n, -1)
+            dS = rhs_jacobian(bioprocess_model, t, y) @ S + parameter_jacobian(bioprocess_model, t, y, parameters)
+            return np.concatenate([np.asarray(bioprocess_model.rhs(t, y), dtype = float), dS.ravel()])
+
+        z0 = np.concatenate([[value for _, value in state.items()], S.ravel()])
+        tcrit = self._breakpoints[(self._breakpoints > t) & (self._breakpoints < t + self.dt)]
+        z = odeint(augmented, t = np.array([t,t+self.dt]), y0 = z0, tcrit = tcrit if len(tcrit) else None)[-1]
+        return z[:n], z[n:].reshape(S.shape)
+
+def periodic(period:float, phase = 0.):
+    """
+    Decorator giving a subroutine method its own sample period. The method runs at the first time step at or after
+    every phase + k*period, instead of at every time step. Between runs of the subroutines the simulator
+    integrates without stopping at every time step.
+
+        class MySubroutines(Subroutine):
+            @periodic(0.5)
+            def temperature_cascade(self):
+                ...
+
+    Arguments
+    ---------
+        period : float
+            Time between runs of the method
+
+    Keyword Arguments
+    -----------------
+        phase : float
+            Time of the first run. Defaults to 0.
+    """
+    if period <= 0:
+        raise ValueError('The period of a subroutine must be positive, got {}.'.format(period))
+    def decorator(method):
+        method.period = period
+        method.phase = phase
+        return method
+    return decorator
 
 class Subroutine():
     """
@@ -400,6 +1997,36 @@ class Subroutine():
 
         self._initialization()
 
+    def _reset(self):
+        """
+        Refreshes the variables seen by the subroutine and runs the initialization again
+        """
+        self.model_parameters = self.model.get_all_vars_dict()
+        self.model_state = self.model.get_state_dict()
+        self.subroutine_vars = self.subrvars.get_all_vars_dict()
+        self._initialization()
+
+    def _get_state(self):
+        """
+        Returns a copy of the internal state of the subroutine, i.e. all the attributes that can be pickled
+        other than the model and the subroutine variables
+        """
+        state = {}
+        for k, v in vars(self).items():
+            if k in ['model', 'subrvars']:
+                continue
+            try:
+                state[k] = pickle.loads(pickle.dumps(v))
+            except Exception:
+                pass
+        return state
+
+    def _set_state(self, state:dict):
+        """
+        Restores the internal state returned by `_get_state`
+        """
+        self.__dict__.update(pickle.loads(pickle.dumps(state)))
+
     def _initialization(self):
         """
         Method run once in the first integration iteration. Useful for initializing variables.
@@ -408,7 +2035,7 @@ class Subroutine():
         """
         pass
     
-    def _run_all(self,t: float):
+    def _run_all(self,t: float, methods = None):
         """
         Eexecutes all subroutine methods specified by the user and udpates variables
 
@@ -416,6 +2043,11 @@ class Subroutine():
         ---------
             t:flaot
                 Current time, provided by Simulator.
+
+        Keyword Arguments
+        -----------------
+            methods : list
+                Names of the methods to run. Defaults to None, which runs all of them.
         
         Raises
         ------
@@ -423,17 +2055,65 @@ class Subroutine():
         """
         self.model_parameters = self.model.get_all_vars_dict(t)
         self.model_state = self.model.get_state_dict(t)
-        self.subroutine_vars = self.subrvars.get_all_vars_dict()
+        self.subroutine_vars = self.subrvars.get_all_vars_dict(t)
+        self._execute(t, methods)
+        self.model.update_mvars_from_dict(self.model_parameters)
 
+    def _methods(self):
+        """
+        Returns the subroutine methods specified by the user, i.e. the not underscored ones
+        """
         all_methods = (getattr(self, name) for name in dir(self))
-        self.exe_methods = filter(lambda x: not x.__name__.startswith('_') ,filter(inspect.ismethod,all_methods))
+        return list(filter(lambda x: not x.__name__.startswith('_') ,filter(inspect.ismethod,all_methods)))
+
+    def _due(self, time):
+        """
+        Returns, for every subroutine method, a boolean array telling at which points of the time grid it runs.
+        Methods without a period (see `periodic`) run at every point.
+
+        Arguments
+        ---------
+            time : np.ndarray
+                Time grid of the simulation
+        """
+        time = np.asarray(time, dtype = float)
+        due = {}
+        for method in self._methods():
+            period = getattr(method, 'period', None)
+            if period is None:
+                due[method.__name__] = np.ones(len(time), dtype = bool)
+                continue
+            phase = getattr(method, 'phase', 0.)
+            # index of the last sample time at or before each time, due when it changes
+            k = np.floor((time - phase)/period + 1e-9)
+            due[method.__name__] = (time >= phase - 1e-9*period) & np.concatenate([[True], k[1:] > k[:-1]])
+        return due
+
+    def _execute(self, t: float, methods = None):
+        """
+        Executes all subroutine methods specified by the user on the current
+        `model_parameters`, `model_state` and `subroutine_vars` dictionaries, without touching the variable tables
+
+        Arguments
+        ---------
+            t:flaot
+                Current time, provided by Simulator.
+
+        Keyword Arguments
+        -----------------
+            methods : list
+                Names of the methods to run. Defaults to None, which runs all of them.
+
+        Raises
+        ------
+            SubroutineError
+        """
+        self.exe_methods = [m for m in self._methods() if methods is None or m.__name__ in methods]
         for method in self.exe_methods:
             try:
                 method()
             except:
                 raise SubroutineError('Run into an issue with the subroutine at time {}'.format(t))
-        
-        self.model.update_mvars_from_dict(self.model_parameters)
 
 # this dsnt work
 
@@ -0,0 +1,189 @@
+from engine import Model, Simulator, read_timeseries
+from concurrent.futures import ProcessPoolExecutor
+from scipy.optimize import least_squares
+from scipy.stats import qmc
+import pandas as pd
+import numpy as np
+import os
+
+# one simulator per model and process, so models are imported only once per worker
+_simulators = {}
+
+def _get_simulator(model_path):
+    """
+    Returns the cached simulator of a model, creating it on first use
+
+    Arguments
+    ---------
+        model_path :
+            Path poiting to a specific model directory.
+    """
+    if model_path not in _simulators:
+        _simulators[model_path] = Simulator(model = Model(model_path))
+    return _simulators[model_path]
+
+class Objective():
+    """
+    Weighted least squares residuals between a simulation and measured time series.
+    The residuals and their Jacobian come from a single `Simulator.run_sensitivity` call,
+    which is cached for the last evaluated parameter vector.
+    The sensitivities are open loop: the inputs set by subroutines (e.g. a PID) are taken as fixed,
+    so with subroutines the Jacobian does not match the residuals and should be found by finite differences.
+    """
+    def __init__(self, simulator: Simulator, measurements: pd.DataFrame, unknowns: list, weights = None, sensitivities = True):
+        """
+        Arguments
+        ---------
+            simulator : Simulator
+                Simulator of the model to fit
+            measurements : pd.DataFrame
+                Measured values indexed by time, one column per variable. Missing values are ignored.
+            unknowns : list
+                Names of the parameters to estimate
+
+        Keyword Arguments
+        -----------------
+            weights : dict
+                Weight of the residuals of each measured variable.
+                Defaults to the inverse of the standard deviation of each measured variable.
+            sensitivities : bool
+                Integrate the sensitivities for `jacobian`. If False, only the residuals are computed, with `Simulator.run`.
+                Defaults to True.
+
+        Raises
+        ------
+            ValueError
+                If measurements fall outside the simulation time or refer to unknown variables.
+        """
+        self.simulator = simulator
+        self.measurements = measurements
+        self.unknowns = list(unknowns)
+        self.sensitivities = sensitivities
+
+        states = simulator.model.get_state_dict()
+        unknown_vars = [v for v in measurements.columns if v not in states]
+        if unknown_vars:
+            raise ValueError('Only states can be fitted, got {}.'.format(unknown_vars))
+        if measurements.index.min() < simulator.time[0] or measurements.index.max() > simulator.time[-1]:
+            raise ValueError('Measurements must lie within the simulation time [{}, {}].'.format(simulator.time[0], simulator.time[-1]))
+
+        if weights is None:
+            weights = {v: 1/measurements[v].std() if measurements[v].std() > 0 else 1. for v in measurements.columns}
+        self.weights = np.array([weights[v] for v in measurements.columns])
+        self.mask = ~np.isnan(measurements.values)
+
+        self._x = None
+
+    def _evaluate(self, x):
+        """
+        Simulates the model with parameter values x, reusing the last result if x did not change
+        """
+        if self._x is not None and np.array_equal(x, self._x):
+            return
+        for p, value in zip(self.unknowns, x):
+            table = self.simulator.model.params if p in self.simulator.model.params.from_input.index else self.simulator.model.mvars
+            table.from_input.loc[p,'Value'] = value
+        self.simulator.reinitialize()
+        if self.sensitivities:
+            data, sens = self.simulator.run_sensitivity(self.unknowns)
+        else:
+            data = self.simulator.run()
+
+        t = self.measurements.index.values
+        time = data.index.values.astype(float)
+        predicted = np.array([np.interp(t, time, data[v].values.astype(float)) for v in self.measurements.columns]).T
+        self._residuals = ((predicted - self.measurements.values)*self.weights)[self.mask]
+        self._x = np.array(x, copy = True)
+        if not self.sensitivities:
+            self._jac = None
+            return
+
+        jac = np.array([[np.interp(t, time, sens[(v,p)].values) for p in self.unknowns] for v in self.measurements.columns])
+        self._jac = (jac.transpose(2,0,1)*self.weights[None,:,None])[self.mask]
+
+    def residuals(self, x):
+        self._evaluate(x)
+        return self._residuals
+
+    def jacobian(self, x):
+        self._evaluate(x)
+        return self._jac
+
+def _fit(model_path, measurements, unknowns, bounds, x0, weights, jac, kwds):
+    """
+    Runs a single local fit. Executed in the worker processes.
+    """
+    simulator = _get_simulator(model_path)
+    if jac is None:
+        jac = '2-point' if simulator.subroutines else 'sensitivity'
+    defaults = {table: table.from_input['Value'].copy(True) for table in [simulator.model.params, simulator.model.mvars]}
+    try:
+        objective = Objective(simulator, measurements, unknowns, weights, sensitivities = jac == 'sensitivity')
+        res = least_squares(objective.residuals, x0,
+                jac = objective.jacobian if jac == 'sensitivity' else jac,
+                bounds = tuple(np.array(bounds).T), x_scale = 'jac', **kwds)
+        return {**dict(zip(unknowns, res.x)), 'cost': res.cost, 'success': res.success, 'nfev': res.nfev, 'message': res.message}
+    except Exception as e:
+        return {**dict(zip(unknowns, x0)), 'cost': np.inf, 'success': False, 'nfev': 0, 'message': str(e)}
+    finally:
+        for table, values in defaults.items():
+            table.from_input['Value'] = values
+
+def estimate_multistart(model_path, measurements, bounds: dict, n_starts = 20, processes = None, weights = None, jac = None, seed = None, **kwds):
+    """
+    Fits model parameters to measured time series from many random starting points in parallel.
+    Each worker process imports the model once and reuses it for all of its starts.
+
+    Arguments
+    ---------
+        model_path :
+            Path poiting to a specific model directory.
+        measurements : str or pd.DataFrame
+            Measured states indexed by time, or path to a .csv or .parquet file with a "Time" column.
+        bounds : dict
+            Lower and upper bounds of each parameter to estimate, e.g. {'UA': (1e4, 1e5)}.
+
+    Keyword Arguments
+    -----------------
+        n_starts : int
+            Number of starting points, drawn by Latin hypercube sampling within the bounds. Defaults to 20.
+        processes : int
+            Number of worker processes. Defaults to the number of CPUs, 1 runs serially.
+        weights : dict
+            Weight of the residuals of each measured variable. See `Objective`.
+        jac : str
+            "sensitivity" to use the forward sensitivities, or any `scipy.optimize.least_squares` finite difference scheme.
+            Defaults to None: "sensitivity" for models without subroutines, and "2-point" for models with subroutines,
+            whose closed loop the sensitivities do not include (see `Objective`).
+        seed : int
+            Seed for the starting points.
+        **kwds :
+            Passed on to `scipy.optimize.least_squares`.
+
+    Returns
+    -------
+        best : pd.Series
+            Best parameter estimates, with their cost.
+        starts : pd.DataFrame
+            Result of every start, sorted by cost.
+        spread : pd.DataFrame
+            Summary statistics of the estimates across the successful starts.
+    """
+    if isinstance(measurements, str):
+        measurements = read_timeseries(measurements)
+    model_path = os.path.abspath(model_path)
+    unknowns = list(bounds.keys())
+    limits = np.array([bounds[p] for p in unknowns], dtype = float)
+
+    x0s = qmc.scale(qmc.LatinHypercube(d = len(unknowns), seed = seed).random(n_starts), limits[:,0], limits[:,1])
+    args = [(model_path, measurements, unknowns, limits, x0, weights, jac, kwds) for x0 in x0s]
+
+    if processes == 1:
+        results = [_fit(*a) for a in args]
+    else:
+        with ProcessPoolExecutor(max_workers = processes) as pool:
+            results = list(pool.map(_fit, *zip(*args)))
+
+    starts = pd.DataFrame(results).sort_values('cost').reset_index(drop = True).rename_axis('Start')
+    spread = starts.loc[starts.success, unknowns].describe().T
+    return starts.iloc[0], starts, spread
@@ -0,0 +1,339 @@
+"""
+Networks of reactors simulated as one coupled system.
+
+Every unit is a model from rms/models. Streams connect the states of a unit to the inlet parameters of another,
+e.g. two jckantor_complex reactors in series with a recycle of 20 L/min from the second one:
+
+    fs = Flowsheet()
+    fs.add_unit('R1', Model('models/jckantor_complex'), flow = 'q')            # fresh feed of q = 100 L/min
+    fs.add_unit('R2', Model('models/jckantor_complex'), flow = 'q', q = 0)     # no fresh feed
+    fs.connect('R1', 'R2', {'Cf': 'C', 'Tf': 'T'}, flow = 'q')                  # all the outlet of R1
+    fs.connect('R2', 'R1', {'Cf': 'C', 'Tf': 'T'}, flow = 20)
+    data = fs.run()
+
+The inlet of a unit with a flow parameter is its fresh feed mixed with the streams entering it, and its flow is
+the sum of them: 120 L/min through both reactors here, of which 100 L/min leave R2.
+
+Units of the same model are stacked, so rhs is called once per model and not once per unit.
+"""
+from engine import Model, Vars, make_bioprocess_model, rhs_batch
+from scipy.integrate import solve_ivp
+from scipy import sparse
+import pandas as pd
+import numpy as np
+import os
+
+class Flowsheet():
+    """
+    Couples several models through stream connections into a single ODE system,
+    integrated with a shared implicit solver and a sparse block Jacobian.
+    Subroutines are not run and inputs are evaluated at the initial time.
+    """
+    def __init__(self):
+        self.units = {}
+        self.connections = []
+        # same settings as Simulator
+        self.simvars = Vars(os.path.dirname(os.path.abspath(__file__)), 'simulator_vars.csv')
+        self._system = None
+
+    def add_unit(self, name:str, model: Model, flow = None, **values):
+        """
+        Adds a unit to the flowsheet
+
+        Arguments
+        ---------
+            name : str
+                Unique name of the unit
+            model : Model
+                Model of the unit
+
+        Keyword Arguments
+        -----------------
+            flow : str
+                Parameter with the flow through the unit, e.g. "q". Its value is the fresh feed of the unit, at the inlet
+                values of the unit, and the streams entering the unit are mixed with it and add to its flow.
+                Defaults to None: the unit has no fresh feed when connected, and its connected inlets are the average
+                of the streams weighted by their flow.
+            **values :
+                Values of the parameters, manipulated variables or initial conditions of this unit, e.g. T0 = 360
+
+        Raises
+        ------
+            KeyError
+                If the name is already used or a value refers to an unknown variable.
+        """
+        if name in self.units:
+            raise KeyError('Unit {} already exists'.format(name))
+        t0 = float(self.simvars.current.loc['Ti','Value'])
+        parameters = {k: v for k, v in model.get_vars_dict(t0).items()}
+        state = model.get_state_dict(t0)
+        unknown = [k for k in values if k not in parameters] + ([flow] if flow is not None and flow not in parameters else [])
+        if unknown:
+            raise KeyError('Unknown variables {} for unit {}'.format(unknown, name))
+        parameters.update(values)
+        self.units[name] = {
+            'model': model,
+            'flow': flow,
+            'parameters': parameters,
+            'states': list(state.keys()),
+            'initial_values': [float(parameters[k+'0']) if k+'0' in parameters else float(v) for k, v in state.items()],
+        }
+        self._system = None
+
+    def connect(self, source:str, target:str, streams:dict, flow = None):
+        """
+        Connects the outlet of a unit to the inlet of another.
+        When several connections, and the fresh feed of the target, feed the same inlet parameter,
+        the inlet is their average weighted by flow.
+
+        Arguments
+        ---------
+            source : str
+                Name of the unit the stream leaves
+            target : str
+                Name of the unit the stream enters
+            streams : dict
+                Inlet parameters of the target and the states of the source they take, e.g. {'Cf': 'C', 'Tf': 'T'}
+
+        Keyword Arguments
+        -----------------
+            flow : str or float
+                Flow of the stream, used to mix streams. Either a number or the name of a source parameter;
+                the flow parameter of the source is its total flow, see `add_unit`. Defaults to 1.
+
+        Raises
+        ------
+            KeyError
+                If a unit, state or parameter does not exist.
+        """
+        for unit in [source, target]:
+            if unit not in self.units:
+                raise KeyError('Unknown unit {}'.format(unit))
+        unknown = [k for k, v in streams.items() if k not in self.units[target]['parameters'] or v not in self.units[source]['states']]
+        if isinstance(flow, str) and flow not in self.units[source]['parameters']:
+            unknown.append(flow)
+        if unknown:
+            raise KeyError('Unknown variables {} in connection {} -> {}'.format(unknown, source, target))
+        self.connections.append({'source': source, 'target': target, 'streams': dict(streams), 'flow': flow})
+        self._system = None
+
+    def _build(self):
+        """
+        Groups the units by model and precomputes the flows, the stacked parameters, state indices and mixing matrices
+        """
+        names = list(self.units)
+        flows = self._flows()
+        offsets = np.cumsum([0] + [len(self.units[u]['states']) for u in names])
+        offset = dict(zip(names, offsets[:-1]))
+        N = offsets[-1]
+
+        groups = {}
+        for u in names:
+            groups.setdefault(os.path.abspath(self.units[u]['model'].path), []).append(u)
+
+        system = {'groups': [], 'N': N, 'names': names, 'offset': offset, 'flows': flows,
+                  'y0': np.concatenate([self.units[u]['initial_values'] for u in names]) if names else np.array([])}
+        for members in groups.values():
+            first = self.units[members[0]]
+            n, k = len(first['states']), len(members)
+            group = {
+                'members': members,
+                'model_class': first['model'].model_class,
+                'parameters': {p: np.array([flows[u] if p == self.units[u]['flow'] else self.units[u]['parameters'][p] for u in members], dtype = float)
+                               for p in first['parameters']},
+                # global index of every state of every unit, with shape (states, units)
+                'index': np.array([offset[u] + np.arange(n) for u in members]).T,
+                'inlets': {},
+            }
+
+            # inlet parameter = M @ y + fresh feed, for the units where it is connected
+            for p in first['parameters']:
+                rows, cols, weights, fresh = [], [], [], {}
+                for r, u in enumerate(members):
+                    incoming = [c for c in self.connections if c['target'] == u and p in c['streams']]
+                    if not incoming:
+                        continue
+                    stream_flows = np.array([self._flow(c, flows) for c in incoming])
+                    unit = self.units[u]
+                    own = float(unit['parameters'][unit['flow']]) if unit['flow'] else 0.
+                    total = own + stream_flows.sum()
+                    if total <= 0:
+                        continue
+                    fresh[r] = own*float(unit['parameters'][p])/total
+                    for c, f in zip(incoming, stream_flows):
+                        rows.append(r)
+                        cols.append(offset[c['source']] + self.units[c['source']]['states'].index(c['streams'][p]))
+                        weights.append(f/total)
+                if rows:
+                    connected = np.unique(rows)
+                    M = sparse.csr_matrix((weights, (np.searchsorted(connected, rows), cols)), shape = (len(connected), N))
+                    group['inlets'][p] = (connected, M, np.array([fresh[r] for r in connected]))
+            system['groups'].append(group)
+        self._system = system
+        return system
+
+    def _flows(self):
+        """
+        Returns the total flow through every unit with a flow parameter: its fresh feed plus the streams entering it.
+        With recycles, the flows depend on each other and are solved together.
+
+        Raises
+        ------
+            ValueError
+                If the flows have no solution, e.g. a loop without fresh feed or outlet, or more flow leaves a unit than enters it.
+        """
+        names = [u for u in self.units if self.units[u]['flow']]
+        index = {u: i for i, u in enumerate(names)}
+        A = np.eye(len(names))
+        b = np.array([float(self.units[u]['parameters'][self.units[u]['flow']]) for u in names])
+        for c in self.connections:
+            if c['target'] not in index:
+                continue
+            source = self.units[c['source']]
+            if c['flow'] is not None and c['flow'] == source['flow']:
+                A[index[c['target']], index[c['source']]] -= 1
+            else:
+                b[index[c['target']]] += self._flow(c, {})
+        try:
+            flows = dict(zip(names, np.linalg.solve(A, b))) if names else {}
+        except np.linalg.LinAlgError:
+            raise ValueError('The flows of the flowsheet have no solution, check the loops for a fresh feed and an outlet.')
+
+        for u in names:
+            leaving = sum(self._flow(c, flows) for c in self.connections if c['source'] == u)
+            if flows[u] < 0 or leaving > flows[u]*(1 + 1e-9) + 1e-12:
+                raise ValueError('{} of flow leaves unit {} through its connections, but {} enters it.'.format(leaving, u, flows[u]))
+        return flows
+
+    def _flow(self, connection, flows):
+        """
+        Flow of a connection, given the total flows of the units
+        """
+        flow = connection['flow']
+        if flow is None:
+            return 1.
+        if isinstance(flow, str):
+            source = connection['source']
+            if flow == self.units[source]['flow'] and source in flows:
+                return float(flows[source])
+            return float(self.units[source]['parameters'][flow])
+        return float(flow)
+
+    def _group_model(self, group, y):
+        """
+        Model instance holding the stacked parameters of a group, with the inlets taken from y
+        """
+        parameters = dict(group['parameters'])
+        for p, (connected, M, fresh) in group['inlets'].items():
+            parameters[p] = parameters[p].copy()
+            parameters[p][connected] = M @ y + fresh
+        return make_bioprocess_model(group['model_class'], parameters)
+
+    def rhs(self, t, y):
+        """
+        Right-hand side of the coupled system
+
+        Arguments
+        ---------
+            t : float
+                Current time
+            y : np.ndarray
+                States of all the units, stacked in the order they were added
+        """
+        system = self._system or self._build()
+        dydt = np.empty(system['N'])
+        for group in system['groups']:
+            bioprocess_model = self._group_model(group, y)
+            dydt[group['index']] = rhs_batch(bioprocess_model, t, y[group['index']])
+        return dydt
+
+    def jacobian(self, t, y, rel_h = 1e-6):
+        """
+        Sparse Jacobian of the coupled system. The diagonal blocks are the Jacobians of every unit
+        and the off-diagonal blocks come from the inlets, through the derivatives of rhs with respect to them.
+        Derivatives are evaluated for all the units of a model at once, by finite differences.
+
+        Arguments
+        ---------
+            t : float
+                Current time
+            y : np.ndarray
+                States of all the units
+
+        Keyword Arguments
+        -----------------
+            rel_h : float
+                Relative finite difference step. Defaults to 1e-6.
+        """
+        system = self._system or self._build()
+        N = system['N']
+        rows, cols, data = [], [], []
+        coupling = sparse.csr_matrix((N, N))
+        for group in system['groups']:
+            bioprocess_model = self._group_model(group, y)
+            index = group['index']
+            Y = y[index]
+            n, k = Y.shape
+
+            # diagonal blocks, one state perturbed in all units at once
+            h = rel_h*np.maximum(np.abs(Y), 1.)
+            perturbed = np.repeat(Y[None], 2*n, axis = 0)
+            for s in range(n):
+                perturbed[s, s] += h[s]
+                perturbed[n+s, s] -= h[s]
+            tiled = make_bioprocess_model(group['model_class'], {p: np.tile(v, 2*n) for p, v in bioprocess_model.model_parameters.items()})
+            f = rhs_batch(tiled, t, np.hstack(list(perturbed))).reshape(n, 2*n, k)
+            J = (f[:,:n] - f[:,n:])/(2*h[None])
+            rows.append(np.broadcast_to(index[:,None,:], J.shape).ravel())
+            cols.append(np.broadcast_to(index[None,:,:], J.shape).ravel())
+            data.append(J.ravel())
+
+            # off-diagonal blocks, through the inlet parameters
+            for p, (connected, M, _) in group['inlets'].items():
+                value = bioprocess_model.model_parameters[p]
+                hp = rel_h*np.maximum(np.abs(value), 1.)
+                bioprocess_model.model_parameters[p] = value + hp
+                fp = rhs_batch(bioprocess_model, t, Y)
+                bioprocess_model.model_parameters[p] = value - hp
+                fm = rhs_batch(bioprocess_model, t, Y)
+                bioprocess_model.model_parameters[p] = value
+                dfdp = ((fp - fm)/(2*hp))[:, connected]
+                for s in range(n):
+                    select = sparse.csr_matrix((dfdp[s], (index[s, connected], np.arange(len(connected)))), shape = (N, len(connected)))
+                    coupling = coupling + select @ M
+
+        J = sparse.csr_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))), shape = (N, N)) if data else sparse.csr_matrix((N, N))
+        return (J + coupling).tocsc()
+
+    @property
+    def time(self):
+        """
+        Time grid, from the simulator variables
+        """
+        ti = float(self.simvars.current.loc['Ti','Value'])
+        tf = float(self.simvars.current.loc['Tf','Value'])
+        n = int(self.simvars.current.loc['n','Value'])
+        return np.linspace(ti, tf, n)
+
+    def run(self, method = 'BDF', **kwds):
+        """
+        Integrates all the units together over the simulation time.
+        Returns a DataFrame indexed by time, with (unit, state) columns.
+
+        Keyword Arguments
+        -----------------
+            method : str
+                Integration method of `scipy.integrate.solve_ivp`. Defaults to "BDF".
+            **kwds :
+                Passed on to `scipy.integrate.solve_ivp`.
+        """
+        system = self._build()
+        time = self.time
+        if method in ['BDF', 'Radau']:
+            kwds.setdefault('jac', self.jacobian)
+        sol = solve_ivp(self.rhs, (time[0], time[-1]), system['y0'], method = method, t_eval = time, **kwds)
+        if not sol.success:
+            raise RuntimeError('Flowsheet integration failed: {}'.format(sol.message))
+
+        columns = pd.MultiIndex.from_tuples([(u, s) for u in system['names'] for s in self.units[u]['states']], names = ['Unit', 'Var'])
+        return pd.DataFrame(sol.y.T, index = sol.t, columns = columns)
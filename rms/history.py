@@ -0,0 +1,249 @@
+"""
+Local store of past runs, to compare against them without running them again.
+
+Metadata (model, input values, integrator, timings and a hash of the inputs) is kept in a SQLite database,
+with an index on the input values, and every trajectory in its own columnar file next to it:
+
+    history = RunHistory('runs')
+    mysim.reinitialize()
+    data = mysim.run()
+    history.save(mysim, data)
+
+    runs = history.find('jckantor_complex', UA = (4e4, 5e4))
+    overlay = history.load(runs.index, variables = ['T', 'qc'])
+"""
+from engine import Simulator, read_timeseries, write_timeseries
+import pandas as pd
+import numbers
+import hashlib
+import sqlite3
+import time
+import json
+import os
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    model TEXT NOT NULL,
+    created REAL NOT NULL,
+    integrator TEXT,
+    wall_time_s REAL,
+    n_steps INTEGER,
+    hash TEXT,
+    file TEXT,
+    note TEXT
+);
+CREATE TABLE IF NOT EXISTS run_values (
+    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    tbl TEXT NOT NULL,
+    var TEXT NOT NULL,
+    value REAL,
+    text TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_runs_model ON runs(model, created);
+CREATE INDEX IF NOT EXISTS idx_runs_hash ON runs(hash);
+CREATE INDEX IF NOT EXISTS idx_values_var ON run_values(var, value, run_id);
+CREATE INDEX IF NOT EXISTS idx_values_run ON run_values(run_id);
+"""
+
+def input_values(simulator: Simulator):
+    """
+    Returns the input values of a simulator, i.e. the values applied by `reinitialize`, as (table, variable, value) tuples
+
+    Arguments
+    ---------
+        simulator : Simulator
+    """
+    tables = [('params', simulator.model.params), ('mvars', simulator.model.mvars), ('simvars', simulator.simvars)]
+    if simulator.subroutines:
+        tables.append(('subrvars', simulator.subroutines.subrvars))
+    return [(name, var, value) for name, table in tables for var, value in table.from_input['Value'].items()]
+
+def inputs_hash(model_name, values):
+    """
+    Hash of the model and its input values. Runs with the same hash have the same inputs.
+    Numbers are compared to 12 significant digits, so 100, 100.0 and "100" hash the same.
+
+    Arguments
+    ---------
+        model_name : str
+        values : list
+            (table, variable, value) tuples, see `input_values`
+    """
+    def normalized(x):
+        number, text = _value_columns(x)
+        return text if number is None else '{:.12g}'.format(number)
+    text = json.dumps([model_name] + sorted([t, v, normalized(x)] for t, v, x in values))
+    return hashlib.sha1(text.encode()).hexdigest()
+
+def _value_columns(x):
+    """
+    Splits a value into its numeric and text columns. Numbers, also written as text, are stored as numbers.
+    """
+    if isinstance(x, numbers.Number):
+        return float(x), None
+    try:
+        return float(x), None
+    except (TypeError, ValueError):
+        return None, repr(x) if callable(x) else str(x)
+
+class RunHistory():
+    """
+    Indexed store of past runs: metadata and input values in SQLite, trajectories in columnar files
+    """
+    def __init__(self, path = 'runs', fmt = 'parquet', max_runs = None):
+        """
+        Keyword Arguments
+        -----------------
+            path :
+                Directory of the store, created if needed. Defaults to "runs".
+            fmt : str
+                File format of the trajectories, "parquet" (needs pyarrow) or "csv". Defaults to "parquet".
+            max_runs : int
+                Number of runs kept, the oldest ones are deleted when a new run is saved. Defaults to None, no limit.
+        """
+        self.path = path
+        self.fmt = fmt
+        self.max_runs = max_runs
+        os.makedirs(path, exist_ok = True)
+        self._connection = sqlite3.connect(os.path.join(path, 'history.db'), check_same_thread = False)
+        self._connection.execute('PRAGMA foreign_keys = ON')
+        self._connection.executescript(SCHEMA)
+
+    def save(self, simulator: Simulator, data: pd.DataFrame, wall_time_s = None, note = ''):
+        """
+        Stores a run and returns its id
+
+        Arguments
+        ---------
+            simulator : Simulator
+                Simulator of the run, with the inputs used
+            data : pd.DataFrame
+                Result of the run, indexed by time
+
+        Keyword Arguments
+        -----------------
+            wall_time_s : float
+                Duration of the run. Defaults to None.
+            note : str
+                Free text. Defaults to "".
+        """
+        model_name = os.path.basename(os.path.normpath(simulator.model.path))
+        values = input_values(simulator)
+        with self._connection as c:
+            run_id = c.execute('INSERT INTO runs (model, created, integrator, wall_time_s, n_steps, hash, note) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (model_name, time.time(), str(simulator.integrator), wall_time_s, len(data), inputs_hash(model_name, values), note)).lastrowid
+            c.executemany('INSERT INTO run_values (run_id, tbl, var, value, text) VALUES (?, ?, ?, ?, ?)',
+                          [(run_id, t, v, *_value_columns(x)) for t, v, x in values])
+            file = '{:06d}.{}'.format(run_id, self.fmt)
+            write_timeseries(data, os.path.join(self.path, file))
+            c.execute('UPDATE runs SET file = ? WHERE id = ?', (file, run_id))
+        if self.max_runs is not None:
+            self.prune(self.max_runs)
+        return run_id
+
+    def prune(self, max_runs):
+        """
+        Deletes the oldest runs, keeping the latest max_runs. Returns the ids of the deleted runs.
+
+        Arguments
+        ---------
+            max_runs : int
+                Number of runs kept
+        """
+        old = [row[0] for row in self._connection.execute('SELECT id FROM runs ORDER BY created DESC, id DESC LIMIT -1 OFFSET ?', (int(max_runs),))]
+        for run_id in old:
+            self.delete(run_id)
+        return old
+
+    def find(self, model = None, since = None, until = None, hash = None, **ranges):
+        """
+        Returns the metadata of the runs matching all the conditions, indexed by run id, oldest first
+
+        Keyword Arguments
+        -----------------
+            model : str
+                Name of the model. Defaults to None, any model.
+            since : float
+                Only runs created at or after this unix time. Defaults to None.
+            until : float
+                Only runs created at or before this unix time. Defaults to None.
+            hash : str
+                Only runs with these inputs, see `inputs_hash`. Defaults to None.
+            **ranges :
+                Input values, either a value or a (low, high) tuple where None is open,
+                e.g. UA = (4e4, 5e4). A name shared by several tables, e.g. Tf, matches any of them.
+        """
+        query, args = ['SELECT * FROM runs WHERE 1'], []
+        for column, op, value in [('model', '=', model), ('created', '>=', since), ('created', '<=', until), ('hash', '=', hash)]:
+            if value is not None:
+                query.append('AND {} {} ?'.format(column, op))
+                args.append(value)
+        for var, value in ranges.items():
+            low, high = value if isinstance(value, tuple) else (value, value)
+            query.append('AND id IN (SELECT run_id FROM run_values WHERE var = ?')
+            args.append(var)
+            if low is not None:
+                query.append('AND value >= ?')
+                args.append(float(low))
+            if high is not None:
+                query.append('AND value <= ?')
+                args.append(float(high))
+            query.append(')')
+        query.append('ORDER BY created, id')
+        return pd.read_sql_query(' '.join(query), self._connection, params = args, index_col = 'id')
+
+    def values(self, run_id):
+        """
+        Returns the input values of a run, indexed by table and variable
+        """
+        df = pd.read_sql_query('SELECT tbl, var, value, text FROM run_values WHERE run_id = ?', self._connection, params = [int(run_id)])
+        return df.assign(value = df.value.astype(object).where(df.text.isna(), df.text)).set_index(['tbl', 'var'])['value']
+
+    def load(self, run_ids, variables = None):
+        """
+        Loads the trajectories of some runs, reading only the requested variables.
+        Returns a dictionary of DataFrames indexed by time, one per run id.
+
+        Arguments
+        ---------
+            run_ids : list
+                Ids of the runs
+
+        Keyword Arguments
+        -----------------
+            variables : list
+                Variables to load. Defaults to None, all of them.
+        """
+        run_ids = [int(i) for i in run_ids]
+        if not run_ids:
+            return {}
+        files = dict(self._connection.execute('SELECT id, file FROM runs WHERE id IN ({})'.format(','.join('?'*len(run_ids))), run_ids).fetchall())
+        result = {}
+        for run_id in run_ids:
+            path = os.path.join(self.path, files[run_id])
+            if variables is None:
+                result[run_id] = read_timeseries(path)
+            elif path.endswith('.csv'):
+                result[run_id] = pd.read_csv(path, usecols = lambda c: c == 'Time' or c in variables).set_index('Time').astype(float)
+            else:
+                result[run_id] = pd.read_parquet(path, columns = ['Time', *variables]).set_index('Time').astype(float)
+        return result
+
+    def delete(self, run_id):
+        """
+        Removes a run and its trajectory
+        """
+        row = self._connection.execute('SELECT file FROM runs WHERE id = ?', (int(run_id),)).fetchone()
+        if row is None:
+            raise KeyError('Unknown run {}'.format(run_id))
+        with self._connection as c:
+            c.execute('DELETE FROM runs WHERE id = ?', (int(run_id),))
+        if row[0] and os.path.isfile(os.path.join(self.path, row[0])):
+            os.remove(os.path.join(self.path, row[0]))
+
+    def close(self):
+        """
+        Closes the database
+        """
+        self._connection.close()
@@ -45,6 +45,30 @@ class MyModel(BioprocessModel):
         # The order corresponds to the state vector.
         return [dCdt, dTdt, dTcdt]
 
+    def jacobian(self, t, y):
+        """
+        Optional. Analytical Jacobian of rhs with respect to the states, used for sensitivities and linearizations.
+        """
+        C,T,Tc = y
+
+        q = self.model_parameters['q']
+        qc = self.model_parameters['qc']
+        Vc = self.model_parameters['Vc']
+        V = self.model_parameters['V']
+        rho = self.model_parameters['rho']
+        Cp = self.model_parameters['Cp']
+        dHr = self.model_parameters['dHr']
+        UA = self.model_parameters['UA']
+        Ea = self.model_parameters['Ea']
+        R = self.model_parameters['R']
+
+        k = self.k(T)
+        dkdT = k*Ea/R/T**2
+
+        return [[-q/V - k, -dkdT*C, 0],
+                [(-dHr/rho/Cp)*k, -q/V + (-dHr/rho/Cp)*dkdT*C - UA/V/rho/Cp, UA/V/rho/Cp],
+                [0, UA/Vc/rho/Cp, -qc/Vc - UA/Vc/rho/Cp]]
+
     ###############################################
     """
     Other methods can also be defined
@@ -63,6 +87,7 @@ class MySubroutines(Subroutine):
     Defines the subroutine class. Always named MySubroutines. Always inherits from Subroutine.
 
     The Subroutine class runs all its NOT underscored functions before iterating at every time step.
+    Decorate a function with @periodic(period, phase) from engine to run it at its own sample period instead.
     """
     def _initialization(self):
         '''
@@ -23,6 +23,23 @@ class MyModel(BioprocessModel):
         # The order corresponds to the state vector.
         return [dPdt,dSdt,dVdt,dXdt]
     
+    # Optional analytical Jacobian of rhs with respect to the states
+    def jacobian(self, t, y):
+        P,S,V,X = y
+
+        Yxs = self.model_parameters['Yxs']
+        Ypx = self.model_parameters['Ypx']
+        Sf = self.model_parameters['Sf']
+        F = self.model_parameters['F']
+
+        mu = self.mu(S)
+        dmudS = self.model_parameters['mu_max']*self.model_parameters['Ks']/(self.model_parameters['Ks'] + S)**2
+
+        return [[-F/V, Ypx*dmudS*X, F*P/V**2, Ypx*mu],
+                [0, -F/V - dmudS*X/Yxs, -F*(Sf-S)/V**2, -mu/Yxs],
+                [0, 0, 0, 0],
+                [0, dmudS*X, F*X/V**2, -F/V + mu]]
+
     # Monoid expression
     def mu(self,S):
         mu_max = self.model_parameters['mu_max']
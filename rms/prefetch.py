@@ -0,0 +1,297 @@
+"""
+Speculative runs of the scenarios a user is likely to ask for next, in idle worker processes.
+
+Users nudge a slider one step at a time and run the simulation after every nudge. After each run, the prefetcher
+queues the current inputs with the recently touched variables one slider step up and down, and runs them
+in the background while the workers are idle. Results go into a bounded cache, keyed by the hash of the inputs
+(see `history.inputs_hash`), so the next run is usually a cache hit:
+
+    cache = ResultCache(max_bytes = 200*2**20)
+    prefetcher = Prefetcher('models/jckantor_complex', cache, workers = 2)
+    prefetcher.touch('q', 3.)
+
+    data = prefetcher.result(key)               # cached, or waits for a prefetch already running
+    if data is None:
+        data = mysim.run()
+        cache.put(key, data)
+    prefetcher.schedule(input_values(mysim))   # cancels the queued runs that are no longer neighbours
+
+Only the queued runs are cancelled; at most one run per worker is in progress at a time.
+"""
+from engine import Simulator
+from history import inputs_hash
+from uncertainty import _get_model
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
+import pandas as pd
+import numbers
+import threading
+import os
+
+class ResultCache():
+    """
+    Least recently used results of simulations, bounded in number and in memory
+    """
+    def __init__(self, max_entries = 64, max_bytes = 256*2**20):
+        """
+        Keyword Arguments
+        -----------------
+            max_entries : int
+                Maximum number of results. Defaults to 64.
+            max_bytes : int
+                Maximum memory of the results, in bytes. Defaults to 256 MB.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Returns the result stored under a key, or None
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key][0]
+
+    def put(self, key, data: pd.DataFrame):
+        """
+        Stores a result, evicting the least recently used ones beyond the budget.
+        Results larger than the whole budget are not stored.
+
+        Arguments
+        ---------
+            key : str
+                Hash of the inputs of the run
+            data : pd.DataFrame
+                Result of the run
+        """
+        nbytes = int(data.memory_usage(index = True, deep = True).sum())
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (data, nbytes)
+            self.nbytes += nbytes
+            while len(self._entries) > self.max_entries or self.nbytes > self.max_bytes:
+                self.nbytes -= self._entries.popitem(last = False)[1][1]
+
+    def stats(self):
+        """
+        Returns the number of results, their memory, hits, misses and hit rate
+        """
+        lookups = self.hits + self.misses
+        return {'entries': len(self._entries), 'bytes': self.nbytes, 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits/lookups if lookups else 0.}
+
+# one simulator per model and process, so models are imported only once per worker
+_simulators = {}
+
+def _run_inputs(model_path, values):
+    """
+    Runs a model with the given input values, see `history.input_values`, and returns its result
+    """
+    if model_path not in _simulators:
+        _simulators[model_path] = Simulator(model = _get_model(model_path))
+    mysim = _simulators[model_path]
+    tables = {}
+    for table, var, value in values:
+        tables.setdefault(table, {})[var] = value
+    mysim.update_inputs(**tables)
+    mysim.reinitialize()
+    return mysim.run()
+
+class Prefetcher():
+    """
+    Runs the neighbours of the current inputs of a model in background processes, into a ResultCache
+    """
+    def __init__(self, model_path, cache: ResultCache, workers = 1, recent = 2, bounds = None):
+        """
+        Arguments
+        ---------
+            model_path :
+                Path poiting to a specific model directory.
+            cache : ResultCache
+                Where the results are stored
+
+        Keyword Arguments
+        -----------------
+            workers : int
+                Number of worker processes, i.e. of runs in progress at a time. Defaults to 1.
+            recent : int
+                Number of recently touched variables whose neighbours are run. Defaults to 2.
+            bounds : dict
+                (min, max) of the variables, neighbours outside them are not run. Defaults to None.
+        """
+        self.model_path = os.path.abspath(model_path)
+        self.model_name = os.path.basename(os.path.normpath(model_path))
+        self.cache = cache
+        self.workers = workers
+        self.recent = recent
+        self.bounds = dict(bounds or {})
+        self.steps = OrderedDict()
+        self.prefetched = 0
+        self.cancelled = 0
+        self._queue = []
+        self._running = {}
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def key(self, values):
+        """
+        Cache key of a run with these inputs, see `history.inputs_hash`
+
+        Arguments
+        ---------
+            values : list
+                (table, variable, value) tuples, see `history.input_values`
+        """
+        return inputs_hash(self.model_name, values)
+
+    def touch(self, var, step):
+        """
+        Records that the user moved a variable, with the step of its slider. The most recent ones are prefetched.
+
+        Arguments
+        ---------
+            var : str
+                Name of the variable
+            step : float
+                Step of its slider
+        """
+        with self._lock:
+            self.steps.pop(var, None)
+            self.steps[var] = float(step)
+            while len(self.steps) > self.recent:
+                self.steps.popitem(last = False)
+
+    def neighbours(self, values):
+        """
+        Returns the inputs one step up and down of the recently touched variables, most recent first,
+        as a list of (key, values)
+
+        Arguments
+        ---------
+            values : list
+                Current (table, variable, value) tuples, see `history.input_values`
+        """
+        result = []
+        for var, step in reversed(list(self.steps.items())):
+            for sign in [1, -1]:
+                new, found = [], False
+                for table, v, x in values:
+                    if v == var and table in ['mvars', 'subrvars', 'params'] and isinstance(x, numbers.Number) and not isinstance(x, bool):
+                        x, found = x + sign*step, True
+                        low, high = self.bounds.get(var, (None, None))
+                        if (low is not None and x < low) or (high is not None and x > high):
+                            found = False
+                    new.append((table, v, x))
+                if found:
+                    result.append((self.key(new), new))
+        return result
+
+    def schedule(self, values):
+        """
+        Replaces the queue with the neighbours of the current inputs that are not cached or running yet,
+        cancelling the queued runs that are no longer neighbours, and starts them on the idle workers.
+        Inputs that cannot be sent to a worker process, e.g. profiles, are not prefetched.
+
+        Arguments
+        ---------
+            values : list
+                Current (table, variable, value) tuples, see `history.input_values`
+        """
+        if any(callable(x) for _, _, x in values):
+            queue = []
+        else:
+            queue = [(k, v) for k, v in self.neighbours(values) if k not in self.cache]
+        with self._lock:
+            keys = {k for k, _ in queue}
+            self.cancelled += sum(1 for k, _ in self._queue if k not in keys)
+            self._queue = [(k, v) for k, v in queue if k not in self._running]
+        self._pump()
+
+    def cancel(self):
+        """
+        Empties the queue. Runs in progress finish into the cache.
+        """
+        with self._lock:
+            self.cancelled += len(self._queue)
+            self._queue = []
+
+    def _pump(self):
+        """
+        Starts queued runs while there are idle workers
+        """
+        with self._lock:
+            while self._queue and len(self._running) < self.workers:
+                key, values = self._queue.pop(0)
+                if self._pool is None:
+                    self._pool = ProcessPoolExecutor(max_workers = self.workers)
+                future = self._pool.submit(_run_inputs, self.model_path, values)
+                self._running[key] = future
+                future.add_done_callback(lambda f, key = key: self._done(key, f))
+
+    def _done(self, key, future):
+        """
+        Stores the result of a finished run and starts the next one
+        """
+        if not future.cancelled() and future.exception() is None:
+            self.cache.put(key, future.result())
+            self.prefetched += 1
+        with self._lock:
+            self._running.pop(key, None)
+        self._pump()
+
+    def result(self, key, timeout = None):
+        """
+        Returns the result of a run from the cache, waiting for it if it is being prefetched, or None
+
+        Arguments
+        ---------
+            key : str
+                Cache key of the run, see `key`
+
+        Keyword Arguments
+        -----------------
+            timeout : float
+                Seconds to wait for a run in progress. Defaults to None, no limit.
+        """
+        data = self.cache.get(key)
+        if data is not None:
+            return data
+        with self._lock:
+            future = self._running.get(key)
+        if future is None:
+            return None
+        try:
+            data = future.result(timeout = timeout)
+        except Exception:
+            return None
+        self.cache.put(key, data)
+        return data
+
+    def close(self):
+        """
+        Cancels the queue and stops the workers, without waiting for the runs in progress
+        """
+        self.cancel()
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait = False, cancel_futures = True)
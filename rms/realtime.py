@@ -0,0 +1,329 @@
+"""
+Soft real-time mode for operator training.
+
+Every trainee drives a session: a copy of a model and its subroutines advancing in simulation time as the wall clock ticks.
+All the sessions are advanced together, one integration per model and session time per tick, with the states of the sessions
+stacked and the parameters passed as arrays to the vectorized rhs. Inputs from the trainees are queued and applied between ticks.
+As in Simulator, subroutine methods with a period (see `engine.periodic`) only run when due, inputs that are functions
+of time are evaluated at every tick and profiles are followed during the integration.
+
+    scheduler = RealtimeScheduler(tick = 0.5, speed = 2)
+    for trainee in ['ana', 'ben']:
+        scheduler.add_session(trainee, 'jckantor_complex')
+    scheduler.start()
+    scheduler.set_inputs('ana', {'Tsp': 380})
+    ...
+    scheduler.stop()
+    print(scheduler.metrics())
+"""
+from engine import Model, Vars, Recorder, Profile, make_bioprocess_model, rhs_batch, result_dtype
+from scipy.integrate import odeint
+import numpy as np
+import threading
+import time
+import os
+
+MODELS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')
+
+class Session():
+    """
+    State of a single trainee: current time, states, inputs and subroutines, kept in plain dictionaries
+    so that a tick does not touch the variable tables
+    """
+    def __init__(self, session_id, model: Model, scheduler, recording = None):
+        """
+        Arguments
+        ---------
+            session_id :
+                Unique id of the session
+            model : Model
+                Model of the session, copied so sessions are independent
+            scheduler : RealtimeScheduler
+                Scheduler running the session
+
+        Keyword Arguments
+        -----------------
+            recording : Recorder
+                Recording policy of the session trajectory. Defaults to None, which logs everything in memory.
+        """
+        self.session_id = session_id
+        self.model = model.copy()
+        self.model.reset()
+        self.t = float(scheduler.simvars.current.loc['Ti','Value'])
+        self.step = 0
+        self.parameters = self.model.get_vars_dict(self.t)
+        self.state = self.model.get_state_dict(self.t)
+        self.states = list(self.state.keys())
+        # subroutines read the simulator variables from the scheduler, as from a Simulator
+        self.subroutines = self.model.subroutine_class(self.model, scheduler) if self.model.subroutine_class else None
+        self.subroutine_vars = self.subroutines.subrvars.get_all_vars_dict(self.t) if self.subroutines else {}
+        self.recorder = Recorder(dtype = result_dtype(scheduler.simvars)) if recording is None else recording
+        self.recorder._start([*self.parameters, *self.states, *self.subroutine_vars])
+        self._pending = {}
+        self._previous_t = None
+
+        # inputs that depend on time: functions are evaluated at every tick, profiles also during the integration
+        tables = [self.model.params, self.model.mvars] + ([self.subroutines.subrvars] if self.subroutines else [])
+        inputs = {k: v for table in tables for k, v in table.default.Value.items()
+                  if callable(v) and (k in self.parameters or k in self.subroutine_vars)}
+        self.profiles = {k: v for k, v in inputs.items() if isinstance(v, Profile) and k in self.parameters}
+        self.functions = {k: v for k, v in inputs.items() if k not in self.profiles}
+
+    def _eval_inputs(self):
+        """
+        Evaluates the inputs that depend on time at the current time of the session
+        """
+        for k, fun in {**self.functions, **self.profiles}.items():
+            if k in self.parameters:
+                self.parameters[k] = fun(self.t)
+            else:
+                self.subroutine_vars[k] = fun(self.t)
+
+    def _apply_inputs(self, pending:dict):
+        """
+        Applies the inputs queued since the last tick. They replace any function of time or profile of the variable.
+        """
+        for k, value in pending.items():
+            self.functions.pop(k, None)
+            self.profiles.pop(k, None)
+            if k in self.parameters:
+                self.parameters[k] = value
+            else:
+                self.subroutine_vars[k] = value
+
+    def _run_subroutines(self, dt):
+        """
+        Runs the subroutine methods that are due on the dictionaries of the session
+        """
+        if not self.subroutines:
+            return
+        # methods with a period run at the first tick at or after each of their sample times
+        times = [self.t] if self._previous_t is None else [self._previous_t, self.t]
+        self._previous_t = self.t
+        methods = [name for name, due in self.subroutines._due(times).items() if due[-1]]
+        if not methods:
+            return
+        subroutines = self.subroutines
+        subroutines.model_parameters = {**self.parameters, **self.state}
+        subroutines.model_state = dict(self.state)
+        subroutines.subroutine_vars = self.subroutine_vars
+        subroutines.simulator_vars = {**subroutines.simulator_vars, 'dt': dt}
+        subroutines._execute(self.t, methods)
+        for k in self.parameters:
+            self.parameters[k] = subroutines.model_parameters[k]
+
+    def history(self):
+        """
+        Returns the recorded trajectory of the session, indexed by time
+        """
+        return self.recorder.to_frame()
+
+class RealtimeScheduler():
+    """
+    Advances all the active sessions together on a wall-clock tick, and keeps track of the ticks that overrun
+    """
+    def __init__(self, tick = 1., speed = 1., models_dir = MODELS_DIR):
+        """
+        Keyword Arguments
+        -----------------
+            tick : float
+                Wall-clock seconds between ticks. Defaults to 1.
+            speed : float
+                Simulation time advanced per wall-clock second. Defaults to 1.
+            models_dir :
+                Directory with the models. Defaults to rms/models.
+        """
+        self.tick = tick
+        self.speed = speed
+        self.models_dir = models_dir
+        # same settings as Simulator, dt is set by the tick
+        self.simvars = Vars(os.path.dirname(os.path.abspath(__file__)), 'simulator_vars.csv')
+        self.simvars.current.loc['dt','Value'] = self.dt
+        self.sessions = {}
+        self._models = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._tick_times = []
+        self._overruns = 0
+        self._lag = 0.
+
+    @property
+    def dt(self):
+        """
+        Simulation time advanced every tick
+        """
+        return self.tick*self.speed
+
+    def add_session(self, session_id, model_name, recording = None):
+        """
+        Adds a session running a model from the models directory. Each model is imported once.
+
+        Arguments
+        ---------
+            session_id :
+                Unique id of the session
+            model_name : str
+                Name of the model directory
+
+        Keyword Arguments
+        -----------------
+            recording : Recorder
+                Recording policy of the session trajectory. Defaults to None.
+
+        Raises
+        ------
+            KeyError
+                If the session already exists.
+        """
+        if model_name not in self._models:
+            self._models[model_name] = Model(os.path.join(self.models_dir, model_name))
+        session = Session(session_id, self._models[model_name], self, recording = recording)
+        with self._lock:
+            if session_id in self.sessions:
+                raise KeyError('Session {} already exists'.format(session_id))
+            self.sessions[session_id] = session
+        return session
+
+    def remove_session(self, session_id):
+        """
+        Removes a session, returning it
+        """
+        with self._lock:
+            return self.sessions.pop(session_id)
+
+    def set_inputs(self, session_id, values:dict):
+        """
+        Queues new input values of a session, applied before the next tick
+
+        Arguments
+        ---------
+            session_id :
+                Id of the session
+            values : dict
+                New values of model parameters, manipulated variables or subroutine variables
+
+        Raises
+        ------
+            KeyError
+                If the session or a variable does not exist.
+        """
+        with self._lock:
+            session = self.sessions[session_id]
+            unknown = [k for k in values if k not in session.parameters and k not in session.subroutine_vars]
+            if unknown:
+                raise KeyError('Unknown variables {}'.format(unknown))
+            session._pending.update(values)
+
+    def step(self):
+        """
+        Advances all the sessions by one tick: applies the queued inputs, runs the subroutines and logs every session,
+        then integrates together the sessions of each model that are at the same time, e.g. not those added later.
+        Returns the compute time of the tick in seconds.
+        """
+        tic = time.perf_counter()
+        with self._lock:
+            sessions = list(self.sessions.values())
+            pending = [s._pending for s in sessions]
+            for s in sessions:
+                s._pending = {}
+
+        groups = {}
+        for session, inputs in zip(sessions, pending):
+            session._eval_inputs()
+            session._apply_inputs(inputs)
+            session._run_subroutines(self.dt)
+            session.recorder.append(session.step, session.t, {**session.parameters, **session.state, **session.subroutine_vars})
+            groups.setdefault((session.model.path, session.t), []).append(session)
+
+        for group in groups.values():
+            self._step_group(group)
+
+        elapsed = time.perf_counter() - tic
+        self._tick_times.append(elapsed)
+        return elapsed
+
+    def _step_group(self, sessions):
+        """
+        Integrates the sessions of one model, all at the same time t, to t + dt in a single solve
+        """
+        states = sessions[0].states
+        t = sessions[0].t
+        parameters = {k: np.array([s.parameters[k] for s in sessions], dtype = float) for k in sessions[0].parameters}
+        Y = np.array([[s.state[k] for s in sessions] for k in states], dtype = float)
+        bioprocess_model = make_bioprocess_model(sessions[0].model.model_class, parameters)
+        profiles = {name: [s.profiles.get(name) for s in sessions] for name in set().union(*(s.profiles for s in sessions))}
+        breakpoints = np.unique(np.concatenate([[], *(p.breakpoints for s in sessions for p in s.profiles.values())]))
+        tcrit = breakpoints[(breakpoints > t) & (breakpoints < t + self.dt)]
+        # the states of each session are contiguous, so the Jacobian is banded
+        n, k = Y.shape
+        def myfun(y, t):
+            for name, session_profiles in profiles.items():
+                bioprocess_model.model_parameters[name] = np.array([p(t) if p else parameters[name][j] for j, p in enumerate(session_profiles)])
+            return rhs_batch(bioprocess_model, t, y.reshape(k, n).T).T.ravel()
+        Y = odeint(myfun, t = np.array([t, t+self.dt]), y0 = Y.T.ravel(), tcrit = tcrit if len(tcrit) else None,
+                   ml = n-1, mu = n-1, mxstep = 5000)[-1]
+        Y = Y.reshape(k, n).T
+        for j, s in enumerate(sessions):
+            s.state = dict(zip(states, Y[:,j]))
+            s.t += self.dt
+            s.step += 1
+
+    def run(self, n_ticks = None):
+        """
+        Runs ticks on the wall clock until `stop` is called or n_ticks have run.
+        A tick that ends after the start of the next one is an overrun; the following ticks start right away
+        so the simulation catches up with the wall clock.
+
+        Keyword Arguments
+        -----------------
+            n_ticks : int
+                Number of ticks to run. Defaults to None, which runs until `stop`.
+        """
+        self._stop.clear()
+        start = time.perf_counter()
+        i = 0
+        while not self._stop.is_set() and (n_ticks is None or i < n_ticks):
+            self.step()
+            i += 1
+            deadline = start + i*self.tick
+            now = time.perf_counter()
+            if now > deadline:
+                self._overruns += 1
+                self._lag = now - deadline
+            else:
+                self._lag = 0.
+                self._stop.wait(deadline - now)
+
+    def start(self):
+        """
+        Runs the ticks in a background thread
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target = self.run, daemon = True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the background thread after the current tick
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def metrics(self):
+        """
+        Returns the tick statistics: number of ticks and overruns, mean and maximum compute time per tick,
+        current lag behind the wall clock and number of sessions
+        """
+        times = np.array(self._tick_times) if self._tick_times else np.zeros(1)
+        return {
+            'ticks': len(self._tick_times),
+            'overruns': self._overruns,
+            'mean_tick_s': float(times.mean()),
+            'max_tick_s': float(times.max()),
+            'lag_s': self._lag,
+            'sessions': len(self.sessions),
+        }
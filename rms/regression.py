@@ -0,0 +1,232 @@
+"""
+Regression checks of the simulation results against reference ("golden") trajectories.
+
+Every case is a json file in rms/goldens with a scenario, as for rms/batch.py, and optionally the tolerances
+of the comparison and the budgets of the run, e.g.
+
+    {
+        "model": "jckantor_complex",
+        "params": {"UA": 40000},
+        "tolerances": {"default": {"rtol": 1e-4, "atol": 1e-6}, "qc": {"rtol": 1e-3, "atol": 1e-3}},
+        "budgets": {"wall_time_s": 5, "peak_memory_mb": 50}
+    }
+
+The reference trajectory is stored next to it with the same name, e.g. goldens/complex_low_UA.csv.
+A case passes when every variable is within atol + rtol*|reference| of the reference at every time,
+the best wall time of the runs is within its budget and the peak memory allocated during a run is within its budget.
+Accuracy and speed are checked together, so a faster engine is only accepted when it gives the same results.
+
+Usage:
+
+    python rms/regression.py                # checks all the cases, exit code 1 on any failure
+    python rms/regression.py -k complex     # only the cases with "complex" in their name
+    python rms/regression.py --update       # writes the reference trajectories of the current engine
+"""
+from engine import Model, Simulator, read_timeseries, write_timeseries
+import pandas as pd
+import numpy as np
+import tracemalloc
+import argparse
+import time
+import glob
+import json
+import os
+
+MODELS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')
+GOLDENS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'goldens')
+
+TOLERANCES = {'rtol': 1e-4, 'atol': 1e-6}
+BUDGETS = {'wall_time_s': None, 'peak_memory_mb': None}
+
+def load_cases(goldens_dir = GOLDENS_DIR, pattern = None):
+    """
+    Returns the regression cases of a directory as a dictionary of name: case, sorted by name
+
+    Keyword Arguments
+    -----------------
+        goldens_dir :
+            Directory with the case json files. Defaults to rms/goldens.
+        pattern : str
+            Only the cases with this text in their name. Defaults to None, all of them.
+    """
+    cases = {}
+    for file in sorted(glob.glob(os.path.join(goldens_dir, '*.json'))):
+        name = os.path.splitext(os.path.basename(file))[0]
+        if pattern is None or pattern in name:
+            with open(file) as f:
+                cases[name] = json.load(f)
+    return cases
+
+def run_case(case: dict, repeat = 1, models_dir = MODELS_DIR):
+    """
+    Runs the scenario of a case. Returns the trajectory, the best wall time of the runs in seconds
+    and the peak memory allocated during a run in MB.
+    The model is imported before timing, and the memory is traced in a separate run so it does not slow down the timed ones.
+
+    Arguments
+    ---------
+        case : dict
+            Scenario, as for rms/batch.py
+
+    Keyword Arguments
+    -----------------
+        repeat : int
+            Number of timed runs. Defaults to 1.
+        models_dir :
+            Directory with the models. Defaults to rms/models.
+    """
+    mysim = Simulator(model = Model(os.path.join(models_dir, case['model'])))
+    mysim.update_inputs(**{k: case.get(k) for k in ['params', 'mvars', 'subrvars', 'simvars']})
+
+    wall_time = np.inf
+    for _ in range(max(repeat, 1)):
+        mysim.reinitialize()
+        tic = time.perf_counter()
+        data = mysim.run()
+        wall_time = min(wall_time, time.perf_counter() - tic)
+
+    mysim.reinitialize()
+    tracemalloc.start()
+    try:
+        mysim.run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return data, wall_time, peak/2**20
+
+def compare(data: pd.DataFrame, golden: pd.DataFrame, tolerances = None):
+    """
+    Compares a trajectory with its reference, variable by variable.
+    Returns a DataFrame indexed by variable with the largest absolute error, the largest error relative to
+    the tolerance (above 1 fails) and whether the variable passes.
+    Variables missing from either trajectory, or a different time grid, fail.
+
+    Arguments
+    ---------
+        data : pd.DataFrame
+            Trajectory to check, indexed by time
+        golden : pd.DataFrame
+            Reference trajectory, indexed by time
+
+    Keyword Arguments
+    -----------------
+        tolerances : dict
+            rtol and atol of every variable, with the default ones under "default", e.g.
+            {'default': {'rtol': 1e-4, 'atol': 1e-6}, 'qc': {'atol': 1e-3}}. Defaults to rtol 1e-4 and atol 1e-6.
+    """
+    tolerances = tolerances or {}
+    default = {**TOLERANCES, **tolerances.get('default', {})}
+    same_grid = len(data) == len(golden) and np.allclose(data.index.values.astype(float), golden.index.values.astype(float), rtol = 1e-12, atol = 1e-12)
+
+    rows = {}
+    for var in sorted(set(golden.columns) | set(data.columns)):
+        tol = {**default, **tolerances.get(var, {})}
+        if not same_grid or var not in data or var not in golden:
+            rows[var] = {'max_abs_error': np.nan, 'error_ratio': np.inf, 'ok': False}
+            continue
+        x = data[var].values.astype(float)
+        ref = golden[var].values.astype(float)
+        error = np.abs(x - ref)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            ratio = error/(tol['atol'] + tol['rtol']*np.abs(ref))
+        # NaN matches NaN, anything else compared with NaN fails
+        nan = np.isnan(x) | np.isnan(ref)
+        ratio = np.where(nan, np.where(np.isnan(x) & np.isnan(ref), 0., np.inf), ratio)
+        worst = float(np.max(ratio)) if len(ratio) else 0.
+        rows[var] = {'max_abs_error': float(np.nanmax(error)) if (~nan).any() else 0., 'error_ratio': worst, 'ok': worst <= 1.}
+    return pd.DataFrame.from_dict(rows, orient = 'index', columns = ['max_abs_error', 'error_ratio', 'ok']).rename_axis('Var')
+
+def check_case(name, case: dict, goldens_dir = GOLDENS_DIR, update = False, repeat = 1, models_dir = MODELS_DIR):
+    """
+    Runs a case and checks it against its reference trajectory and budgets. Returns a summary, also when it fails.
+    The status is "ok", "accuracy", "wall_time", "memory" (the first failed check), "missing" when there is
+    no reference trajectory, "updated" when it has been written, or "failed" when the run raised.
+
+    Arguments
+    ---------
+        name : str
+            Name of the case, also of its reference trajectory
+        case : dict
+            Scenario, tolerances and budgets of the case
+
+    Keyword Arguments
+    -----------------
+        goldens_dir :
+            Directory with the reference trajectories. Defaults to rms/goldens.
+        update : bool
+            Writes the trajectory of the run as the new reference instead of checking it. Defaults to False.
+        repeat : int
+            Number of timed runs. Defaults to 1.
+        models_dir :
+            Directory with the models. Defaults to rms/models.
+    """
+    budgets = {**BUDGETS, **case.get('budgets', {})}
+    summary = {'case': name, 'model': case.get('model'), 'status': 'failed', 'message': '',
+               'worst_var': None, 'error_ratio': np.nan,
+               'wall_time_s': np.nan, 'wall_time_budget_s': budgets['wall_time_s'],
+               'peak_memory_mb': np.nan, 'peak_memory_budget_mb': budgets['peak_memory_mb']}
+    golden_file = os.path.join(goldens_dir, name + '.csv')
+    try:
+        data, summary['wall_time_s'], summary['peak_memory_mb'] = run_case(case, repeat = repeat, models_dir = models_dir)
+        if update:
+            write_timeseries(data, golden_file)
+            summary['status'] = 'updated'
+            return summary
+        if not os.path.isfile(golden_file):
+            summary.update({'status': 'missing', 'message': 'no reference trajectory, run with --update'})
+            return summary
+
+        errors = compare(data, read_timeseries(golden_file), case.get('tolerances'))
+        summary['worst_var'] = errors.error_ratio.idxmax()
+        summary['error_ratio'] = errors.error_ratio.max()
+        failed = list(errors.index[~errors.ok.astype(bool)])
+        if failed:
+            summary.update({'status': 'accuracy', 'message': 'out of tolerance: {}'.format(', '.join(failed))})
+        elif budgets['wall_time_s'] is not None and summary['wall_time_s'] > budgets['wall_time_s']:
+            summary.update({'status': 'wall_time', 'message': '{:.3f} s over a budget of {} s'.format(summary['wall_time_s'], budgets['wall_time_s'])})
+        elif budgets['peak_memory_mb'] is not None and summary['peak_memory_mb'] > budgets['peak_memory_mb']:
+            summary.update({'status': 'memory', 'message': '{:.1f} MB over a budget of {} MB'.format(summary['peak_memory_mb'], budgets['peak_memory_mb'])})
+        else:
+            summary['status'] = 'ok'
+    except Exception as e:
+        summary['message'] = '{}: {}'.format(type(e).__name__, e)
+    return summary
+
+def check_all(goldens_dir = GOLDENS_DIR, pattern = None, update = False, repeat = 1, models_dir = MODELS_DIR):
+    """
+    Checks all the cases of a directory. Returns a DataFrame with the summary of every case, see `check_case`.
+
+    Keyword Arguments
+    -----------------
+        goldens_dir :
+            Directory with the cases and their reference trajectories. Defaults to rms/goldens.
+        pattern : str
+            Only the cases with this text in their name. Defaults to None, all of them.
+        update : bool
+            Writes the reference trajectories instead of checking them. Defaults to False.
+        repeat : int
+            Number of timed runs per case. Defaults to 1.
+        models_dir :
+            Directory with the models. Defaults to rms/models.
+    """
+    summaries = []
+    for name, case in load_cases(goldens_dir, pattern).items():
+        summary = check_case(name, case, goldens_dir = goldens_dir, update = update, repeat = repeat, models_dir = models_dir)
+        print('{case}: {status} in {wall_time_s:.3f} s, {peak_memory_mb:.1f} MB {message}'.format(**summary))
+        summaries.append(summary)
+    columns = ['case', 'model', 'status', 'message', 'worst_var', 'error_ratio', 'wall_time_s', 'wall_time_budget_s', 'peak_memory_mb', 'peak_memory_budget_mb']
+    return pd.DataFrame(summaries, columns = columns)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Check the simulation results against reference trajectories, tolerances and budgets.')
+    parser.add_argument('-d', '--goldens-dir', default = GOLDENS_DIR, help = 'directory with the cases (default: rms/goldens)')
+    parser.add_argument('-k', '--pattern', default = None, help = 'only the cases with this text in their name')
+    parser.add_argument('-r', '--repeat', type = int, default = 3, help = 'timed runs per case, the best one counts (default: 3)')
+    parser.add_argument('--update', action = 'store_true', help = 'write the reference trajectories of the current engine')
+    args = parser.parse_args(argv)
+
+    index = check_all(args.goldens_dir, pattern = args.pattern, update = args.update, repeat = args.repeat)
+    return 0 if index.status.isin(['ok', 'updated']).all() else 1
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,172 @@
+"""
+Variance-based global sensitivity analysis.
+
+First-order and total Sobol indices of scalar outputs of a simulation, e.g. which parameters of jckantor_complex
+drive the temperature overshoot and the conversion:
+
+    indices, evaluations = sobol_indices('models/jckantor_complex', {
+            'overshoot': lambda data: data['T'].max() - data['Tsp'].iloc[-1],
+            'conversion': lambda data: 1 - data['C'].iloc[-1]/data['Cf'].iloc[-1],
+        },
+        n_samples = 1024,
+        distributions = {'Ea': (7e4, 7.5e4), 'UA': (4e4, 6e4), 'kp': (5, 20), 'ki': (10, 40)})
+    indices.loc['overshoot']
+
+Samples follow the Saltelli scheme: two independent matrices A and B, and one matrix per variable equal to A
+with the column of that variable taken from B, so n_samples*(variables + 2) simulations are run.
+These are run as batched ensembles (see `uncertainty.run_members`) in parallel processes.
+The first-order indices use the estimator of Saltelli et al. (2010) and the total indices that of Jansen (1999),
+with confidence intervals from bootstrap resampling of the rows.
+"""
+from uncertainty import input_distributions, from_unit, run_members, _get_model
+from concurrent.futures import ProcessPoolExecutor
+from scipy.stats import qmc
+import pandas as pd
+import numpy as np
+import os
+
+def saltelli_samples(model_path, n_samples, variables = None, distributions = None, seed = None):
+    """
+    Returns the Saltelli sample matrices, stacked in a DataFrame indexed by (matrix, sample).
+    Matrices are named "A", "B" and "AB_<variable>".
+
+    Arguments
+    ---------
+        model_path :
+            Path poiting to a specific model directory.
+        n_samples : int
+            Rows of every matrix, preferably a power of 2.
+
+    Keyword Arguments
+    -----------------
+        variables : list
+            Variables sampled within their Min/Max bounds. See `uncertainty.sample_inputs`.
+        distributions : dict
+            Distribution of other variables, e.g. {'Ea': (7e4, 7.5e4)}. See `uncertainty.sample_inputs`.
+        seed : int
+            Seed of the scrambled Sobol sequence.
+    """
+    dists = input_distributions(_get_model(model_path), variables, distributions)
+    d = len(dists)
+    u = qmc.Sobol(d = 2*d, scramble = True, seed = seed).random(n_samples)
+    A, B = u[:,:d], u[:,d:]
+    matrices = {'A': A, 'B': B}
+    for j, v in enumerate(dists):
+        AB = A.copy()
+        AB[:,j] = B[:,j]
+        matrices['AB_' + v] = AB
+    return pd.concat({name: from_unit(m, dists) for name, m in matrices.items()}, names = ['Matrix', 'Sample'])
+
+def _evaluate(model_path, samples, outputs, simvars):
+    """
+    Runs a batch of samples and evaluates the scalar outputs on the trajectory of every sample
+    """
+    batch, time, names = run_members(model_path, samples, simvars = simvars)
+    values = np.empty((len(samples), len(outputs)))
+    for j in range(len(samples)):
+        data = pd.DataFrame(batch[j], index = time, columns = names)
+        values[j] = [f(data) for f in outputs.values()]
+    return values
+
+def saltelli_indices(fA, fB, fAB, n_bootstrap = 1000, confidence = 0.95, seed = None):
+    """
+    First-order and total indices from the outputs evaluated on the Saltelli matrices.
+    Returns a dictionary with the arrays S1, ST and their confidence bounds, with shape (variables, outputs).
+
+    Arguments
+    ---------
+        fA : np.ndarray
+            Outputs on A, with shape (samples, outputs)
+        fB : np.ndarray
+            Outputs on B, with shape (samples, outputs)
+        fAB : np.ndarray
+            Outputs on every AB matrix, with shape (variables, samples, outputs)
+
+    Keyword Arguments
+    -----------------
+        n_bootstrap : int
+            Number of bootstrap resamples. Defaults to 1000.
+        confidence : float
+            Confidence level of the intervals. Defaults to 0.95.
+        seed : int
+            Seed of the resampling.
+    """
+    def indices(fA, fB, fAB):
+        variance = np.concatenate([fA, fB], axis = -2).var(axis = -2)
+        S1 = np.mean(fB*(fAB - fA), axis = -2)/variance
+        ST = 0.5*np.mean((fA - fAB)**2, axis = -2)/variance
+        return S1, ST
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        S1, ST = indices(fA, fB, fAB)
+        rows = np.random.default_rng(seed).integers(len(fA), size = (n_bootstrap, len(fA)))
+        S1_boot, ST_boot = indices(fA[rows], fB[rows], fAB[:,rows])
+
+    alpha = (1 - confidence)/2
+    result = {'S1': S1, 'ST': ST}
+    for name, boot in [('S1', S1_boot), ('ST', ST_boot)]:
+        result[name + '_low'], result[name + '_high'] = np.nanquantile(boot, [alpha, 1 - alpha], axis = 1)
+    return result
+
+def sobol_indices(model_path, outputs: dict, n_samples = 512, variables = None, distributions = None, seed = None,
+                  n_bootstrap = 1000, confidence = 0.95, simvars = None, batch_size = 1000, processes = None):
+    """
+    Sobol indices of scalar outputs of a model with respect to its inputs.
+
+    Arguments
+    ---------
+        model_path :
+            Path poiting to a specific model directory.
+        outputs : dict
+            Scalar outputs, as functions of the trajectory (a DataFrame indexed by time with the states,
+            manipulated and controlled variables), e.g. {'Tmax': lambda data: data['T'].max()}.
+            Functions must be importable by the worker processes unless processes is 1.
+
+    Keyword Arguments
+    -----------------
+        n_samples : int
+            Rows of every Saltelli matrix, preferably a power of 2. Defaults to 512.
+        variables : list
+            Variables sampled within their Min/Max bounds. See `uncertainty.sample_inputs`.
+        distributions : dict
+            Distribution of other variables, e.g. {'UA': (4e4, 6e4)}. See `uncertainty.sample_inputs`.
+        seed : int
+            Seed of the sampling and of the bootstrap.
+        n_bootstrap : int
+            Number of bootstrap resamples. Defaults to 1000.
+        confidence : float
+            Confidence level of the intervals. Defaults to 0.95.
+        simvars : dict
+            New values of the simulator variables. Defaults to None.
+        batch_size : int
+            Simulations per ensemble. Defaults to 1000.
+        processes : int
+            Number of worker processes. Defaults to the number of CPUs, 1 runs serially.
+
+    Returns
+    -------
+        indices : pd.DataFrame
+            Indexed by (output, variable), with columns S1, S1_low, S1_high, ST, ST_low and ST_high.
+        evaluations : pd.DataFrame
+            Saltelli samples and the values of the outputs on each of them.
+    """
+    model_path = os.path.abspath(model_path)
+    samples = saltelli_samples(model_path, n_samples, variables, distributions, seed)
+    batches = [samples.iloc[i:i+batch_size] for i in range(0, len(samples), batch_size)]
+    args = [(model_path, b, outputs, simvars) for b in batches]
+
+    if processes == 1:
+        results = [_evaluate(*a) for a in args]
+    else:
+        with ProcessPoolExecutor(max_workers = processes) as pool:
+            results = list(pool.map(_evaluate, *zip(*args)))
+
+    evaluations = samples.join(pd.DataFrame(np.concatenate(results), index = samples.index, columns = list(outputs)))
+    values = evaluations[list(outputs)]
+    names = list(samples.columns)
+    fAB = np.array([values.loc['AB_' + v].values for v in names])
+    result = saltelli_indices(values.loc['A'].values, values.loc['B'].values, fAB, n_bootstrap, confidence, seed)
+
+    index = pd.MultiIndex.from_product([list(outputs), names], names = ['Output', 'Var'])
+    indices = pd.DataFrame({k: v.T.ravel() for k, v in result.items()}, index = index)
+    return indices[['S1', 'S1_low', 'S1_high', 'ST', 'ST_low', 'ST_high']], evaluations
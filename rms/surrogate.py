@@ -0,0 +1,343 @@
+"""
+Cheap approximations of the trajectories of a model, trained on sweeps of its inputs, for instant previews.
+
+Input values are sampled within their bounds (see `uncertainty.sample_inputs`), run as batched ensembles,
+and the trajectories of the outputs are fitted as functions of the inputs, either with a polynomial chaos expansion
+(Legendre polynomials of the inputs mapped to [-1, 1], fitted by least squares) or with a small neural network
+from scikit-learn. A part of the samples is held out to estimate the error of every output:
+
+    surrogate = Surrogate('models/jckantor_complex', variables = ['q', 'Cf', 'qc_max'])
+    surrogate.fit(n_samples = 256)
+    print(surrogate.errors)
+    preview = surrogate.predict({'q': 120})
+    surrogate.save('surrogates/jckantor_complex.pkl.gz')
+
+Predictions are only valid for the other inputs at the values used for training, see `applies_to`.
+Errors against exact runs made later, e.g. by the Dash app, are tracked with `observe`.
+
+Usage:
+
+    python rms/surrogate.py jckantor_complex -n 256 --degree 3
+"""
+from engine import Model, Simulator
+from uncertainty import input_distributions, sample_inputs, run_members
+from history import input_values, _value_columns
+from concurrent.futures import ProcessPoolExecutor
+from numpy.polynomial import legendre
+import pandas as pd
+import numpy as np
+import itertools
+import argparse
+import pickle
+import gzip
+import os
+
+MODELS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')
+
+def total_degree_indices(n_vars, degree):
+    """
+    Returns the multi-indices of the polynomials of n_vars variables with total degree up to degree,
+    with shape (terms, n_vars), lowest degrees first
+
+    Arguments
+    ---------
+        n_vars : int
+        degree : int
+    """
+    indices = [i for i in itertools.product(range(degree + 1), repeat = n_vars) if sum(i) <= degree]
+    return np.array(sorted(indices, key = lambda i: (sum(i), [-x for x in i])), dtype = int).reshape(-1, n_vars)
+
+def legendre_basis(z, indices):
+    """
+    Evaluates the products of Legendre polynomials at points of [-1, 1]^n_vars. Returns shape (points, terms).
+
+    Arguments
+    ---------
+        z : np.ndarray
+            Points with shape (points, n_vars)
+        indices : np.ndarray
+            Multi-indices, see `total_degree_indices`
+    """
+    z = np.atleast_2d(z)
+    degree = int(indices.max()) if indices.size else 0
+    # orthonormal on the uniform distribution, so the coefficients are comparable
+    vander = legendre.legvander(z, degree)*np.sqrt(2*np.arange(degree + 1) + 1)
+    basis = np.ones((len(z), len(indices)))
+    for j in range(z.shape[1]):
+        basis *= vander[:, j, indices[:, j]]
+    return basis
+
+class Surrogate():
+    """
+    Approximation of the trajectories of a model as a function of some of its inputs
+    """
+    def __init__(self, model_path, variables = None, distributions = None, outputs = None, simvars = None, degree = 3, method = 'polynomial'):
+        """
+        Arguments
+        ---------
+            model_path :
+                Path poiting to a specific model directory.
+
+        Keyword Arguments
+        -----------------
+            variables : list
+                Inputs sampled within their Min/Max bounds. See `uncertainty.sample_inputs`.
+            distributions : dict
+                Distribution of other inputs, e.g. {'UA': (4e4, 6e4)}. See `uncertainty.sample_inputs`.
+            outputs : list
+                Variables to approximate. Defaults to None, the states, manipulated and controlled variables.
+            simvars : dict
+                New values of the simulator variables, also used for the predictions. Defaults to None.
+            degree : int
+                Total degree of the polynomials. Defaults to 3.
+            method : str
+                "polynomial" for a polynomial chaos expansion, or "mlp" for a neural network (needs scikit-learn).
+                Defaults to "polynomial".
+
+        Raises
+        ------
+            ValueError
+                If the method is not recognized.
+        """
+        if method not in ['polynomial', 'mlp']:
+            raise ValueError('Surrogate method not recognized. Please use "polynomial" or "mlp".')
+        self.model_path = os.path.abspath(model_path)
+        self.model_name = os.path.basename(os.path.normpath(model_path))
+        self.variables = variables
+        self.distributions = distributions
+        self.outputs = outputs
+        self.simvars = dict(simvars or {})
+        self.degree = degree
+        self.method = method
+        self.dists = None
+        self.time = None
+        self.nominal = None
+        self.defaults = None
+        self.errors = None
+        self._observed = {}
+
+    def _to_unit(self, samples: pd.DataFrame):
+        """
+        Maps input values to [-1, 1], through the cumulative distribution of every input
+        """
+        z = np.empty((len(samples), len(self.dists)))
+        for j, (v, dist) in enumerate(self.dists.items()):
+            x = samples[v].values.astype(float)
+            u = (x - dist[0])/(dist[1] - dist[0]) if isinstance(dist, tuple) else dist.cdf(x)
+            z[:, j] = 2*np.clip(u, 0, 1) - 1
+        return z
+
+    def fit(self, n_samples = 256, validation = 0.2, seed = None, batch_size = 1000, processes = 1):
+        """
+        Runs a sweep of the inputs and fits the surrogate on part of it. The error of every output on the rest
+        is kept in `errors`, with the root mean square error (also relative to the range of the output),
+        the largest absolute error and the coefficient of determination. Returns the surrogate.
+
+        Keyword Arguments
+        -----------------
+            n_samples : int
+                Number of simulations, training and validation. Defaults to 256.
+            validation : float
+                Fraction of the simulations held out to estimate the errors. Defaults to 0.2.
+            seed : int
+                Seed of the sampler and of the split.
+            batch_size : int
+                Simulations per ensemble. Defaults to 1000.
+            processes : int
+                Number of worker processes, None for the number of CPUs. Defaults to 1.
+
+        Raises
+        ------
+            ImportError
+                If the method is "mlp" and scikit-learn is not installed.
+        """
+        model = Model(self.model_path)
+        self.dists = input_distributions(model, self.variables, self.distributions)
+        samples = sample_inputs(model, n_samples, self.variables, self.distributions, seed = seed)
+        batches = [samples.iloc[i:i+batch_size] for i in range(0, len(samples), batch_size)]
+        args = [(self.model_path, b, self.outputs, self.simvars) for b in batches]
+        if processes == 1:
+            results = [run_members(*a) for a in args]
+        else:
+            with ProcessPoolExecutor(max_workers = processes) as pool:
+                results = list(pool.map(run_members, *zip(*args)))
+        batch = np.concatenate([r[0] for r in results])
+        self.time, self.outputs = results[0][1], list(results[0][2])
+
+        # the inputs that are not sampled stay at these values
+        mysim = Simulator(model = model)
+        mysim.update_inputs(simvars = self.simvars)
+        values = input_values(mysim)
+        self.nominal = {(t, v): x for t, v, x in values if v not in self.dists}
+        self.defaults = {v: float(x) for t, v, x in values if v in self.dists}
+
+        z = self._to_unit(samples)
+        Y = batch.reshape(len(samples), -1)
+        n_validation = int(round(validation*len(samples))) if len(samples) > 1 else 0
+        order = np.random.default_rng(seed).permutation(len(samples))
+        train, test = order[n_validation:], order[:n_validation]
+        self._fit(z[train], Y[train])
+
+        if len(test):
+            predicted = self._predict(z[test]).reshape(len(test), len(self.time), -1)
+            self.errors = self._error_table(predicted, batch[test], [len(test)*len(self.time)]*len(self.outputs))
+        return self
+
+    def _fit(self, z, Y):
+        """
+        Fits the mapping from the inputs in [-1, 1] to the flattened trajectories
+        """
+        self._mean = Y.mean(axis = 0)
+        self._scale = np.where(Y.std(axis = 0) > 0, Y.std(axis = 0), 1.)
+        Y = (Y - self._mean)/self._scale
+        if self.method == 'polynomial':
+            self._indices = total_degree_indices(z.shape[1], self.degree)
+            self._coefficients = np.linalg.lstsq(legendre_basis(z, self._indices), Y, rcond = None)[0]
+        else:
+            try:
+                from sklearn.neural_network import MLPRegressor
+            except ImportError:
+                raise ImportError('The "mlp" surrogate needs scikit-learn. Please install it or use method = "polynomial".')
+            self._network = MLPRegressor(hidden_layer_sizes = (64, 64), max_iter = 2000, random_state = 0).fit(z, Y)
+
+    def _predict(self, z):
+        """
+        Flattened trajectories at inputs in [-1, 1], with shape (points, times*outputs)
+        """
+        if self.method == 'polynomial':
+            Y = legendre_basis(z, self._indices) @ self._coefficients
+        else:
+            Y = self._network.predict(z).reshape(len(z), -1)
+        return Y*self._scale + self._mean
+
+    def _error_table(self, predicted, exact, n):
+        """
+        Error statistics of every output, from arrays with shape (samples, times, outputs)
+        """
+        error = predicted - exact
+        sum_sq = (error**2).sum(axis = (0, 1))
+        rmse = np.sqrt(sum_sq/np.array(n))
+        span = exact.max(axis = (0, 1)) - exact.min(axis = (0, 1))
+        variance = ((exact - exact.mean(axis = (0, 1)))**2).sum(axis = (0, 1))
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            table = {
+                'rmse': rmse,
+                'nrmse': np.where(span > 0, rmse/span, 0.),
+                'max_abs_error': np.abs(error).max(axis = (0, 1)),
+                'r2': np.where(variance > 0, 1 - sum_sq/variance, 1.),
+                'n': n,
+            }
+        return pd.DataFrame(table, index = pd.Index(self.outputs, name = 'Var'))
+
+    def predict(self, values: dict):
+        """
+        Returns the approximate trajectories of the outputs, indexed by time
+
+        Arguments
+        ---------
+            values : dict
+                Values of the sampled inputs. Missing inputs take their values in the model.
+        """
+        row = {v: values.get(v, self.defaults[v]) for v in self.dists}
+        Y = self._predict(self._to_unit(pd.DataFrame([row])))
+        return pd.DataFrame(Y.reshape(len(self.time), -1), index = self.time, columns = self.outputs)
+
+    def applies_to(self, values):
+        """
+        Whether the surrogate was trained for these inputs: all the inputs that were not sampled must be
+        at their training values, and the sampled ones within their bounds.
+
+        Arguments
+        ---------
+            values : list
+                (table, variable, value) tuples, see `history.input_values`
+        """
+        for table, var, x in values:
+            if var in self.dists:
+                dist = self.dists[var]
+                if isinstance(dist, tuple) and not dist[0] <= float(x) <= dist[1]:
+                    return False
+            elif (table, var) in self.nominal:
+                a, b = _value_columns(x), _value_columns(self.nominal[(table, var)])
+                if a[0] is not None and b[0] is not None:
+                    if not np.isclose(a[0], b[0], rtol = 1e-9, atol = 0.):
+                        return False
+                elif a != b:
+                    return False
+        return True
+
+    def observe(self, values: dict, data: pd.DataFrame):
+        """
+        Compares a prediction with an exact run and adds it to the running error statistics, see `observed_errors`
+
+        Arguments
+        ---------
+            values : dict
+                Values of the sampled inputs of the run
+            data : pd.DataFrame
+                Result of the exact run, indexed by time
+        """
+        predicted = self.predict(values)
+        for var in self.outputs:
+            if var not in data:
+                continue
+            exact = np.interp(self.time, data.index.values.astype(float), data[var].values.astype(float))
+            error = predicted[var].values - exact
+            n, sum_sq, max_abs = self._observed.get(var, (0, 0., 0.))
+            self._observed[var] = (n + len(error), sum_sq + float((error**2).sum()), max(max_abs, float(np.abs(error).max())))
+
+    def observed_errors(self):
+        """
+        Returns the errors of the predictions compared with exact runs by `observe`, indexed by output:
+        the root mean square error, the largest absolute error and the number of points compared
+        """
+        table = {var: {'rmse': np.sqrt(s/n), 'max_abs_error': m, 'n': n} for var, (n, s, m) in self._observed.items() if n}
+        return pd.DataFrame.from_dict(table, orient = 'index', columns = ['rmse', 'max_abs_error', 'n']).rename_axis('Var')
+
+    def save(self, path):
+        """
+        Writes the surrogate and its error statistics to a compressed pickle
+
+        Arguments
+        ---------
+            path :
+                Path of the .pkl.gz file
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+        with gzip.open(path, 'wb') as f:
+            pickle.dump(self, f, protocol = pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path):
+        """
+        Reads a surrogate written by `save`
+
+        Arguments
+        ---------
+            path :
+                Path of the .pkl.gz file
+        """
+        with gzip.open(path, 'rb') as f:
+            return pickle.load(f)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Train a surrogate of a model on a sweep of its inputs.')
+    parser.add_argument('model', help = 'name of the model directory in rms/models')
+    parser.add_argument('-v', '--variables', nargs = '+', default = None, help = 'inputs to sample (default: all with Min/Max bounds)')
+    parser.add_argument('-n', '--n-samples', type = int, default = 256, help = 'number of simulations (default: 256)')
+    parser.add_argument('--degree', type = int, default = 3, help = 'total degree of the polynomials (default: 3)')
+    parser.add_argument('--method', default = 'polynomial', choices = ['polynomial', 'mlp'], help = 'surrogate type (default: polynomial)')
+    parser.add_argument('-j', '--jobs', type = int, default = None, help = 'number of worker processes (default: number of CPUs)')
+    parser.add_argument('-o', '--output-dir', default = 'surrogates', help = 'directory for the surrogate (default: surrogates)')
+    parser.add_argument('--seed', type = int, default = None, help = 'seed of the sampling')
+    args = parser.parse_args(argv)
+
+    surrogate = Surrogate(os.path.join(MODELS_DIR, args.model), variables = args.variables, degree = args.degree, method = args.method)
+    surrogate.fit(n_samples = args.n_samples, seed = args.seed, batch_size = max(1, -(-args.n_samples//(args.jobs or os.cpu_count() or 1))), processes = args.jobs)
+    print(surrogate.errors.to_string())
+    surrogate.save(os.path.join(args.output_dir, args.model + '.pkl.gz'))
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
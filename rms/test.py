@@ -1,9 +1,29 @@
-from engine import Model, Simulator, ModelDefinitionError
+from engine import Model, Simulator, ModelDefinitionError, load_manifest, Profile, Recorder, periodic, write_timeseries
+from estimation import estimate_multistart
+from control import MPCSubroutine, EstimatorSubroutine, ExtendedKalmanFilter
+from batch import run_batch
+from flowsheet import Flowsheet
+from realtime import RealtimeScheduler
+from uncertainty import propagate_uncertainty
+from sobol import sobol_indices, saltelli_indices
+from history import RunHistory, input_values
+from regression import check_all, check_case, load_cases
+from surrogate import Surrogate
+from prefetch import ResultCache, Prefetcher
 from dash_apps.apps.myapp import app
+from dash_apps.shared_transport import encode_frame, decode_frame
 import dash_html_components as html
 
+import numpy as np
+import pandas as pd
 import os
+import json
+import shutil
+import tempfile
+import time
 import unittest
+import warnings
+from scipy.integrate import ODEintWarning
 
 class MyTests(unittest.TestCase):
 
@@ -83,3 +103,710 @@ class MyTests(unittest.TestCase):
                 print(m)
                 ok = False; er = e
             self.assertTrue(ok, er)
+
+    def test_sensitivity_each_simulator(self):
+        path = os.getcwd()
+        # get all models in the models directory, skip penicilin
+        model_names = [o for o in sorted(os.listdir(os.path.join('models'))) if os.path.isdir(os.path.join('models',o))]
+        model_names.remove('penicillin_goldrick_2017')
+        model_path = lambda model_name: os.path.join(path,'models', model_name)
+
+        for m in model_names:
+            try:
+                mysim = Simulator(model = Model(model_path(m)))
+                mysim.set_inputs()
+                data, sens = mysim.run_sensitivity()
+                ok = sens.index.equals(data.index) and sens.shape[1] == len(mysim.model.state)*len(mysim.model.params.current)
+                er = 'sensitivities not aligned with the results'
+            except Exception as e:
+                ok = False; er = e
+            self.assertTrue(ok, er)
+
+    def test_estimate_multistart(self):
+        path = os.getcwd()
+        model_path = os.path.join(path,'models', 'jckantor_simple')
+        try:
+            mysim = Simulator(model = Model(model_path))
+            mysim.set_inputs()
+            measurements = mysim.run()[['X','S']].iloc[::20].astype(float)
+            best, starts, spread = estimate_multistart(model_path, measurements, {'mu_max': (0.1, 0.3)}, n_starts = 2, processes = 1, seed = 0, max_nfev = 20)
+            ok = len(starts) == 2 and 'mu_max' in spread.index and abs(best['mu_max'] - 0.2) < 1e-4
+
+            # with a PID in the loop, the Jacobian is found by finite differences
+            model_path = os.path.join(path,'models', 'jckantor_complex')
+            mysim = Simulator(model = Model(model_path))
+            mysim.set_inputs()
+            measurements = mysim.run()[['T','C']].iloc[::10].astype(float)
+            best, starts, spread = estimate_multistart(model_path, measurements, {'UA': (3e4, 7e4)}, n_starts = 1, processes = 1, seed = 0, max_nfev = 15)
+            ok = ok and abs(best['UA'] - 5e4) < 1 and best['success']
+            er = starts
+        except Exception as e:
+            ok = False; er = e
+        self.assertTrue(ok, er)
+
+    def test_mpc_subroutine(self):
+        path = os.getcwd()
+        model_path = os.path.join(path,'models', 'jckantor_complex')
+
+        class MyMPC(MPCSubroutine):
+            manipulated = ['qc']
+            setpoints = {'T': 'Tsp'}
+            bounds = {'qc': ('qc_min', 'qc_max')}
+            move_weights = {'qc': 1e-3}
+
+        try:
+            mymodel = Model(model_path)
+            mymodel.subroutine_class = MyMPC
+            mysim = Simulator(model = mymodel)
+            mysim.set_inputs()
+            data = mysim.run()
+            ok = abs(data['T'].iloc[-1] - 390) < 1 and mysim.subroutines.linearizations < len(mysim.time)
+            er = 'MPC did not reach the setpoint reusing linearizations'
+        except Exception as e:
+            ok = False; er = e
+        self.assertTrue(ok, er)
+
+    def test_manifest(self):
+        try:
+            manifest = load_manifest('models')
+            ok = 'penicillin_goldrick_2017' not in manifest and all('parameters.csv' in m['vars'] for m in manifest.values())
+
+            # the cache written from here is valid from the parent directory too
+            cwd = os.getcwd()
+            os.chdir('..')
+            try:
+                cached = load_manifest(os.path.join('rms', 'models'))
+            finally:
+                os.chdir(cwd)
+            ok = ok and cached.keys() == manifest.keys()
+            ok = ok and all(cached[k]['path'] == m['path'] == os.path.join(cwd, 'models', k) and os.path.isdir(m['path']) for k, m in manifest.items())
+            ok = ok and all(m['diagram'] is None or os.path.isfile(m['diagram']) for m in cached.values())
+            er = 'invalid models or paths in the manifest'
+        except Exception as e:
+            ok = False; er = e
+        self.assertTrue(ok, er)
+
+    def test_checkpoint_resume(self):
+        path = os.getcwd()
+        model_path = os.path.join(path,'models', 'jckantor_complex')
+        try:
+            with tempfile.TemporaryDirectory() as checkpoint_dir:
+                mysim = Simulator(model = Model(model_path))
+                mysim.set_inputs()
+                data = mysim.run(checkpoint_every = 2, checkpoint_dir = checkpoint_dir)
+                resumed = Simulator(model = Model(model_path)).resume(from_t = 5, checkpoint_dir = checkpoint_dir)
+                ok = ((resumed.astype(float) - data.astype(float)).abs().max().max() < 1e-6); er = 'resumed run differs'
+
+                # a new run replaces the checkpoints of the previous one
+                mysim.reinitialize()
+                mysim.run(checkpoint_every = 3, checkpoint_dir = checkpoint_dir)
+                resumed = Simulator(model = Model(model_path)).resume(checkpoint_dir = checkpoint_dir)
+                ok = ok and resumed.index.equals(data.index) and ((resumed.astype(float) - data.astype(float)).abs().max().max() < 1e-6)
+        except Exception as e:
+            ok = False; er = e
+        self.assertTrue(ok, er)
+
+    def test_run_batch(self):
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                os.makedirs(os.path.join(tmp, 'scenarios'))
+                with open(os.path.join(tmp, 'scenarios', 'complex.json'), 'w') as f:
+                    json.dump({'model': 'jckantor_complex', 'params': {'UA': 40000}, 'subrvars': {'Tsp': 380}, 'simvars': {'Tf': 4}}, f)
+                with open(os.path.join(tmp, 'scenarios', 'missing.json'), 'w') as f:
+                    json.dump({'model': 'dummy'}, f)
+                index = run_batch(os.path.join(tmp, 'scenarios'), os.path.join(tmp, 'results'), jobs = 2, fmt = 'csv')
+                ok = list(index.status) == ['ok', 'failed'] and os.path.isfile(os.path.join(tmp, 'results', 'index.csv'))
+                er = index.message.tolist()
+        except Exception as e:
+            ok = False; er = e
+        self.assertTrue(ok, er)
+
+    def test_incremental_run(self):
+        path = os.getcwd()
+        model_path = os.path.join(path,'models', 'jckantor_complex')
+        try:
+            mysim = Simulator(model = Model(model_path))
+            mysim.subroutines.subrvars.default.loc['Tsp','Value'] = lambda t: 390 if t < 6 else 380
+            mysim.reinitialize()
+            mysim.run(incremental = True)
+
+            # change the setpoint late in the horizon
+            mysim.subroutines.subrvars.default.loc['Tsp','Value'] = lambda t: 390 if t < 6 else 370
+            mysim.model.reset()
+            mysim.reinitialize()
+            ok = mysim._first_divergence(mysim._input_signature()) > 0
+            data = mysim.run(incremental = True)
+
+            full = Simulator(model = Model(model_path))
+            full.subroutines.subrvars.default.loc['Tsp','Value'] = lambda t: 390 if t < 6 else 370
+            full.reinitialize()
+            ok = ok and ((full.run().astype(float) - data.astype(float)).abs().max().max() < 1e-6)
+            er = 'incremental run differs from a full run'
+        except Exception as e:
+            ok = False; er = e
+        self.assertTrue(ok, er)
+
+    def test_profile_input(self):
+        path = os.getcwd()
+        model_path = os.path.join(path,'models', 'jckantor_simple')
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                with open(os.path.join(tmp, 'feed.csv'), 'w') as f:
+                    f.write('Time,F\n0,0.05\n2.525,0.2\n5,0\n')
+                mysim = Simulator(model = Model(model_path))
+                mysim.model.mvars.default.loc['F','Value'] = Profile(os.path.join(tmp, 'feed.csv'))
+            mysim.reinitialize()
+            data = mysim.run()
+            # the volume integrates the feed exactly across the steps of the profile
+            t = data.index.to_series()
+            volume = 1 + 0.05*t.clip(None, 2.525) + 0.2*(t.clip(None, 5) - 2.525).clip(0)
+            ok = list(mysim.breakpoints) == [2.525, 5] and (data['V'] - volume).abs().max() < 1e-5
+            er = 'profile not followed'
+
+            # moving a breakpoint within a grid interval is seen by incremental runs
+            with tempfile.TemporaryDirectory() as tmp:
+                for name, time_step in [('early.csv', 2.47), ('late.csv', 2.51)]:
+                    with open(os.path.join(tmp, name), 'w') as f:
+                        f.write('Time,F\n0,0.05\n{},0.2\n5,0\n'.format(time_step))
+                mysim.model.mvars.default.loc['F','Value'] = Profile(os.path.join(tmp, 'early.csv'))
+                mysim.reinitialize()
+                mysim.run(incremental = True)
+                mysim.model.mvars.default.loc['F','Value'] = Profile(os.path.join(tmp, 'late.csv'))
+                mysim.reinitialize()
+                incremental = mysim.run(incremental = True)
+                mysim.reinitialize()
+                full = mysim.run()
+            ok = ok and (incremental['V'] - full['V']).abs().max() < 1e-6
+            er = 'incremental run missed the moved breakpoint'
+        except Exception as e:
+            ok = False; er = e
+        self.assertTrue(ok, er)
+
+    def test_recorder(self):
+        path = os.getcwd()
+        model_path = os.path.join(path,'models', 'jckantor_complex')
+        try:
+            mysim = Simulator(model = Model(model_path))
+            mysim.reinitialize()
+            full = mysim.run()
+            with tempfile.TemporaryDirectory() as tmp:
+                recorder = Recorder(variables = ['T', 'q', 'Tsp'], decimation = 4, constants_once = True,
+                                    memory_budget = 0, spill_dir = tmp, chunk_size = 10)
+                mysim.reinitialize()
+                mysim.run(recording = recorder)
+                spilled = len(os.listdir(tmp)) > 0 and recorder.nbytes == 0
+                data = recorder.to_frame()
+                recorder.close()
+            expected = full.loc[full.index[::4], ['q', 'T', 'Tsp']].astype(float)
+            ok = spilled and list(data.columns) == ['q', 'T', 'Tsp'] and (data - expected).abs().max().max() < 1e-9
+            er = 'recorded data differs from a full run'
+        except Exception as e:
+            ok = False; er = e
+        self.assertTrue(ok, er)
+
+    def test_flowsheet(self):
+        path = os.getcwd()
+        try:
+            # a single unit matches the simulator
+            fs = Flowsheet()
+            fs.add_unit('R', Model(os.path.join(path,'models', 'jckantor_simple')))
+            data = fs.run(rtol = 1e-9, atol = 1e-11)
+            mysim = Simulator(model = Model(os.path.join(path,'models', 'jckantor_simple')))
+            mysim.reinitialize()
+            full = mysim.run()
+            ok = all((data['R'][k] - full[k].astype(float)).abs().max() < 1e-4 for k in ['P', 'S', 'V', 'X'])
+
+            # reactors in series with a recycle, sparse Jacobian against finite differences
+            fs = Flowsheet()
+            for i in range(5):
+                fs.add_unit('R{}'.format(i), Model(os.path.join(path,'models', 'jckantor_complex')))
+            for i in range(4):
+                fs.connect('R{}'.format(i), 'R{}'.format(i+1), {'Cf': 'C', 'Tf': 'T'}, flow = 'q')
+            fs.connect('R4', 'R0', {'Cf': 'C', 'Tf': 'T'}, flow = 'q')
+            y = fs._build()['y0']*1.01
+            jac = fs.jacobian(0., y).toarray()
+            fd = np.array([(fs.rhs(0., y + h) - fs.rhs(0., y - h))/(2*h.sum()) for h in np.diag(1e-6*np.maximum(np.abs(y), 1))]).T
+            ok = ok and np.allclose(jac, fd, rtol = 1e-4, atol = 1e-8) and fs.run().shape[1] == 15
+
+            # fresh feeds mixed with a recycle, without reaction C is conserved at steady state
+            fs = Flowsheet()
+            fs.add_unit('R1', Model(os.path.join(path,'models', 'jckantor_complex')), flow = 'q', k0 = 0, q = 100, Cf = 1)
+            fs.add_unit('R2', Model(os.path.join(path,'models', 'jckantor_complex')), flow = 'q', k0 = 0, q = 50, Cf = 3)
+            fs.connect('R1', 'R2', {'Cf': 'C', 'Tf': 'T'}, flow = 'q')
+            fs.connect('R2', 'R1', {'Cf': 'C', 'Tf': 'T'}, flow = 20)
+            fs.simvars.current.loc['Tf','Value'] = 40
+            steady = fs.run(rtol = 1e-9, atol = 1e-11).iloc[-1]
+            flows = fs._build()['flows']
+            ok = ok and np.isclose(flows['R1'], 120) and np.isclose(flows['R2'], 170)
+            ok = ok and abs((flows['R2'] - 20)*steady['R2','C'] - (100*1 + 50*3)) < 1e-4
+            ok = ok and abs(flows['R1']*steady['R1','C'] - (100*1 + 20*steady['R2','C'])) < 1e-4
+            er = 'flowsheet differs from the simulator, its Jacobian is wrong or it does not conserve mass'
+        except Exception as e:
+            ok = False; er = e
+        self.assertTrue(ok, er)
+
+    def test_replicates(self):
+        path = os.getcwd()
+        model_path = os.path.join(path,'models', 'jckantor_complex')
+        try:
+            mysim = Simulator(model = Model(model_path), replicate_ids = ['A', 'B'])
+            mysim.update_inputs(params = {'UA': 40000}, replicate_id = 'B')
+            mysim.reinitialize()
+            data = mysim.run()
+            ok = list(data.index.get_level_values('Replicate').unique()) == ['A', 'B']
+            for replicate_id, params in [('A', None), ('B', {'UA': 40000})]:
+                single = Simulator(model = Model(model_path))
+                single.update_inputs(params = params)
+                single.reinitialize()
+                ok = ok and (data.loc[replicate_id] - single.run().astype(float)).abs().max().max() < 1e-3
+            er = 'replicates differ from single runs'
+        except Exception as e:
+            ok = False; er = e
+        self.assertTrue(ok, er)
+
+    def test_transport(self):
+        path = os.getcwd()
+        model_path = os.path.join(path,'models', 'jckantor_complex')
+        try:
+            mysim = Simulator(model = Model(model_path))
+            mysim.reinitialize()
+            data = mysim.run().astype(float)
+            payload = encode_frame(data, run = 1)
+            small = encode_frame(data, float32 = True)
+            ok = (decode_frame(payload) == data).all().all() and (decode_frame(small) - data).abs().max().max() < 1e-2
+            ok = ok and len(json.dumps(small)) < len(json.dumps(payload))
+            er = 'payload does not round trip'
+        except Exception as e:
+            ok = False; er = e
+        self.assertTrue(ok, er)
+
+    def test_realtime_scheduler(self):
+        path = os.getcwd()
+        try:
+            scheduler = RealtimeScheduler(tick = 0.01, speed = 5, models_dir = os.path.join(path, 'models'))
+            for i in range(10):
+                scheduler.add_session(i, 'jckantor_complex')
+            scheduler.set_inputs(1, {'Tsp': 380})
+            scheduler.run(n_ticks = 160)
+
+            # every session follows the same trajectory as a simulator with the same step
+            mysim = Simulator(model = Model(os.path.join(path, 'models', 'jckantor_complex')))
+            mysim.update_inputs(simvars = {'Tf': 8, 'n': 161})
+            mysim.reinitialize()
+            full = mysim.run()
+            history = scheduler.sessions[0].history()
+            metrics = scheduler.metrics()
+            ok = metrics['ticks'] == 160 and (history['T'] - full['T'].astype(float).iloc[:160]).abs().max() < 1e-3
+            ok = ok and scheduler.sessions[1].history()['Tsp'].iloc[-1] == 380
+            er = 'sessions differ from the simulator'
+
+            # periodic subroutines, profiles and sessions added later follow the simulator too
+            model = Model(os.path.join(path, 'models', 'jckantor_complex'))
+            class SlowSubroutines(model.subroutine_class):
+                @periodic(0.5, phase = 0.25)
+                def temperature_pid_coolant_flowratea(self):
+                    return super().temperature_pid_coolant_flowratea()
+            model.subroutine_class = SlowSubroutines
+            with tempfile.TemporaryDirectory() as tmp:
+                with open(os.path.join(tmp, 'feed.csv'), 'w') as f:
+                    f.write('Time,q\n0,100\n2.02,120\n')
+                model.mvars.default.loc['q','Value'] = Profile(os.path.join(tmp, 'feed.csv'))
+            scheduler = RealtimeScheduler(tick = 0.01, speed = 5, models_dir = os.path.join(path, 'models'))
+            scheduler._models['slow'] = model
+            scheduler.add_session('first', 'slow')
+            scheduler.run(n_ticks = 20)
+            scheduler.add_session('late', 'slow')
+            scheduler.run(n_ticks = 140)
+            mysim = Simulator(model = model)
+            mysim.update_inputs(simvars = {'Tf': 8, 'n': 161})
+            mysim.reinitialize()
+            full = mysim.run()
+            for session_id, n in [('first', 160), ('late', 140)]:
+                history = scheduler.sessions[session_id].history()
+                ok = ok and (history['T'] - full['T'].iloc[:n]).abs().max() < 1e-3 and history['q'].iloc[-1] == 120
+            er = 'sessions differ from the simulator with periodic subroutines and profiles'
+        except Exception as e:
+            ok = False; er = e
+        self.assertTrue(ok, er)
+
+    def test_periodic_subroutines(self):
+        path = os.getcwd()
+        model = Model(os.path.join(path,'models', 'jckantor_complex'))
+        class SlowSubroutines(model.subroutine_class):
+            @periodic(0.5, phase = 0.25)
+            def temperature_pid_coolant_flowratea(self):
+                return super().temperature_pid_coolant_flowratea()
+        try:
+            mysim = Simulator(model = model)
+            mysim.subroutines = SlowSubroutines(model, mysim)
+            calls = []
+            step_span = mysim._step_span
+            mysim._step_span = lambda times, state: calls.append(times) or step_span(times, state)
+            mysim.update_inputs(simvars = {'n': 161})
+            mysim.reinitialize()
+            data = mysim.run()
+
+            # the controller runs at 0.25, 0.75, ... and the integrator only stops there.
+            # Variables are logged before the subroutines run, so new values show one step later
+            changes = data.index[data['qc'].diff().fillna(0) != 0]
+            ok = len(mysim.subroutines.qLog) == 16 and all(abs((t - 0.3)/0.5 - round((t - 0.3)/0.5)) < 1e-9 for t in changes)
+            ok = ok and len(calls) == 17 and all(len(c) == 11 for c in calls[1:-1])
+            er = 'periodic subroutine not scheduled as declared'
+        except Exception as e:
+            ok = False; er = e
+        self.assertTrue(ok, er)
+
+    def test_uncertainty(self):
+        path = os.getcwd()
+        model_path = os.path.join(path, 'models', 'jckantor_complex')
+        try:
+            bands, samples = propagate_uncertainty(model_path, n_samples = 30, variables = ['q', 'Cf'], seed = 0,
+                                                   batch_size = 12, processes = 1)
+
+            # the bands are the percentiles of the simulations of every sample
+            runs = []
+            for sample in samples.to_dict('records'):
+                mysim = Simulator(model = Model(model_path))
+                mysim.update_inputs(mvars = sample)
+                mysim.reinitialize()
+                runs.append(mysim.run()['T'].astype(float).values)
+            expected = np.percentile(np.array(runs), [5, 50, 95], axis = 0, method = 'hazen')
+            ok = len(bands) == len(runs[0]) and np.abs(bands['T'].values.T - expected).max() < 0.1
+
+            try:
+                propagate_uncertainty(model_path, n_samples = 0, processes = 1)
+                ok = False
+            except ValueError:
+                pass
+            er = 'percentile bands differ from the individual simulations'
+        except Exception as e:
+            ok = False; er = e
+        self.assertTrue(ok, er)
+
+    def test_sobol_indices(self):
+        path = os.getcwd()
+        try:
+            # Ishigami function, with known indices
+            u = np.random.default_rng(0).uniform(-np.pi, np.pi, (4096, 6))
+            A, B = u[:,:3], u[:,3:]
+            f = lambda x: (np.sin(x[:,0]) + 7*np.sin(x[:,1])**2 + 0.1*x[:,2]**4*np.sin(x[:,0]))[:,None]
+            fAB = np.array([f(np.where(np.arange(3) == j, B, A)) for j in range(3)])
+            result = saltelli_indices(f(A), f(B), fAB, seed = 0)
+            ok = np.allclose(result['S1'].ravel(), [0.314, 0.442, 0.], atol = 0.05) and np.allclose(result['ST'].ravel(), [0.558, 0.442, 0.244], atol = 0.05)
+            ok = ok and np.all(result['ST_low'] <= result['ST']) and np.all(result['ST'] <= result['ST_high'])
+
+            # the minimum coolant flow of the controller is never reached
+            indices, evaluations = sobol_indices(os.path.join(path, 'models', 'jckantor_complex'), {'Tmax': lambda data: data['T'].max()},
+                                                 n_samples = 16, distributions = {'UA': (4e4, 6e4), 'qc_min': (0, 1)}, seed = 0, processes = 1)
+            ok = ok and len(evaluations) == 16*4 and indices.loc[('Tmax', 'qc_min'), 'ST'] < 0.1 and indices.loc[('Tmax', 'UA'), 'ST'] > 0.5
+            er = 'Sobol indices not estimated correctly'
+        except Exception as e:
+            ok = False; er = e
+        self.assertTrue(ok, er)
+
+    def test_state_estimator(self):
+        path = os.getcwd()
+        class SoftSensor(EstimatorSubroutine):
+            measured = ['P', 'V']
+            noise = {'P': 'P_noise', 'V': 'V_noise'}
+            initial_guess = {'S': 8, 'X': 0.1}
+            initial_std = {'X': 0.05, 'S': 2}
+            seed = 0
+            @periodic(0.5)
+            def state_estimation(self):
+                return super().state_estimation()
+        try:
+            ok = True
+            with tempfile.TemporaryDirectory() as tmp:
+                # jckantor_simple, with the sensor noise levels as subroutine variables
+                for file in ['manipulated_vars.csv', 'parameters.csv', 'model.py']:
+                    shutil.copy(os.path.join(path, 'models', 'jckantor_simple', file), tmp)
+                with open(os.path.join(tmp, 'controlled_vars.csv'), 'w') as f:
+                    f.write('Var,Label,Value,Units,Min,Max\nP_noise,Product Sensor Noise,0.02,g/L,0,0.2\nV_noise,Volume Sensor Noise,0.01,L,0,0.1\n')
+                model = Model(tmp)
+                for kalman_filter in ['ekf', 'ukf']:
+                    SoftSensor.filter = kalman_filter
+                    mysim = Simulator(model = model)
+                    mysim.subroutines = SoftSensor(model, mysim)
+                    mysim.update_inputs(simvars = {'Tf': 40, 'n': 401})
+                    mysim.reinitialize()
+                    data = mysim.run()
+
+                    # X and S are tracked from the noisy measurements of P and V, starting from a wrong guess
+                    estimates = mysim.subroutines.estimates
+                    last = estimates[-1]
+                    ok = ok and len(estimates) == 81 and abs(last['X_est'] - data['X'].iloc[-1]) < 0.1 and abs(last['S_est'] - data['S'].iloc[-1]) < 0.05
+                    ok = ok and last['S_std'] < 0.1*estimates[0]['S_std']
+
+            # a fleet of filters, one per feed rate, with missing measurements of P
+            F = np.linspace(0.02, 0.08, 50)
+            fleet = ExtendedKalmanFilter(model, ['P', 'V'], np.tile([0, 8, 1, 0.1], (50, 1)), np.diag([1e-2, 4, 1e-2, 2.5e-3]), np.zeros((4, 4)),
+                                         np.diag([4e-4, 1e-4]), parameters = {**model.get_vars_dict(), 'F': F})
+            fleet.predict(0.5)
+            x = fleet.update(np.stack([np.full(50, np.nan), 1 + 0.5*F], axis = 1))
+            ok = ok and x.shape == (50, 4) and np.allclose(x[:, 2], 1 + 0.5*F, atol = 1e-3)
+            er = 'states not estimated'
+        except Exception as e:
+            ok = False; er = e
+        self.assertTrue(ok, er)
+
+    def test_changed_vars(self):
+        path = os.getcwd()
+        try:
+            model = Model(os.path.join(path, 'models', 'jckantor_complex'))
+            ok = len(model.get_changed_vars_dict()) == len(model.get_vars_dict()) and model.get_changed_vars_dict() == {}
+            model.update_mvars_from_dict({'q': 120, 'T': 360})
+            ok = ok and model.get_changed_vars_dict() == {'q': 120}
+
+            # all the variables are pushed at the start of a run, then only the controller output and initial conditions
+            mysim = Simulator(model = model)
+            pushed = []
+            set_parameters = mysim.simulators[None].set_parameters
+            mysim.simulators[None].set_parameters = lambda values: pushed.append(values) or set_parameters(values)
+            mysim.set_inputs()
+            mysim.run()
+            ok = ok and set(pushed[0]) == set(model.get_vars_dict()) and all(set(p) <= {'qc', 'C0', 'T0', 'Tc0'} for p in pushed[1:])
+            ok = ok and any('qc' not in p for p in pushed[1:])
+            er = 'changed variables not tracked'
+        except Exception as e:
+            ok = False; er = e
+        self.assertTrue(ok, er)
+
+    def test_run_history(self):
+        path = os.getcwd()
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                history = RunHistory(tmp, fmt = 'csv')
+                mysim = Simulator(model = Model(os.path.join(path, 'models', 'jckantor_complex')))
+                for UA in [4e4, 5e4, 6e4]:
+                    mysim.update_inputs(params = {'UA': UA})
+                    mysim.reinitialize()
+                    history.save(mysim, mysim.run())
+
+                runs = history.find('jckantor_complex', UA = (4.5e4, None))
+                ok = list(runs.index) == [2, 3] and history.values(2)[('params', 'UA')] == 5e4
+                ok = ok and list(history.find(UA = 4e4, Tsp = 390).index) == [1] and history.find('jckantor_simple').empty
+
+                # same inputs, same hash
+                mysim.reinitialize()
+                run_id = history.save(mysim, mysim.run())
+                ok = ok and list(history.find(hash = runs.loc[3, 'hash']).index) == [3, run_id]
+
+                overlay = history.load(runs.index, variables = ['T'])
+                ok = ok and list(overlay[3].columns) == ['T'] and len(overlay[3]) == runs.loc[3, 'n_steps']
+                history.delete(2)
+                ok = ok and list(history.find().index) == [1, 3, 4]
+
+                # only the latest runs are kept
+                history.max_runs = 2
+                mysim.reinitialize()
+                history.save(mysim, mysim.run())
+                ok = ok and list(history.find().index) == [4, 5] and sorted(f for f in os.listdir(tmp) if f.endswith('.csv')) == ['000004.csv', '000005.csv']
+                history.close()
+            er = 'runs not stored or found'
+        except Exception as e:
+            ok = False; er = e
+        self.assertTrue(ok, er)
+
+    def test_regression(self):
+        try:
+            index = check_all()
+            ok = not index.empty and (index.status == 'ok').all()
+            er = index.message.tolist()
+
+            with tempfile.TemporaryDirectory() as tmp:
+                case = load_cases(pattern = 'simple_default')['simple_default']
+                shutil.copy(os.path.join('goldens', 'simple_default.csv'), tmp)
+                ok = ok and check_case('simple_default', case, goldens_dir = tmp)['status'] == 'ok'
+
+                # a change of the results or a run over budget fails
+                ok = ok and check_case('simple_default', {**case, 'mvars': {'F': 0.06}}, goldens_dir = tmp)['status'] == 'accuracy'
+                ok = ok and check_case('simple_default', {**case, 'budgets': {'wall_time_s': 1e-9}}, goldens_dir = tmp)['status'] == 'wall_time'
+                ok = ok and check_case('missing', case, goldens_dir = tmp)['status'] == 'missing'
+        except Exception as e:
+            ok = False; er = e
+        self.assertTrue(ok, er)
+
+    def test_surrogate(self):
+        path = os.getcwd()
+        try:
+            surrogate = Surrogate(os.path.join(path, 'models', 'jckantor_simple'), distributions = {'Sf': (5, 15), 'F': (0.03, 0.08)}, degree = 4)
+            surrogate.fit(n_samples = 64, seed = 1)
+            ok = (surrogate.errors.loc[['X', 'S', 'P'], 'nrmse'] < 1e-3).all()
+
+            mysim = Simulator(model = Model(os.path.join(path, 'models', 'jckantor_simple')))
+            mysim.update_inputs(mvars = {'Sf': 12, 'F': 0.06})
+            mysim.reinitialize()
+            data = mysim.run()
+            prediction = surrogate.predict({'Sf': 12, 'F': 0.06})
+            ok = ok and surrogate.applies_to(input_values(mysim)) and np.allclose(prediction['X'], data['X'], rtol = 1e-3)
+            surrogate.observe({'Sf': 12, 'F': 0.06}, data)
+            ok = ok and surrogate.observed_errors().loc['X', 'n'] == len(data)
+
+            # other inputs than the trained ones are out of scope
+            mysim.update_inputs(params = {'mu_max': 0.3})
+            ok = ok and not surrogate.applies_to(input_values(mysim))
+
+            with tempfile.TemporaryDirectory() as tmp:
+                surrogate.save(os.path.join(tmp, 'jckantor_simple.pkl.gz'))
+                loaded = Surrogate.load(os.path.join(tmp, 'jckantor_simple.pkl.gz'))
+                ok = ok and np.allclose(loaded.predict({'Sf': 12, 'F': 0.06}), prediction) and len(loaded.observed_errors()) > 0
+            er = surrogate.errors
+        except Exception as e:
+            ok = False; er = e
+        self.assertTrue(ok, er)
+
+    def test_prefetch(self):
+        path = os.getcwd()
+        try:
+            cache = ResultCache(max_entries = 3)
+            prefetcher = Prefetcher(os.path.join(path, 'models', 'jckantor_simple'), cache, workers = 1, recent = 1, bounds = {'Sf': (0, 20)})
+            mysim = Simulator(model = Model(os.path.join(path, 'models', 'jckantor_simple')))
+            mysim.reinitialize()
+            prefetcher.touch('Sf', 0.5)
+            prefetcher.schedule(input_values(mysim))
+            ok = len(prefetcher._queue) + len(prefetcher._running) == 2
+
+            # moving another variable cancels the queued neighbours of the first one
+            prefetcher.touch('F', 0.01)
+            prefetcher.schedule(input_values(mysim))
+            ok = ok and prefetcher.cancelled == 1
+
+            mysim.update_inputs(mvars = {'F': 0.06})
+            mysim.reinitialize()
+            key = prefetcher.key(input_values(mysim))
+            for _ in range(300):
+                if key in cache:
+                    break
+                time.sleep(0.1)
+            prefetched = prefetcher.result(key)
+            ok = ok and prefetched is not None and np.allclose(prefetched.values, mysim.run().astype(float).values)
+            ok = ok and len(cache) <= 3 and cache.stats()['hits'] == 1
+            prefetcher.close()
+            er = cache.stats()
+        except Exception as e:
+            ok = False; er = e
+        self.assertTrue(ok, er)
+
+    def test_state_events(self):
+        path = os.getcwd()
+        source = '\n'.join([
+            'from pyfoomb import BioprocessModel',
+            '',
+            'class MyModel(BioprocessModel):',
+            '    terminal_events = [2]',
+            '',
+            '    def rhs(self, t, y, sw):',
+            '        P,S,V,X = y',
+            "        mu = self.model_parameters['mu_max']*S/(self.model_parameters['Ks'] + S)",
+            "        F = self.model_parameters['F'] if sw[0] else 0",
+            "        Sf = self.model_parameters['Sf']",
+            "        return [-F*P/V + self.model_parameters['Ypx']*mu*X, F*(Sf-S)/V - mu*X/self.model_parameters['Yxs'], F, -F*X/V + mu*X]",
+            '',
+            '    def state_events(self, t, y, sw):',
+            '        P,S,V,X = y',
+            '        return [t - 2., S - 2., V - 1.3]',
+            '',
+            '    def change_states(self, t, y, sw):',
+            '        P,S,V,X = y',
+            '        if S <= 2.:',
+            "            Sf = self.model_parameters['Sf']",
+            '            return [P*V/(V + 0.1), (S*V + Sf*0.1)/(V + 0.1), V + 0.1, X*V/(V + 0.1)]',
+            '        return y',
+            ''])
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                for file in ['manipulated_vars.csv', 'parameters.csv']:
+                    shutil.copy(os.path.join(path, 'models', 'jckantor_simple', file), tmp)
+                with open(os.path.join(tmp, 'model.py'), 'w') as f:
+                    f.write(source)
+                mysim = Simulator(model = Model(tmp))
+                mysim.update_inputs(mvars = {'X0': 2.}, simvars = {'Tf': 20, 'n': 201})
+                mysim.reinitialize()
+                data = mysim.run()
+                events = pd.DataFrame(mysim.events)
+
+                # the feed starts at t = 2 exactly, a substrate pulse keeps S above 2 and the run ends when the reactor is full
+                feed = events[events.Event == 0].Time.values
+                ok = len(feed) == 1 and abs(feed[0] - 2.) < 1e-8
+                ok = ok and (events.Event == 1).sum() == 1 and data.S.min() > 2. - 1e-6
+                ok = ok and events.Terminal.iloc[-1] and data.index[-1] == events.Time.iloc[-1] < 20
+                ok = ok and data.V.iloc[-1] >= 1.3 - 1e-6 and (data.V.iloc[:-1] < 1.3).all()
+
+                # runs are repeatable
+                mysim.reinitialize()
+                ok = ok and np.allclose(mysim.run().values.astype(float), data.values.astype(float)) and len(mysim.events) == len(events)
+
+                raised = 0
+                try:
+                    mysim.run_sensitivity()
+                except ValueError:
+                    raised += 1
+                try:
+                    Simulator(model = Model(tmp), replicate_ids = ['a', 'b']).run()
+                except ValueError:
+                    raised += 1
+                ok = ok and raised == 2
+            er = events
+        except Exception as e:
+            ok = False; er = e
+        self.assertTrue(ok, er)
+
+    def test_result_precision(self):
+        path = os.getcwd()
+        try:
+            mysim = Simulator(model = Model(os.path.join(path, 'models', 'jckantor_complex')))
+            mysim.reinitialize()
+            exact = mysim.run()
+            mysim.update_inputs(simvars = {'precision': 'float32'})
+            mysim.reinitialize()
+            data = mysim.run()
+            ok = (exact.dtypes == np.float64).all() and (data.dtypes == np.float32).all() and data.index.dtype == np.float64
+            ok = ok and np.allclose(data.values, exact.values, rtol = 1e-6) and np.array_equal(data.index.values, exact.index.values)
+            ok = ok and data.memory_usage(index = False).sum()*2 == exact.memory_usage(index = False).sum()
+            ok = ok and decode_frame(encode_frame(data)).values.dtype == np.float32
+
+            # flags are kept as booleans, a variable that is not always boolean is numeric
+            recorder = Recorder(dtype = np.float32, chunk_size = 2)
+            recorder._start(['on', 'x', 'mixed'])
+            for i, (on, x, mixed) in enumerate([(True, 1., False), (False, 2., 0.5), (True, 3., True)]):
+                recorder.append(i, 0.1*i, {'on': on, 'x': x, 'mixed': mixed})
+            frame = recorder.to_frame()
+            ok = ok and list(frame.dtypes) == [np.bool_, np.float32, np.float32] and list(frame.on) == [True, False, True]
+
+            # files keep the precision of the results
+            with tempfile.TemporaryDirectory() as tmp:
+                write_timeseries(pd.DataFrame({'x': np.float32([0.1])}, index = [0.]), os.path.join(tmp, 'x.csv'))
+                write_timeseries(frame, os.path.join(tmp, 'frame.csv'))
+                with open(os.path.join(tmp, 'x.csv')) as f:
+                    ok = ok and f.read().splitlines() == ['Time,x', '0.0,0.1']
+                with open(os.path.join(tmp, 'frame.csv')) as f:
+                    ok = ok and f.read().splitlines()[1:] == ['0.0,1.0,1.0,0.0', '0.1,0.0,2.0,0.5', '0.2,1.0,3.0,1.0']
+
+            mysim.update_inputs(simvars = {'precision': 'float16'})
+            mysim.reinitialize()
+            try:
+                mysim.run()
+                ok = False
+            except ValueError:
+                pass
+            er = data.dtypes
+        except Exception as e:
+            ok = False; er = e
+        self.assertTrue(ok, er)
+
+    def test_stiff_steps(self):
+        path = os.getcwd()
+        try:
+            # the step size carried over from the previous step fails on this stiff stretch, the step is repeated
+            mysim = Simulator(model = Model(os.path.join(path, 'models', 'jckantor_complex')))
+            mysim.update_inputs(mvars = {'q': 96.0838099947184, 'Cf': 2.8109725647995205})
+            mysim.reinitialize()
+            with warnings.catch_warnings():
+                warnings.simplefilter('error', ODEintWarning)
+                data = mysim.run()
+            ok = len(data) == len(mysim.time) and np.isfinite(data.values.astype(float)).all()
+            er = data.tail()
+        except Exception as e:
+            ok = False; er = e
+        self.assertTrue(ok, er)
@@ -0,0 +1,377 @@
+"""
+Monte Carlo propagation of the uncertainty of inputs to percentile bands of the trajectories.
+
+Inputs are sampled within the Min/Max bounds of the variable tables, or from given distributions,
+and every batch of samples runs as one ensemble on the stacked sessions of `realtime`.
+Only a bounded summary of every batch is kept, so thousands of samples fit in memory:
+
+    bands, samples = propagate_uncertainty('models/jckantor_complex', n_samples = 2000,
+                                           distributions = {'UA': scipy.stats.norm(5e4, 2e3)}, variables = ['Cf'])
+    bands['T'][['P5', 'P95']].plot()
+"""
+from engine import Model, Vars, Recorder, result_dtype
+from realtime import RealtimeScheduler
+from concurrent.futures import ProcessPoolExecutor
+from scipy.stats import qmc
+import pandas as pd
+import numpy as np
+import os
+
+def input_bounds(model: Model):
+    """
+    Returns the Min/Max bounds of the manipulated and controlled variables that have both, in a dictionary
+
+    Arguments
+    ---------
+        model : Model
+    """
+    tables = [model.mvars.default]
+    if os.path.isfile(os.path.join(model.path, 'controlled_vars.csv')):
+        tables.append(Vars(model.path, 'controlled_vars.csv').default)
+    bounds = {}
+    for table in tables:
+        if 'Min' not in table.columns or 'Max' not in table.columns:
+            continue
+        for var, row in table.iterrows():
+            if row['Min'] is not False and row['Max'] is not False and float(row['Max']) > float(row['Min']):
+                bounds[var] = (float(row['Min']), float(row['Max']))
+    return bounds
+
+def sample_inputs(model: Model, n_samples, variables = None, distributions = None, method = 'lhs', seed = None):
+    """
+    Samples input values, uniformly within the Min/Max bounds of the variable tables or from user distributions.
+
+    Arguments
+    ---------
+        model : Model
+            Model whose variables are sampled
+        n_samples : int
+            Number of samples
+
+    Keyword Arguments
+    -----------------
+        variables : list
+            Variables to sample within their Min/Max bounds. Defaults to None, all the variables with bounds,
+            unless distributions are given.
+        distributions : dict
+            Distribution of other variables, either a (low, high) tuple or a frozen scipy.stats distribution,
+            e.g. {'UA': scipy.stats.norm(5e4, 2e3)}. Defaults to None.
+        method : str
+            "lhs" for Latin hypercube or "sobol" for a scrambled Sobol sequence. Defaults to "lhs".
+        seed : int
+            Seed of the sampler.
+
+    Raises
+    ------
+        KeyError
+            If a variable has no bounds and no distribution.
+        ValueError
+            If the method is not recognized.
+    """
+    dists = input_distributions(model, variables, distributions)
+    if method == 'lhs':
+        sampler = qmc.LatinHypercube(d = len(dists), seed = seed)
+    elif method == 'sobol':
+        sampler = qmc.Sobol(d = len(dists), scramble = True, seed = seed)
+    else:
+        raise ValueError('Sampling method not recognized. Please use "lhs" or "sobol".')
+    return from_unit(sampler.random(n_samples), dists)
+
+def input_distributions(model: Model, variables = None, distributions = None):
+    """
+    Returns the distribution of every sampled variable, in sampling order. See `sample_inputs`.
+
+    Arguments
+    ---------
+        model : Model
+
+    Keyword Arguments
+    -----------------
+        variables : list
+            Variables sampled within their Min/Max bounds.
+        distributions : dict
+            Distribution of other variables.
+
+    Raises
+    ------
+        KeyError
+            If a variable has no bounds and no distribution.
+    """
+    bounds = input_bounds(model)
+    distributions = dict(distributions or {})
+    if variables is None:
+        variables = [] if distributions else list(bounds)
+    missing = [v for v in variables if v not in bounds and v not in distributions]
+    if missing:
+        raise KeyError('No Min/Max bounds or distribution for {}'.format(missing))
+    dists = {v: bounds[v] for v in variables if v not in distributions}
+    dists.update(distributions)
+    return dists
+
+def from_unit(u, dists:dict):
+    """
+    Maps points of the unit hypercube to input values, one column per distribution
+
+    Arguments
+    ---------
+        u : np.ndarray
+            Points with shape (samples, variables), between 0 and 1
+        dists : dict
+            Distribution of every variable, see `input_distributions`
+    """
+    samples = {}
+    for j, (v, dist) in enumerate(dists.items()):
+        if isinstance(dist, tuple):
+            samples[v] = dist[0] + u[:,j]*(dist[1] - dist[0])
+        else:
+            samples[v] = dist.ppf(u[:,j])
+    return pd.DataFrame(samples).rename_axis('Sample')
+
+class QuantileSummary():
+    """
+    Bounded-size summary of the distribution of every variable at every time, updated one batch of samples at a time.
+    Keeps `size` weighted points per variable and time, so memory does not depend on the number of samples.
+    """
+    def __init__(self, size = 201):
+        """
+        Keyword Arguments
+        -----------------
+            size : int
+                Number of points kept per variable and time. Defaults to 201.
+        """
+        self.size = size
+        self.values = None
+        self.weights = None
+        self.count = 0
+
+    def update(self, batch):
+        """
+        Adds a batch of samples
+
+        Arguments
+        ---------
+            batch : np.ndarray
+                Values with shape (samples, times, variables)
+        """
+        batch = np.moveaxis(np.asarray(batch, dtype = float), 0, -1)
+        weights = np.ones(batch.shape)
+        self.count += batch.shape[-1]
+        if self.values is not None:
+            batch = np.concatenate([self.values, batch], axis = -1)
+            weights = np.concatenate([self.weights, weights], axis = -1)
+        self.values, self.weights = self._compress(batch, weights)
+
+    def merge(self, other):
+        """
+        Adds the samples summarized by another QuantileSummary
+        """
+        if other.values is None:
+            return
+        if self.values is None:
+            self.values, self.weights, self.count = other.values, other.weights, other.count
+            return
+        values = np.concatenate([self.values, other.values], axis = -1)
+        weights = np.concatenate([self.weights, other.weights], axis = -1)
+        self.count += other.count
+        self.values, self.weights = self._compress(values, weights)
+
+    def _compress(self, values, weights):
+        """
+        Reduces weighted points to `size` points of equal weight, at evenly spaced quantiles
+        """
+        if values.shape[-1] <= self.size:
+            return values, weights
+        order = np.argsort(values, axis = -1)
+        values = np.take_along_axis(values, order, axis = -1)
+        weights = np.take_along_axis(weights, order, axis = -1)
+        total = weights.sum(axis = -1, keepdims = True)
+        position = np.cumsum(weights, axis = -1) - weights/2
+        levels = (np.arange(self.size) + 0.5)/self.size
+        flat_values = values.reshape(-1, values.shape[-1])
+        flat_position = (position/total).reshape(flat_values.shape)
+        compressed = np.array([np.interp(levels, p, v) for p, v in zip(flat_position, flat_values)])
+        compressed = compressed.reshape(*values.shape[:-1], self.size)
+        return compressed, np.broadcast_to(total/self.size, compressed.shape).copy()
+
+    def quantiles(self, q):
+        """
+        Returns the q-th quantiles of every variable at every time, with shape (quantiles, times, variables)
+
+        Arguments
+        ---------
+            q : list
+                Quantiles, between 0 and 1
+        """
+        order = np.argsort(self.values, axis = -1)
+        values = np.take_along_axis(self.values, order, axis = -1)
+        weights = np.take_along_axis(self.weights, order, axis = -1)
+        position = (np.cumsum(weights, axis = -1) - weights/2)/weights.sum(axis = -1, keepdims = True)
+        flat_values = values.reshape(-1, values.shape[-1])
+        flat_position = position.reshape(flat_values.shape)
+        result = np.array([np.interp(q, p, v) for p, v in zip(flat_position, flat_values)])
+        return np.moveaxis(result.reshape(*values.shape[:-1], len(q)), -1, 0)
+
+# one model per path and process, so models are imported only once per worker
+_models = {}
+
+def _get_model(model_path):
+    if model_path not in _models:
+        _models[model_path] = Model(model_path)
+    return _models[model_path]
+
+def run_members(model_path, samples: pd.DataFrame, outputs = None, simvars = None):
+    """
+    Runs one simulation per sample as a single batched ensemble: all the members are advanced together,
+    one stacked integration per time step, and their subroutines run on plain dictionaries.
+    Returns the trajectories with shape (samples, times, outputs), in the precision of the simulator variables,
+    the time and the output names.
+
+    Arguments
+    ---------
+        model_path :
+            Path poiting to a specific model directory.
+        samples : pd.DataFrame
+            One row per member, with the values of the sampled variables. Initial conditions (e.g. T0) also set the state.
+
+    Keyword Arguments
+    -----------------
+        outputs : list
+            Variables to keep. Defaults to None, the states, manipulated and controlled variables.
+        simvars : dict
+            New values of the simulator variables. Defaults to None.
+    """
+    model = _get_model(model_path)
+    scheduler = RealtimeScheduler(models_dir = os.path.dirname(model_path))
+    for k, value in (simvars or {}).items():
+        scheduler.simvars.current.loc[k,'Value'] = value
+    ti = float(scheduler.simvars.current.loc['Ti','Value'])
+    tf = float(scheduler.simvars.current.loc['Tf','Value'])
+    n = int(scheduler.simvars.current.loc['n','Value'])
+    scheduler.tick = (tf - ti)/max(n - 1, 1)
+    scheduler._models[os.path.basename(model_path)] = model
+
+    sessions = []
+    for i, sample in enumerate(samples.to_dict('records')):
+        session = scheduler.add_session(i, os.path.basename(model_path), recording = Recorder(variables = []))
+        for k, value in sample.items():
+            # sampled values replace any function of time or profile
+            session._apply_inputs({k: value})
+            if k in session.parameters and k[:-1] in session.state and k.endswith('0'):
+                session.state[k[:-1]] = value
+        if session.subroutines:
+            # initialize the subroutines with the sampled values
+            session.subroutines.model_parameters = {**session.parameters, **session.state}
+            session.subroutines.model_state = dict(session.state)
+            session.subroutines.subroutine_vars = session.subroutine_vars
+            session.subroutines._initialization()
+        sessions.append(session)
+
+    if outputs is None:
+        first = sessions[0]
+        outputs = [*first.states, *[k for k in model.mvars.default.index if not model.mvars.default.loc[k,'State']], *first.subroutine_vars]
+
+    batch = np.empty((len(sessions), n, len(outputs)), dtype = result_dtype(scheduler.simvars))
+    for i in range(n):
+        for j, s in enumerate(sessions):
+            row = {**s.parameters, **s.state, **s.subroutine_vars}
+            batch[j, i] = [row[v] for v in outputs]
+        scheduler.step()
+    return batch, np.linspace(ti, tf, n), outputs
+
+def run_ensemble(model_path, samples: pd.DataFrame, outputs = None, simvars = None, size = 201):
+    """
+    Runs the samples as a batched ensemble, see `run_members`, and returns the QuantileSummary of the outputs
+    and the output names.
+
+    Arguments
+    ---------
+        model_path :
+            Path poiting to a specific model directory.
+        samples : pd.DataFrame
+            One row per member, with the values of the sampled variables.
+
+    Keyword Arguments
+    -----------------
+        outputs : list
+            Variables to summarize. Defaults to None, the states, manipulated and controlled variables.
+        simvars : dict
+            New values of the simulator variables. Defaults to None.
+        size : int
+            Number of points kept per variable and time by the summary. Defaults to 201.
+    """
+    batch, time, outputs = run_members(model_path, samples, outputs, simvars)
+    summary = QuantileSummary(size)
+    summary.update(batch)
+    return summary, outputs
+
+def propagate_uncertainty(model_path, n_samples = 1000, variables = None, distributions = None, method = 'lhs', seed = None,
+                          quantiles = (0.05, 0.5, 0.95), outputs = None, simvars = None, batch_size = 1000, processes = None):
+    """
+    Monte Carlo propagation of the uncertainty of inputs. Samples are run in batched ensembles, in parallel processes,
+    and only a bounded summary of each batch is kept, so memory does not grow with the number of samples.
+
+    Arguments
+    ---------
+        model_path :
+            Path poiting to a specific model directory.
+
+    Keyword Arguments
+    -----------------
+        n_samples : int
+            Number of samples. Defaults to 1000.
+        variables : list
+            Variables sampled within their Min/Max bounds. See `sample_inputs`.
+        distributions : dict
+            Distribution of other variables. See `sample_inputs`.
+        method : str
+            "lhs" or "sobol". Defaults to "lhs".
+        seed : int
+            Seed of the sampler.
+        quantiles : tuple
+            Quantiles of the bands. Defaults to (0.05, 0.5, 0.95).
+        outputs : list
+            Variables to summarize. See `run_ensemble`.
+        simvars : dict
+            New values of the simulator variables. Defaults to None.
+        batch_size : int
+            Samples per ensemble. Defaults to 1000.
+        processes : int
+            Number of worker processes. Defaults to the number of CPUs, 1 runs serially.
+
+    Returns
+    -------
+        bands : pd.DataFrame
+            Quantiles indexed by time, with (variable, quantile) columns, e.g. ('T', 'P95').
+        samples : pd.DataFrame
+            Sampled input values.
+
+    Raises
+    ------
+        ValueError
+            If n_samples is not positive.
+    """
+    if n_samples < 1:
+        raise ValueError('The number of samples must be positive, got {}.'.format(n_samples))
+    model_path = os.path.abspath(model_path)
+    samples = sample_inputs(_get_model(model_path), n_samples, variables, distributions, method, seed)
+    batches = [samples.iloc[i:i+batch_size] for i in range(0, len(samples), batch_size)]
+    args = [(model_path, b, outputs, simvars) for b in batches]
+
+    if processes == 1:
+        results = [run_ensemble(*a) for a in args]
+    else:
+        with ProcessPoolExecutor(max_workers = processes) as pool:
+            results = list(pool.map(run_ensemble, *zip(*args)))
+
+    summary = QuantileSummary()
+    for batch_summary, names in results:
+        summary.merge(batch_summary)
+
+    simulator_vars = Vars(os.path.dirname(os.path.abspath(__file__)), 'simulator_vars.csv').current['Value'].to_dict()
+    simulator_vars.update(simvars or {})
+    time = np.linspace(float(simulator_vars['Ti']), float(simulator_vars['Tf']), int(simulator_vars['n']))
+
+    values = summary.quantiles(list(quantiles))
+    columns = pd.MultiIndex.from_product([names, ['P{:g}'.format(100*q) for q in quantiles]], names = ['Var', 'Quantile'])
+    bands = pd.DataFrame(values.transpose(1, 2, 0).reshape(len(time), -1), index = time, columns = columns)
+    return bands, samples